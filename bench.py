@@ -0,0 +1,989 @@
+# ================================
+# bench.py
+# Бенчмарки Horror-Studio Bot
+#
+# python bench.py groq --players 50 --latency 0.5
+# python bench.py db --players 100 --turns 50
+# python bench.py messages --rows 2000000
+# python bench.py prompt --characters 15 --context 20
+# python bench.py budget --budget 3000
+# python bench.py stream --latency 0.3 --token-delay 0.03
+# python bench.py webhook --users 200 --turns 5
+# python bench.py ratelimit --limit 20 --window 2 --requests 100
+# python bench.py replycache --players 200 --turns 3
+# python bench.py router --requests 400 --slow-rate 0.03
+# python bench.py retention --sessions 2000 --messages 100
+# python bench.py startup --runs 5
+# ================================
+
+import argparse
+import asyncio
+import time
+
+
+def _unlimited_ai():
+    """
+    Снимает лимиты запросов к AI: бенчмарки меряют
+    сам бот, а не квоту аккаунта. Одновременных запросов —
+    не больше соединений пула, остальные ждут в планировщике.
+    """
+
+    from groq_ai import GROQ_MAX_CONNECTIONS
+    from ratelimit import ai_scheduler, TokenBucket
+
+    ai_scheduler.concurrency = GROQ_MAX_CONNECTIONS
+    ai_scheduler.requests = TokenBucket(1e9, 1e9)
+    ai_scheduler.tokens = TokenBucket(1e12, 1e12)
+
+
+def _no_reply_cache():
+    """
+    Бенчмарки без БД: кэш ответов не трогаем.
+    """
+
+    from reply_cache import reply_cache
+
+    reply_cache.allowed = False
+
+
+# ================================
+# groq: параллельные игроки
+# ================================
+async def bench_groq(args):
+    """
+    N игроков одновременно ждут ответ AI.
+    Общее время должно быть около одной задержки,
+    а не N задержек.
+    """
+
+    import groq_ai
+    from fake_groq import FakeGroq
+
+    _unlimited_ai()
+    _no_reply_cache()
+    server = FakeGroq(latency=args.latency)
+    groq_ai.GROQ_URL = await server.start()
+
+    story = ("Тест", "Описание", "Прошлое", "Сцена")
+    characters = [("Аня", "подруга (17 лет)", "тихая", "знакомый")]
+
+    try:
+        started = time.perf_counter()
+        replies = await asyncio.gather(*(
+            groq_ai.generate_story_reply(1, story, characters, [], f"привет {i}")
+            for i in range(args.players)
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        await groq_ai.close_session()
+        await server.stop()
+
+    errors = sum(1 for r in replies if r == groq_ai.AI_ERROR_REPLY)
+
+    print(f"Игроков:            {args.players}")
+    print(f"Задержка Groq:      {args.latency:.3f} с")
+    print(f"Общее время:        {elapsed:.3f} с")
+    print(f"Макс. параллельно:  {server.max_in_flight}")
+    print(f"Ошибок:             {errors}")
+
+
+# ================================
+# db: запись сообщений
+# ================================
+async def bench_db(args):
+    """
+    Игроки одновременно пишут и читают сообщения.
+    Показывает среднюю стоимость save_message
+    и задержку event loop во время нагрузки.
+    """
+
+    import os
+    import tempfile
+
+    import db
+
+    tmp = tempfile.mkdtemp()
+    db.DB_NAME = os.path.join(tmp, "bench.db")
+    await db.init_db()
+
+    lag = [0.0]
+
+    async def watch_loop():
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(0.005)
+            lag[0] = max(lag[0], time.perf_counter() - started - 0.005)
+
+    async def player(user_id):
+        for i in range(args.turns):
+            await db.save_message(user_id, 1, "player", f"сообщение {i}")
+            await db.get_last_messages(user_id, 1, limit=20)
+            await db.save_message(user_id, 1, "character", f"ответ {i}")
+
+    watcher = asyncio.create_task(watch_loop())
+
+    started = time.perf_counter()
+    await asyncio.gather(*(player(u) for u in range(args.players)))
+
+    # Считаем и дозапись журнала сообщений при закрытии
+    await db.close_db()
+    elapsed = time.perf_counter() - started
+    watcher.cancel()
+
+    writes = args.players * args.turns * 2
+    log = db.message_log.stats()
+
+    print(f"Игроков:            {args.players}")
+    print(f"Записей:            {writes}")
+    print(f"Общее время:        {elapsed:.3f} с")
+    print(f"Записей в секунду:  {writes / elapsed:.0f}")
+    print(f"На запись:          {elapsed / writes * 1e6:.0f} мкс")
+    print(f"Макс. лаг loop:     {lag[0] * 1000:.1f} мс")
+    print(f"Транзакций:         {log['flushes']} (в среднем {log['avg_batch']} строк)")
+
+
+# ================================
+# messages: последние 20 сообщений на большой таблице
+# ================================
+def bench_messages(args):
+    """
+    Наполняет messages миллионами строк и после каждого шага
+    меряет чтение последних 20 сообщений одних и тех же сессий:
+    длинных (40 сообщений) и коротких (5, без архива).
+    С индексом idx_messages_user_story время не растёт —
+    бенчмарк падает, если оно выросло больше чем в max_growth раз.
+    """
+
+    import os
+    import random
+    import sqlite3
+    import tempfile
+
+    import db
+
+    path = os.path.join(tempfile.mkdtemp(), "bench.db")
+    conn = sqlite3.connect(path, isolation_level=None)
+    for pragma in db.PRAGMAS:
+        conn.execute(pragma)
+
+    db._init_db(conn)
+    if args.no_index:
+        conn.execute("DROP INDEX idx_messages_user_story")
+
+    plan = conn.execute(
+        "EXPLAIN QUERY PLAN SELECT sender, text FROM messages "
+        "WHERE user_id = ? AND story_id = ? ORDER BY id DESC LIMIT ?",
+        (1, 1, 20)
+    ).fetchall()
+    print("План:", "; ".join(row[-1] for row in plan))
+
+    # Замеряемые сессии: размер ответа одинаков на всех шагах.
+    # Случайные сессии растут вместе с таблицей (пока в них
+    # меньше 20 сообщений), и время чтения росло бы из-за этого
+    long_sessions = [(-1 - i, 0) for i in range(args.probes)]
+    short_sessions = [(-1 - args.probes - i, 0) for i in range(args.probes)]
+
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO messages (user_id, story_id, sender, text) VALUES (?, ?, ?, ?)",
+        [(user_id, story_id, "player", "текст сообщения " * 4)
+         for sessions, size in ((long_sessions, 40), (short_sessions, 5))
+         for user_id, story_id in sessions
+         for _ in range(size)]
+    )
+    conn.execute("COMMIT")
+
+    print(f"{'строк':>10}  {'мкс, длинная':>12}  {'мкс, короткая':>13}")
+
+    rnd = random.Random(1)
+    step = args.rows // args.steps
+    seeded = 0
+    results = []
+
+    # Лучший из 5 замеров: одиночные всплески — шум машины, не рост
+    def measure(sessions):
+        rounds = []
+        for _ in range(5):
+            started = time.perf_counter()
+            for _ in range(args.queries // 5):
+                db._get_last_messages(conn, *rnd.choice(sessions), 20)
+            rounds.append((time.perf_counter() - started) / (args.queries // 5) * 1e6)
+        return min(rounds)
+
+    for _ in range(args.steps):
+        rows = (
+            (rnd.randrange(args.users), rnd.randrange(args.stories),
+             "player" if i % 2 else "character", "текст сообщения " * 4)
+            for i in range(step)
+        )
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO messages (user_id, story_id, sender, text) VALUES (?, ?, ?, ?)",
+            rows
+        )
+        conn.execute("COMMIT")
+        seeded += step
+
+        results.append((measure(long_sessions), measure(short_sessions)))
+        print(f"{seeded:>10}  {results[-1][0]:>12.1f}  {results[-1][1]:>13.1f}")
+
+    conn.close()
+
+    growth = max(last / first for first, last in zip(results[0], results[-1]))
+    print(f"Рост времени чтения: x{growth:.2f}")
+
+    if not args.no_index and growth > args.max_growth:
+        raise SystemExit(f"Чтение замедлилось больше чем в {args.max_growth} раза")
+
+
+# ================================
+# prompt: сборка промпта
+# ================================
+def bench_prompt(args):
+    """
+    Сравнивает полный рендер промпта на каждом ходе
+    со сборкой из закэшированного статичного блока.
+    """
+
+    from prompts import PromptBuilder, render_system_prompt, approx_tokens
+
+    story = ("Тест", "Описание истории. " * 100, "Прошлое героя. " * 50, "Сцена. " * 50)
+    characters = [
+        (f"Персонаж {i}", "роль (30 лет)", "характер " * 20, "знакомый")
+        for i in range(args.characters)
+    ]
+    context = [
+        ("player" if i % 2 else "character", "сообщение в переписке " * 5)
+        for i in range(args.context)
+    ]
+
+    uncached = PromptBuilder(maxsize=0)
+
+    def full_render():
+        approx_tokens.cache_clear()
+        return uncached.build_messages(1, story, characters, context, "привет")
+
+    builder = PromptBuilder()
+
+    def cached():
+        return builder.build_messages(1, story, characters, context, "привет")
+
+    full_size = len(render_system_prompt(story, characters))
+    system, tokens = builder.system_prompt(1, story, characters)
+    print(f"System-блок:        {full_size} символов, в промпте {len(system)} ({tokens} токенов)")
+
+    for name, func in (("Полный рендер", full_render), ("С кэшем", cached)):
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            func()
+        elapsed = time.perf_counter() - started
+        print(f"{name + ':':<20}{elapsed / args.iterations * 1e6:.1f} мкс/ход")
+
+
+# ================================
+# budget: промпт не выходит за бюджет токенов
+# ================================
+def bench_budget(args):
+    """
+    Собирает промпт для патологических диалогов
+    и проверяет, что он укладывается в бюджет.
+    """
+
+    import random
+
+    from prompts import PromptBuilder, count_prompt_tokens
+
+    rnd = random.Random(1)
+    builder = PromptBuilder(budget=args.budget)
+
+    story = ("Тест", "Описание истории. " * 20, "Прошлое героя.", "Сцена.")
+    characters = [("Аня", "подруга (17 лет)", "тихая", "знакомый")]
+
+    # System-блок сам по себе больше бюджета: 15 персонажей с длинными анкетами
+    crowded = ("Тест", "Описание истории. " * 300, "Прошлое героя. " * 100, "Сцена. " * 100)
+    crowd = [
+        (f"Персонаж {i}", "роль (30 лет)", "характер " * 80, "знакомый")
+        for i in range(15)
+    ]
+
+    def words(n):
+        return " ".join(rnd.choice(("тьма", "дверь", "кто", "здесь?!", "hello", "…")) for _ in range(n))
+
+    cases = {
+        "40 коротких": [("player" if i % 2 else "character", "да") for i in range(40)],
+        "40 длинных": [("player" if i % 2 else "character", words(500)) for i in range(40)],
+        "одно огромное": [("character", words(50_000))],
+        "без пробелов": [("player", "а" * 100_000), ("character", "!" * 100_000)],
+        "вперемешку": [
+            ("player" if i % 2 else "character", words(rnd.choice((1, 10, 3000))))
+            for i in range(40)
+        ],
+        "огромная история": [("player" if i % 2 else "character", words(50)) for i in range(40)],
+    }
+
+    failed = 0
+    print(f"Бюджет: {args.budget} токенов")
+
+    for name, context in cases.items():
+        story_id, story_, characters_ = (2, crowded, crowd) if name == "огромная история" \
+            else (1, story, characters)
+
+        for user_message in ("привет", words(20_000)):
+            messages = builder.build_messages(story_id, story_, characters_, context, user_message,
+                                              summary=words(2000) if story_id == 2 else None)
+            tokens = count_prompt_tokens(messages)
+
+            # Сообщение игрока не должно пропадать из промпта
+            ok = tokens <= args.budget and bool(messages[-1]["content"])
+            failed += not ok
+
+            print(f"{name:<16} сообщений в промпте: {len(messages):>3}  "
+                  f"токенов: {tokens:>5}  {'OK' if ok else 'ПРЕВЫШЕН'}")
+
+    if failed:
+        raise SystemExit(f"Бюджет превышен в {failed} случаях")
+
+
+# ================================
+# stream: время до первого текста у игрока
+# ================================
+async def bench_stream(args):
+    """
+    Сравнивает, когда игрок видит первый текст:
+    обычный ответ целиком против потокового.
+    """
+
+    import groq_ai
+    from fake_groq import FakeGroq
+    from streaming import StreamingReply
+
+    _unlimited_ai()
+    _no_reply_cache()
+    reply = "\n".join(f"Персонаж {i}: слово слово слово слово" for i in range(4))
+    server = FakeGroq(latency=args.latency, reply=reply, token_delay=args.token_delay)
+    groq_ai.GROQ_URL = await server.start()
+
+    class FakeBot:
+        first = None
+
+        async def send_message(self, chat_id, text):
+            if self.first is None:
+                self.first = time.perf_counter()
+            return type("Message", (), {"message_id": 1})
+
+        async def edit_message_text(self, text, chat_id, message_id):
+            pass
+
+    story = ("Тест", "Описание", "Прошлое", "Сцена")
+
+    try:
+        # Обычный режим: текст появляется после всей генерации
+        server.latency = args.latency + args.token_delay * len(reply.split(" "))
+        started = time.perf_counter()
+        await groq_ai.generate_story_reply(1, story, [], [], "привет")
+        full = time.perf_counter() - started
+
+        # Потоковый режим
+        server.latency = args.latency
+        bot = FakeBot()
+        streamed = StreamingReply(bot, 1)
+        started = time.perf_counter()
+        async for delta in groq_ai.stream_story_reply(1, story, [], [], "привет"):
+            await streamed.feed(delta)
+        await streamed.finish()
+        total = time.perf_counter() - started
+        first = bot.first - started
+    finally:
+        await groq_ai.close_session()
+        await server.stop()
+
+    print(f"Без потока, первый текст:  {full * 1000:.0f} мс")
+    print(f"Поток, первый текст:       {first * 1000:.0f} мс")
+    print(f"Поток, весь ответ:         {total * 1000:.0f} мс")
+
+
+# ================================
+# webhook: пропускная способность приёма апдейтов
+# ================================
+async def bench_webhook(args):
+    """
+    Настоящий bot.py в режиме webhook против фейковых
+    Telegram и Groq: апдейты шлются POST-ами на /webhook,
+    ответы бота считаются на фейковом Bot API.
+    """
+
+    import os
+    import socket
+    import tempfile
+
+    import aiohttp
+
+    from fake_groq import FakeGroq
+    from fake_telegram import FakeTelegram, make_callback_update, make_message_update
+
+    # Ответы бота по чатам
+    replies = {}
+
+    def on_send(chat_id, text):
+        replies.setdefault(chat_id, asyncio.Queue()).put_nowait(text)
+
+    telegram = FakeTelegram(on_send=on_send)
+    groq = FakeGroq(latency=args.latency)
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+
+    os.environ.update({
+        "BOT_MODE": "webhook",
+        "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+        "WEBHOOK_SECRET": "bench-secret",
+        "TELEGRAM_API_URL": await telegram.start(),
+        "GROQ_URL": await groq.start(),
+        "PORT": str(port),
+    })
+
+    import db
+    db.DB_NAME = os.path.join(tempfile.mkdtemp(), "bench.db")
+
+    import bot
+
+    runner = await bot.start_webserver()
+    handlers = await bot.load_handlers()
+
+    # После загрузки обработчиков: groq_ai читает GROQ_URL при импорте
+    _unlimited_ai()
+    from groq_ai import close_session
+
+    story_id = await db.add_story("Тест", "Описание", "Прошлое", "Сцена")
+
+    url = f"http://127.0.0.1:{port}{bot.WEBHOOK_PATH}"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}
+    update_ids = iter(range(1, 10**9))
+    intake = []
+
+    try:
+        async with aiohttp.ClientSession(headers=headers) as session:
+            async def post(update):
+                started = time.perf_counter()
+                async with session.post(url, json=update) as response:
+                    assert response.status == 200, response.status
+                intake.append(time.perf_counter() - started)
+
+            async def reply(user_id):
+                return await replies.setdefault(user_id, asyncio.Queue()).get()
+
+            # Каждый игрок начинает историю и делает несколько ходов,
+            # дожидаясь ответа на каждый
+            async def player(user_id):
+                await post(make_callback_update(next(update_ids), user_id, f"start_{story_id}"))
+                await reply(user_id)
+
+                for _ in range(args.turns):
+                    await post(make_message_update(next(update_ids), user_id, "привет"))
+                    await reply(user_id)
+
+            # Чужой секрет должен отклоняться
+            async with session.post(url, json={}, headers={
+                "X-Telegram-Bot-Api-Secret-Token": "wrong"
+            }) as response:
+                print(f"Неверный секрет:    HTTP {response.status}")
+
+            started = time.perf_counter()
+            await asyncio.gather(*(player(u) for u in range(1, args.users + 1)))
+            elapsed = time.perf_counter() - started
+
+            async with session.get(f"http://127.0.0.1:{port}/metrics") as response:
+                exposition = await response.text()
+    finally:
+        await runner.cleanup()
+        await handlers.outbox.close()
+        await close_session()
+        await db.close_db()
+        await groq.stop()
+        await telegram.stop()
+
+    turns = args.users * args.turns
+    intake.sort()
+
+    print(f"Апдейтов:           {len(intake)}")
+    print(f"Приём апдейта p50:  {intake[len(intake) // 2] * 1000:.1f} мс")
+    print(f"Ходов в секунду:    {turns / elapsed:.0f}")
+    print(f"Вызовы Bot API:     {dict(telegram.calls)}")
+
+    # Среднее время этапов хода — из тех же метрик, что отдаёт /metrics
+    import metrics
+
+    print(f"/metrics:           {len(exposition.splitlines())} строк")
+    for (name,), (_, total, count) in metrics.stage_seconds.values.items():
+        print(f"  {name:14} {total / count * 1000:7.2f} мс в среднем ({count})")
+
+
+# ================================
+# ratelimit: работа в пределах лимитов аккаунта
+# ================================
+async def bench_ratelimit(args):
+    """
+    Фейковый Groq пускает не больше limit запросов за window секунд
+    и отвечает 429 сверх того. Локальные лимиты сняты, планировщик
+    подстраивается только по заголовкам. Ходы игроков (interactive)
+    и конспекты (background) идут вперемешку.
+    """
+
+    import groq_ai
+    from fake_groq import FakeGroq
+    from ratelimit import ai_scheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+
+    _unlimited_ai()
+    server = FakeGroq(latency=args.latency, rate_limit=args.limit, rate_window=args.window)
+    groq_ai.GROQ_URL = await server.start()
+
+    payload = {"model": groq_ai.MODEL, "messages": [{"role": "user", "content": "привет"}],
+               "max_tokens": 10}
+    latency = {PRIORITY_INTERACTIVE: [], PRIORITY_BACKGROUND: []}
+    failed = 0
+
+    async def one(priority):
+        nonlocal failed
+        started = time.perf_counter()
+        result = await groq_ai.request_completion(payload, priority)
+        latency[priority].append(time.perf_counter() - started)
+        failed += result is None
+
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(
+            one(PRIORITY_BACKGROUND if i % 4 == 0 else PRIORITY_INTERACTIVE)
+            for i in range(args.requests)
+        ))
+        elapsed = time.perf_counter() - started
+    finally:
+        await groq_ai.close_session()
+        await server.stop()
+
+    print(f"Лимит сервера:      {args.limit} за {args.window} с "
+          f"({args.limit / args.window:.1f} в секунду)")
+    print(f"Запросов:           {args.requests}, из них неудачных: {failed}")
+    print(f"Ответов 429:        {server.rejected}")
+    print(f"Пропускная способность: {args.requests / elapsed:.1f} в секунду")
+    for priority, name in ((PRIORITY_INTERACTIVE, "ходы игроков"), (PRIORITY_BACKGROUND, "конспекты")):
+        values = latency[priority]
+        if values:
+            print(f"Среднее ожидание, {name}: {sum(values) / len(values):.2f} с")
+    print(f"Планировщик:        {ai_scheduler.stats()}")
+
+
+# ================================
+# replycache: одинаковые первые ходы
+# ================================
+async def bench_replycache(args):
+    """
+    Игроки начинают одну историю и пишут первые ходы
+    из небольшого набора фраз. Сравнивает ход из кэша
+    и ход с запросом в фейковый Groq.
+    """
+
+    import os
+    import random
+    import tempfile
+
+    import db
+    import groq_ai
+    from fake_groq import FakeGroq
+    from reply_cache import reply_cache
+
+    _unlimited_ai()
+    db.DB_NAME = os.path.join(tempfile.mkdtemp(), "bench.db")
+    await db.init_db()
+
+    server = FakeGroq(latency=args.latency)
+    groq_ai.GROQ_URL = await server.start()
+
+    story_id = await db.add_story("Тест", "Описание", "Прошлое", "Сцена")
+    story = await db.get_story(story_id)
+    await reply_cache.set_enabled(story_id, True)
+
+    openers = ["привет", "Привет!", "кто здесь?", "Кто здесь", "где я?", "ау"]
+    rng = random.Random(1)
+
+    async def player(timings):
+        context = []
+        for _ in range(args.turns):
+            text = rng.choice(openers)
+
+            started = time.perf_counter()
+            reply = await groq_ai.generate_story_reply(story_id, story, [], context, text)
+            timings.append(time.perf_counter() - started)
+
+            context += [("player", text), ("character", reply)]
+
+    rounds = []
+    try:
+        # Первая волна наполняет кэш, вторая читает готовое
+        for name in ("холодный кэш", "тёплый кэш"):
+            timings = []
+            requests = server.requests
+            await asyncio.gather(*(player(timings) for _ in range(args.players)))
+            rounds.append((name, sorted(timings), server.requests - requests))
+
+        entries, size = await db.reply_cache_info()
+    finally:
+        await groq_ai.close_session()
+        await server.stop()
+        await db.close_db()
+
+    s = reply_cache.stats()
+    print(f"Ходов:              {2 * args.players * args.turns}")
+    for name, timings, requests in rounds:
+        print(f"{name}: запросов в Groq {requests}, "
+              f"медиана хода {timings[len(timings) // 2] * 1000:.1f} мс, "
+              f"p95 {timings[int(len(timings) * 0.95)] * 1000:.1f} мс")
+    print(f"Попаданий:          {s['hits']} ({s['hit_ratio']:.0%}), сэкономлено {s['bytes_saved']} байт")
+    print(f"В кэше:             {entries} ответов, {size} байт")
+
+
+# ================================
+# retention: архив старых диалогов
+# ================================
+async def bench_retention(args):
+    """
+    Старые сессии уходят в архив: размер файла базы
+    до и после, время чтения диалога из архива.
+    """
+
+    import os
+    import tempfile
+
+    import db
+    from retention import Retention
+
+    db.DB_NAME = os.path.join(tempfile.mkdtemp(), "bench.db")
+    await db.init_db()
+
+    def file_size():
+        return sum(os.path.getsize(db.DB_NAME + suffix)
+                   for suffix in ("", "-wal") if os.path.exists(db.DB_NAME + suffix))
+
+    # Половина сессий — месячной давности
+    old = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - 30 * 86400))
+    rows = [
+        (user_id, 1, "player" if i % 2 else "character",
+         f"сообщение {i} игрока {user_id}: " + "скрип половиц в темноте " * 8,
+         old if user_id % 2 else time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime()))
+        for user_id in range(args.sessions)
+        for i in range(args.messages)
+    ]
+    await db.get_db().write(db._save_messages, rows)
+    await db.checkpoint()
+
+    async def read_dialogs(users):
+        started = time.perf_counter()
+        for user_id in users:
+            await db.get_full_dialog(user_id, 1)
+        return (time.perf_counter() - started) / len(users) * 1000
+
+    archived_users = range(1, args.sessions, 2)
+    before_size = file_size()
+    before_read = await read_dialogs(archived_users)
+
+    started = time.perf_counter()
+    result = await Retention().run_once()
+    elapsed = time.perf_counter() - started
+
+    after_size = file_size()
+    after_read = await read_dialogs(archived_users)
+    dialog = await db.get_full_dialog(1, 1)
+    await db.close_db()
+
+    print(f"Сессий/сообщений:   {args.sessions} / {len(rows)}")
+    print(f"В архив:            {result['sessions']} сессий, {result['messages']} сообщений "
+          f"за {elapsed:.2f} с")
+    print(f"Файл базы:          {before_size / 1e6:.1f} -> {after_size / 1e6:.1f} МБ")
+    print(f"Чтение диалога:     {before_read:.2f} -> {after_read:.2f} мс")
+    print(f"Диалог из архива:   {len(dialog)} сообщений (ожидалось {args.messages})")
+
+
+# ================================
+# router: хвост задержек, резерв и circuit breaker
+# ================================
+def _percentiles(values):
+    values = sorted(values)
+    return " ".join(
+        f"p{p} {values[min(int(len(values) * p / 100), len(values) - 1)] * 1000:.0f} мс"
+        for p in (50, 95, 99)
+    )
+
+
+async def bench_router(args):
+    """
+    Два фейковых бэкенда: основной иногда «подвисает» (slow_rate)
+    и ошибается (error_rate), резервный стабилен. Сравнивает
+    хвост задержек без hedged-запросов и с ними, затем
+    выключает основной и смотрит на circuit breaker.
+    """
+
+    import groq_ai
+    from fake_groq import FakeGroq
+    from router import ModelRouter
+
+    _unlimited_ai()
+    primary = FakeGroq(latency=args.latency, slow_rate=args.slow_rate,
+                       slow_latency=args.slow_latency, error_rate=args.error_rate, seed=1)
+    secondary = FakeGroq(latency=args.latency * 1.5, seed=2)
+    urls = [await primary.start(), await secondary.start()]
+
+    router = groq_ai.router = ModelRouter(
+        [("primary", urls[0]), ("secondary", urls[1])],
+        retries=groq_ai.GROQ_RETRIES, backoff=groq_ai.backoff_delay
+    )
+    payload = {"model": groq_ai.MODEL, "messages": [{"role": "user", "content": "привет"}],
+               "max_tokens": 10}
+
+    async def run(hedge):
+        timings, failed = [], 0
+        queue = list(range(args.requests))
+
+        async def worker():
+            nonlocal failed
+            while queue:
+                queue.pop()
+                started = time.perf_counter()
+                result = await groq_ai.complete(payload, hedge=hedge)
+                timings.append(time.perf_counter() - started)
+                failed += result is None
+
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        return timings, failed
+
+    try:
+        for hedge, name in ((False, "без hedging"), (True, "с hedging")):
+            before = primary.requests + secondary.requests
+            timings, failed = await run(hedge)
+            sent = primary.requests + secondary.requests - before
+            print(f"{name:12} {_percentiles(timings)}, ошибок {failed}, "
+                  f"запросов к бэкендам {sent} на {args.requests}")
+
+        # Основной бэкенд лежит: после AI_BREAKER_FAILURES ошибок
+        # запросы идут сразу в резервный
+        primary.error_rate = 1.0
+        before = primary.requests
+        timings, failed = await run(True)
+        print(f"{'основной лёг':12} {_percentiles(timings)}, ошибок {failed}, "
+              f"запросов к основному {primary.requests - before}")
+    finally:
+        await groq_ai.close_session()
+        await primary.stop()
+        await secondary.stop()
+
+    for name, s in router.stats()["backends"].items():
+        print(f"{name.split('@')[0]:9} {s}")
+    print(f"hedged: {router.hedged}, дедлайн: {router.timeouts}")
+
+
+# ================================
+# startup: холодный старт и время импорта
+# ================================
+def importtime_report(lines, top=15):
+    """
+    Разбор вывода python -X importtime: модули верхнего
+    уровня по суммарному времени импорта (мс) и общее время.
+    """
+
+    modules = []
+
+    for line in lines:
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+
+        _, cumulative, name = line[len("import time:"):].split("|")
+
+        # Вложенные импорты сдвинуты на два пробела за уровень
+        if name.startswith("  "):
+            continue
+
+        modules.append((int(cumulative) / 1000, name.strip()))
+
+    modules.sort(reverse=True)
+    return modules[:top], sum(ms for ms, _ in modules)
+
+
+async def bench_startup(args):
+    """
+    Настоящий процесс python -X importtime bot.py в режиме webhook:
+    через сколько открывается порт (/ отвечает), через сколько
+    обработан первый апдейт (/start -> ответ на фейковом Bot API)
+    и какие модули импортируются дольше всего.
+    """
+
+    import os
+    import socket
+    import statistics
+    import sys
+    import tempfile
+
+    import aiohttp
+
+    from fake_groq import FakeGroq
+    from fake_telegram import FakeTelegram, make_message_update
+
+    replies = asyncio.Queue()
+    telegram = FakeTelegram(on_send=lambda chat_id, text: replies.put_nowait(time.perf_counter()))
+    groq = FakeGroq()
+
+    env = dict(os.environ, **{
+        "BOT_MODE": "webhook",
+        "WEBHOOK_SECRET": "bench-secret",
+        "TELEGRAM_API_URL": await telegram.start(),
+        "GROQ_URL": await groq.start(),
+        "LOG_LEVEL": "WARNING",
+    })
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+    headers = {"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}
+
+    port_times, update_times, last_stderr = [], [], b""
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        for run in range(args.runs):
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+
+            env.update({
+                "PORT": str(port),
+                "WEBHOOK_URL": f"http://127.0.0.1:{port}",
+                "DB_NAME": os.path.join(tempfile.mkdtemp(), "bench.db"),
+            })
+
+            started = time.perf_counter()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, "-X", "importtime", script,
+                env=env, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+            )
+            stderr = asyncio.ensure_future(process.stderr.read())
+
+            try:
+                # Порт: опрашиваем /, как балансировщик Render
+                while True:
+                    try:
+                        async with session.get(f"http://127.0.0.1:{port}/") as response:
+                            if response.status == 200:
+                                break
+                    except aiohttp.ClientConnectionError:
+                        await asyncio.sleep(0.005)
+                port_times.append(time.perf_counter() - started)
+
+                # Первый апдейт — сразу, как разбудивший сервис запрос
+                update = make_message_update(run + 1, 1, "/start")
+                async with session.post(f"http://127.0.0.1:{port}/webhook", json=update) as response:
+                    assert response.status == 200, response.status
+                update_times.append(await asyncio.wait_for(replies.get(), 60) - started)
+            finally:
+                process.terminate()
+                await process.wait()
+                last_stderr = await stderr
+
+            print(f"Запуск {run + 1}: порт {port_times[-1] * 1000:.0f} мс, "
+                  f"первый апдейт {update_times[-1] * 1000:.0f} мс")
+
+    await groq.stop()
+    await telegram.stop()
+
+    modules, total = importtime_report(last_stderr.decode(errors="replace").splitlines(), args.top)
+
+    print(f"Порт открыт, медиана:      {statistics.median(port_times) * 1000:.0f} мс")
+    print(f"Первый апдейт, медиана:    {statistics.median(update_times) * 1000:.0f} мс")
+    print(f"Импорт (-X importtime):    {total:.0f} мс, дольше всего:")
+    for ms, name in modules:
+        print(f"  {name:36} {ms:8.1f} мс")
+
+
+# ================================
+# Запуск
+# ================================
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки Horror-Studio Bot")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("groq", help="параллельные запросы к фейковому Groq")
+    p.add_argument("--players", type=int, default=50)
+    p.add_argument("--latency", type=float, default=0.5)
+    p.set_defaults(func=bench_groq)
+
+    p = sub.add_parser("db", help="запись и чтение сообщений")
+    p.add_argument("--players", type=int, default=100)
+    p.add_argument("--turns", type=int, default=50)
+    p.set_defaults(func=bench_db)
+
+    p = sub.add_parser("messages", help="чтение контекста на большой таблице")
+    p.add_argument("--rows", type=int, default=2_000_000)
+    p.add_argument("--steps", type=int, default=4)
+    p.add_argument("--users", type=int, default=2000)
+    p.add_argument("--stories", type=int, default=10)
+    p.add_argument("--queries", type=int, default=2000)
+    p.add_argument("--probes", type=int, default=200, help="замеряемых сессий каждого вида")
+    p.add_argument("--max-growth", type=float, default=1.5,
+                   help="допустимый рост времени чтения от первого шага к последнему")
+    p.add_argument("--no-index", action="store_true", help="без индекса, для сравнения")
+    p.set_defaults(func=bench_messages)
+
+    p = sub.add_parser("prompt", help="сборка промпта")
+    p.add_argument("--characters", type=int, default=15)
+    p.add_argument("--context", type=int, default=20)
+    p.add_argument("--iterations", type=int, default=20000)
+    p.set_defaults(func=bench_prompt)
+
+    p = sub.add_parser("budget", help="промпт в пределах бюджета токенов")
+    p.add_argument("--budget", type=int, default=3000)
+    p.set_defaults(func=bench_budget)
+
+    p = sub.add_parser("stream", help="время до первого текста в потоковом режиме")
+    p.add_argument("--latency", type=float, default=0.3, help="задержка первого токена")
+    p.add_argument("--token-delay", type=float, default=0.03)
+    p.set_defaults(func=bench_stream)
+
+    p = sub.add_parser("webhook", help="приём апдейтов в режиме webhook")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--turns", type=int, default=5)
+    p.add_argument("--latency", type=float, default=0.2, help="задержка фейкового Groq")
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser("ratelimit", help="429 и приоритеты против фейкового лимита")
+    p.add_argument("--limit", type=int, default=20)
+    p.add_argument("--window", type=float, default=2.0)
+    p.add_argument("--requests", type=int, default=100)
+    p.add_argument("--latency", type=float, default=0.05)
+    p.set_defaults(func=bench_ratelimit)
+
+    p = sub.add_parser("replycache", help="кэш ответов для одинаковых первых ходов")
+    p.add_argument("--players", type=int, default=200)
+    p.add_argument("--turns", type=int, default=3)
+    p.add_argument("--latency", type=float, default=0.3)
+    p.set_defaults(func=bench_replycache)
+
+    p = sub.add_parser("router", help="резервная модель, hedged-запросы, circuit breaker")
+    p.add_argument("--requests", type=int, default=400)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.add_argument("--latency", type=float, default=0.1)
+    p.add_argument("--slow-rate", type=float, default=0.03)
+    p.add_argument("--slow-latency", type=float, default=2.0)
+    p.add_argument("--error-rate", type=float, default=0.02)
+    p.set_defaults(func=bench_router)
+
+    p = sub.add_parser("retention", help="архив старых диалогов и размер базы")
+    p.add_argument("--sessions", type=int, default=2000)
+    p.add_argument("--messages", type=int, default=100)
+    p.set_defaults(func=bench_retention)
+
+    p = sub.add_parser("startup", help="холодный старт: порт, первый апдейт, время импорта")
+    p.add_argument("--runs", type=int, default=3)
+    p.add_argument("--top", type=int, default=15, help="сколько модулей показать")
+    p.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    result = args.func(args)
+    if asyncio.iscoroutine(result):
+        asyncio.run(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+# ================================
+# cache.py
+# Кэши в памяти процесса
+# ================================
+
+import time
+from collections import OrderedDict, deque
+
+
+_MISSING = object()
+
+
+def _chars(messages):
+    return sum(len(text or "") for _, text in messages)
+
+
+# ================================
+# LRU-кэш с TTL
+# ================================
+class LRUCache:
+    """
+    Кэш с ограничением по размеру (LRU) и времени жизни (TTL).
+    Считает попадания и промахи.
+    """
+
+    def __init__(self, maxsize=256, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+        # key -> [сколько загрузок идёт, сколько записей было за это время]
+        self._loading = {}
+
+        # Растёт только на clear(): сбрасывает все идущие загрузки
+        self._generation = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key, _MISSING)
+
+        if item is not _MISSING:
+            value, expires = item
+            if expires is None or expires > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+
+            del self._data[key]
+
+        self.misses += 1
+        return default
+
+    def set(self, key, value):
+        """
+        Записывает значение. Загрузки этого ключа, начатые
+        раньше, свой (более старый) результат уже не сохранят.
+        """
+
+        self._touch(key)
+        expires = None if self.ttl is None else time.monotonic() + self.ttl
+
+        self._data[key] = (value, expires)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    async def get_or_load(self, key, loader):
+        """
+        Read-through: при промахе вызывает await loader()
+        и кладёт результат в кэш. None не кэшируется.
+        """
+
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        state = self._loading.setdefault(key, [0, 0])
+        state[0] += 1
+        writes_before = state[1]
+        generation = self._generation
+
+        try:
+            value = await loader()
+        finally:
+            state[0] -= 1
+            if not state[0]:
+                del self._loading[key]
+
+        # Пока шла загрузка, этот ключ могли перезаписать или
+        # инвалидировать — тогда значение устарело и не сохраняется.
+        # Записи других ключей загрузке не мешают
+        if value is not None and state[1] == writes_before and generation == self._generation:
+            self.set(key, value)
+
+        return value
+
+    def invalidate(self, key):
+        self._touch(key)
+        self._data.pop(key, None)
+
+    def _touch(self, key):
+        state = self._loading.get(key)
+        if state is not None:
+            state[1] += 1
+
+    def clear(self):
+        self._generation += 1
+        self._data.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+# ================================
+# Последние сообщения диалогов
+# ================================
+class DialogBuffer:
+    """
+    Кольцевой буфер последних сообщений для каждой пары
+    (user_id, story_id). Заполняется из БД при первом обращении,
+    дальше обновляется на месте при каждом save_message.
+
+    Общий объём ограничен max_chars: при превышении
+    вытесняются сессии, к которым дольше всех не обращались.
+    """
+
+    def __init__(self, size=40, max_chars=20_000_000):
+        self.size = size
+        self.max_chars = max_chars
+        self.hits = 0
+        self.misses = 0
+        self.chars = 0
+        self._sessions = OrderedDict()
+        self._loading = {}
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def get_or_load(self, key, limit, loader):
+        """
+        Возвращает последние limit сообщений сессии.
+        При промахе читает await loader(size) из БД.
+        """
+
+        if limit > self.size:
+            return await loader(limit)
+
+        messages = self._sessions.get(key)
+        if messages is not None:
+            self._sessions.move_to_end(key)
+            self.hits += 1
+            return list(messages)[-limit:]
+
+        self.misses += 1
+
+        # [сколько загрузок идёт, сколько записей было за это время]
+        state = self._loading.setdefault(key, [0, 0])
+        state[0] += 1
+        writes_before = state[1]
+
+        try:
+            rows = await loader(self.size)
+        finally:
+            state[0] -= 1
+            if not state[0]:
+                del self._loading[key]
+
+        # Если во время чтения пришло новое сообщение,
+        # результат мог его не увидеть — в буфер не кладём
+        if state[1] == writes_before and key not in self._sessions:
+            self._store(key, rows)
+
+        return rows[-limit:]
+
+    def append(self, key, sender, text):
+        """
+        Добавляет сообщение в загруженную сессию.
+        Вызывать до записи в БД, чтобы порядок совпадал.
+        """
+
+        messages = self._sessions.get(key)
+
+        if messages is None:
+            state = self._loading.get(key)
+            if state is not None:
+                state[1] += 1
+            return
+
+        if len(messages) == messages.maxlen:
+            self.chars -= len(messages[0][1] or "")
+
+        messages.append((sender, text))
+        self.chars += len(text or "")
+        self._sessions.move_to_end(key)
+        self._evict()
+
+    def drop(self, key):
+        messages = self._sessions.pop(key, None)
+        if messages is not None:
+            self.chars -= _chars(messages)
+
+        state = self._loading.get(key)
+        if state is not None:
+            state[1] += 1
+
+    def _store(self, key, rows):
+        self._sessions[key] = deque(rows, maxlen=self.size)
+        self.chars += _chars(rows)
+        self._evict()
+
+    def _evict(self):
+        while self.chars > self.max_chars and len(self._sessions) > 1:
+            _, messages = self._sessions.popitem(last=False)
+            self.chars -= _chars(messages)
+
+    def stats(self):
+        return {
+            "size": len(self._sessions),
+            "hits": self.hits,
+            "misses": self.misses,
+            "chars": self.chars
+        }
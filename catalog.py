@@ -0,0 +1,114 @@
+# ================================
+# catalog.py
+# Каталог историй по страницам:
+# keyset-пагинация по id и кэш готовых клавиатур
+# ================================
+
+import os
+
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+
+import db
+from cache import LRUCache
+
+
+# ================================
+# Настройки
+# ================================
+CATALOG_PAGE_SIZE = int(os.getenv("CATALOG_PAGE_SIZE", 8))
+CATALOG_CACHE_SIZE = int(os.getenv("CATALOG_CACHE_SIZE", 256))
+
+# Истории, добавленные другим инстансом, появятся не позже
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", 600))
+
+# Режимы: play — только кнопки, list — ещё и описания
+PLAY = "play"
+LIST = "list"
+
+HEADERS = {
+    PLAY: "Выберите историю:",
+    LIST: "📚 Истории:"
+}
+
+
+class StoryCatalog:
+    """
+    Страница — истории после (или перед) id из callback_data:
+    catalog:<режим>:<a|b>:<id>. Запрос идёт по первичному ключу,
+    сколько бы историй ни было. Текст и клавиатура страницы
+    кэшируются и сбрасываются целиком, когда появляется история.
+    """
+
+    def __init__(self, page_size=CATALOG_PAGE_SIZE, cache_size=CATALOG_CACHE_SIZE,
+                 ttl=CATALOG_CACHE_TTL):
+        self.page_size = page_size
+        self.pages = LRUCache(cache_size, ttl)
+
+    async def page(self, mode=PLAY, direction="a", cursor=0):
+        """
+        (текст, клавиатура) или (текст, None), если историй нет.
+        """
+
+        return await self.pages.get_or_load(
+            (mode, direction, cursor), lambda: self._render(mode, direction, cursor)
+        )
+
+    async def page_from_callback(self, data):
+        """
+        Страница по callback_data кнопки «назад»/«вперёд».
+        """
+
+        _, mode, direction, cursor = data.split(":")
+        if mode not in HEADERS or direction not in ("a", "b") or not cursor.isdigit():
+            mode, direction, cursor = PLAY, "a", 0
+
+        return await self.page(mode, direction, int(cursor))
+
+    async def _render(self, mode, direction, cursor):
+        rows, has_prev, has_next = await db.get_stories_page(
+            cursor, self.page_size, before=direction == "b"
+        )
+
+        # Страница опустела (курсор устарел) — показываем первую
+        if not rows and cursor:
+            return await self._render(mode, "a", 0)
+
+        if not rows:
+            return "Историй пока нет.", None
+
+        kb = InlineKeyboardBuilder()
+        lines = [HEADERS[mode]]
+
+        for story_id, title, description in rows:
+            kb.button(text=title or f"История {story_id}", callback_data=f"start_{story_id}")
+
+            if mode == LIST:
+                lines.append("")
+                lines.append(f"▫️ {title}")
+                if description:
+                    lines.append(description + ("…" if len(description) == 120 else ""))
+
+        nav = 0
+        if has_prev:
+            kb.button(text="⬅️ Назад", callback_data=f"catalog:{mode}:b:{rows[0][0]}")
+            nav += 1
+        if has_next:
+            kb.button(text="Вперёд ➡️", callback_data=f"catalog:{mode}:a:{rows[-1][0]}")
+            nav += 1
+
+        # Истории по одной в ряд, «назад» и «вперёд» — рядом
+        kb.adjust(*([1] * len(rows)), max(nav, 1))
+        return "\n".join(lines), kb.as_markup()
+
+    def invalidate(self):
+        """
+        Вызывать после добавления историй.
+        """
+
+        self.pages.clear()
+
+    def stats(self):
+        return self.pages.stats()
+
+
+story_catalog = StoryCatalog()
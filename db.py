@@ -3,31 +3,288 @@
 # Horror-Studio Bot Database System
 # ================================
 
+import asyncio
+import json
+import logging
+import os
+import queue
 import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import Future
 
+from cache import LRUCache, DialogBuffer
+
+
+log = logging.getLogger(__name__)
 
 # ================================
 # Подключение к базе данных
 # ================================
-DB_NAME = "stories.db"
+DB_NAME = os.getenv("DB_NAME", "stories.db")
+
+# Сколько записей из очереди объединять в одну транзакцию
+WRITE_BATCH = 64
+
+PRAGMAS = (
+    # Действует только для новой базы; старую — python retention.py convert
+    "PRAGMA auto_vacuum = INCREMENTAL",
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 134217728",
+    "PRAGMA busy_timeout = 5000",
+)
+
+# Кэш историй и персонажей (они почти не меняются после создания)
+STORY_CACHE_SIZE = int(os.getenv("STORY_CACHE_SIZE", 256))
+STORY_CACHE_TTL = float(os.getenv("STORY_CACHE_TTL", 600))
+
+# Последние сообщения диалогов в памяти
+DIALOG_BUFFER_SIZE = int(os.getenv("DIALOG_BUFFER_SIZE", 40))
+DIALOG_CACHE_MAX_CHARS = int(os.getenv("DIALOG_CACHE_MAX_CHARS", 20_000_000))
+DIALOG_SUMMARY_CACHE_SIZE = int(os.getenv("DIALOG_SUMMARY_CACHE_SIZE", 10_000))
+
+# Сообщения пишутся в БД пачками: когда накопится MESSAGE_FLUSH_SIZE
+# или пройдёт MESSAGE_FLUSH_INTERVAL секунд с первого незаписанного.
+# MESSAGE_WRITE_BEHIND=0 — save_message ждёт записи своей пачки
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "1") == "1"
+MESSAGE_FLUSH_SIZE = int(os.getenv("MESSAGE_FLUSH_SIZE", 256))
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", 0.05))
+
+# Больше стольких незаписанных — save_message ждёт записи
+MESSAGE_MAX_PENDING = int(os.getenv("MESSAGE_MAX_PENDING", 10_000))
+
+_STOP = object()
+
+
+class Database:
+    """
+    Одно постоянное соединение SQLite в отдельном потоке.
+
+    Все запросы выполняются в этом потоке, event loop
+    только ждёт результат. Записи, накопившиеся в очереди,
+    выполняются пачкой в одной короткой транзакции.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._jobs = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    # ----------------------------
+    # Управление потоком
+    # ----------------------------
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="db-thread", daemon=True
+                )
+                self._thread.start()
+
+    def close(self):
+        """
+        Дожидается выполнения всех задач в очереди
+        и закрывает соединение.
+        """
+
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self._jobs.put(_STOP)
+            self._thread.join()
+            self._thread = None
+
+    # ----------------------------
+    # Постановка задач
+    # ----------------------------
+    def submit(self, func, *args, write=False):
+        """
+        Ставит func(conn, *args) в очередь потока БД.
+        Возвращает concurrent.futures.Future.
+        """
+
+        self.start()
+
+        future = Future()
+        self._jobs.put((func, args, write, future))
+        return future
+
+    async def read(self, func, *args):
+        return await asyncio.wrap_future(self.submit(func, *args))
+
+    async def write(self, func, *args):
+        return await asyncio.wrap_future(self.submit(func, *args, write=True))
+
+    # ----------------------------
+    # Поток БД
+    # ----------------------------
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path, isolation_level=None, check_same_thread=False
+        )
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        pending = None
+
+        try:
+            while True:
+                job = pending if pending is not None else self._jobs.get()
+                pending = None
+
+                if job is _STOP:
+                    break
+
+                func, args, write, future = job
+
+                if not write:
+                    self._run_read(conn, func, args, future)
+                    continue
+
+                # Собираем подряд идущие записи в одну транзакцию
+                batch = [job]
+                while len(batch) < WRITE_BATCH:
+                    try:
+                        nxt = self._jobs.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    if nxt is _STOP or not nxt[2]:
+                        pending = nxt
+                        break
+
+                    batch.append(nxt)
+
+                self._run_writes(conn, batch)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _run_read(conn, func, args, future):
+        if not future.set_running_or_notify_cancel():
+            return
+
+        try:
+            future.set_result(func(conn, *args))
+        except BaseException as e:
+            future.set_exception(e)
+
+    @staticmethod
+    def _run_writes(conn, batch):
+        batch = [job for job in batch if job[3].set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        results = []
+
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+
+            for func, args, write, future in batch:
+                # SAVEPOINT: ошибка одной записи не откатывает остальные
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((True, func(conn, *args)))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((False, e))
+
+            conn.execute("COMMIT")
+
+        except BaseException as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for job in batch:
+                job[3].set_exception(e)
+            return
+
+        for (ok, value), job in zip(results, batch):
+            if ok:
+                job[3].set_result(value)
+            else:
+                job[3].set_exception(value)
+
+
+_db = None
+
+
+def get_db():
+    """
+    Общий экземпляр Database (создаётся при первом обращении).
+    """
+
+    global _db
+
+    if _db is None:
+        _db = Database(DB_NAME)
+
+    return _db
+
+
+async def close_db():
+    """
+    Дожидается записи всех данных (в том числе
+    незаписанных сообщений) и закрывает соединение.
+    """
+
+    global _db
+
+    try:
+        await message_log.flush()
+    finally:
+        if _db is not None:
+            await asyncio.to_thread(_db.close)
+            _db = None
 
 
 # ================================
 # Инициализация базы данных
 # ================================
-def init_db():
+async def init_db():
     """
-    Создаёт все нужные таблицы,
-    если их ещё нет.
+    Создаёт все нужные таблицы и применяет
+    новые миграции схемы.
     """
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    await get_db().write(_init_db)
+
+
+def _init_db(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+    for number, statements in enumerate(MIGRATIONS, start=1):
+        if number <= version:
+            continue
+
+        for sql in statements:
+            conn.execute(sql)
+
+        conn.execute(f"PRAGMA user_version = {number}")
 
+
+# ================================
+# Миграции схемы
+# Номер миграции = позиция в списке,
+# применённые хранятся в PRAGMA user_version.
+# Новые миграции добавлять только в конец!
+# ================================
+MIGRATIONS = [
     # ----------------------------
-    # Таблица историй
+    # 1: таблицы историй, персонажей и сообщений
     # ----------------------------
-    cursor.execute("""
+    (
+        """
         CREATE TABLE IF NOT EXISTS stories (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT,
@@ -35,12 +292,8 @@ def init_db():
             hero_past TEXT,
             start_scene TEXT
         )
-    """)
-
-    # ----------------------------
-    # Таблица персонажей
-    # ----------------------------
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS characters (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             story_id INTEGER,
@@ -49,12 +302,8 @@ def init_db():
             personality TEXT,
             known TEXT
         )
-    """)
-
-    # ----------------------------
-    # Таблица сообщений (НОВОЕ)
-    # ----------------------------
-    cursor.execute("""
+        """,
+        """
         CREATE TABLE IF NOT EXISTS messages (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id INTEGER,
@@ -63,150 +312,1255 @@ def init_db():
             text TEXT,
             timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
         )
-    """)
+        """,
+    ),
 
-    conn.commit()
-    conn.close()
+    # ----------------------------
+    # 2: индексы для горячих запросов
+    # get_last_messages идёт по индексу от последнего id,
+    # get_characters — по story_id
+    # ----------------------------
+    (
+        """
+        CREATE INDEX IF NOT EXISTS idx_messages_user_story
+        ON messages (user_id, story_id, id)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_characters_story
+        ON characters (story_id)
+        """,
+    ),
+
+    # ----------------------------
+    # 3: краткое содержание старых сообщений
+    # upto_id — последнее сообщение, вошедшее в summary
+    # ----------------------------
+    (
+        """
+        CREATE TABLE IF NOT EXISTS summaries (
+            user_id INTEGER,
+            story_id INTEGER,
+            summary TEXT,
+            upto_id INTEGER,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, story_id)
+        )
+        """,
+    ),
+
+    # ----------------------------
+    # 4: состояние игроков и авторов (переживает перезапуск)
+    # ----------------------------
+    (
+        """
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS active_stories (
+            user_id INTEGER PRIMARY KEY,
+            story_id INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS draft_characters (
+            user_id INTEGER PRIMARY KEY,
+            characters TEXT
+        )
+        """,
+    ),
+
+    # ----------------------------
+    # 5: кэш ответов AI (включается для истории отдельно)
+    # size — байт в reply, used_at — для вытеснения LRU
+    # ----------------------------
+    (
+        """
+        ALTER TABLE stories ADD COLUMN cache_replies INTEGER DEFAULT 0
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS reply_cache (
+            key TEXT PRIMARY KEY,
+            story_id INTEGER,
+            reply TEXT,
+            size INTEGER,
+            hits INTEGER DEFAULT 0,
+            used_at REAL
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_reply_cache_used
+        ON reply_cache (used_at)
+        """,
+    ),
+
+    # ----------------------------
+    # 6: архив старых диалогов
+    # data — zlib(JSON [[id, sender, text, timestamp], ...]),
+    # сообщения с first_id по last_id одной сессии
+    # ----------------------------
+    (
+        """
+        CREATE TABLE IF NOT EXISTS message_archive (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            story_id INTEGER,
+            first_id INTEGER,
+            last_id INTEGER,
+            count INTEGER,
+            data BLOB,
+            archived_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_message_archive_session
+        ON message_archive (user_id, story_id, first_id)
+        """,
+    ),
+
+    # ----------------------------
+    # 7: очередь ходов для рабочих процессов (worker.py)
+    # lease_until > now — ход выполняется, иначе ждёт;
+    # выполненные удаляются
+    # ----------------------------
+    (
+        """
+        CREATE TABLE IF NOT EXISTS turn_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            story_id INTEGER,
+            chat_id INTEGER,
+            text TEXT,
+            lease_until REAL DEFAULT 0,
+            worker TEXT,
+            attempts INTEGER DEFAULT 0,
+            created_at REAL
+        )
+        """,
+    ),
+]
+
+
+# ================================
+# Кэш историй и персонажей
+# ================================
+story_cache = LRUCache(STORY_CACHE_SIZE, STORY_CACHE_TTL)
+characters_cache = LRUCache(STORY_CACHE_SIZE, STORY_CACHE_TTL)
+dialog_buffer = DialogBuffer(DIALOG_BUFFER_SIZE, DIALOG_CACHE_MAX_CHARS)
+summary_cache = LRUCache(DIALOG_SUMMARY_CACHE_SIZE)
+
+
+def cache_stats():
+    """
+    Попадания и промахи кэшей историй, персонажей и диалогов.
+    """
+
+    return {
+        "stories": story_cache.stats(),
+        "characters": characters_cache.stats(),
+        "dialogs": dialog_buffer.stats(),
+        "summaries": summary_cache.stats()
+    }
 
 
 # ================================
 # Истории
 # ================================
-def add_story(title, description, hero_past, start_scene):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+async def add_story(title, description, hero_past, start_scene):
+    story_id = await get_db().write(_add_story, title, description, hero_past, start_scene)
+    story_cache.invalidate(story_id)
+    return story_id
 
-    cursor.execute("""
+
+def _add_story(conn, title, description, hero_past, start_scene):
+    cursor = conn.execute("""
         INSERT INTO stories (title, description, hero_past, start_scene)
         VALUES (?, ?, ?, ?)
     """, (title, description, hero_past, start_scene))
 
-    conn.commit()
-    story_id = cursor.lastrowid
-    conn.close()
+    return cursor.lastrowid
+
+
+async def add_story_with_characters(title, description, hero_past, start_scene, characters):
+    """
+    История и все её персонажи одной транзакцией:
+    либо всё, либо ничего.
+    characters — [(name, role, personality, known)].
+    """
+
+    story_id = await get_db().write(
+        _add_story_with_characters, title, description, hero_past, start_scene, characters
+    )
+    story_cache.invalidate(story_id)
+    characters_cache.invalidate(story_id)
+    return story_id
+
+
+def _add_story_with_characters(conn, title, description, hero_past, start_scene, characters):
+    story_id = _add_story(conn, title, description, hero_past, start_scene)
+
+    conn.executemany("""
+        INSERT INTO characters (story_id, name, role, personality, known)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(story_id, *character) for character in characters])
 
     return story_id
 
 
-def get_stories():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+async def add_stories(stories):
+    """
+    Много историй с персонажами одной транзакцией (импорт).
+    stories — [(title, description, hero_past, start_scene,
+    cache_replies, [(name, role, personality, known)])].
+    Возвращает id новых историй.
+    """
 
-    cursor.execute("SELECT id, title FROM stories")
-    stories = cursor.fetchall()
+    return await get_db().write(_add_stories, stories)
 
-    conn.close()
-    return stories
 
+def _add_stories(conn, stories):
+    ids = []
 
-def get_story(story_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    for title, description, hero_past, start_scene, cache_replies, characters in stories:
+        cursor = conn.execute("""
+            INSERT INTO stories (title, description, hero_past, start_scene, cache_replies)
+            VALUES (?, ?, ?, ?, ?)
+        """, (title, description, hero_past, start_scene, int(cache_replies)))
 
-    cursor.execute("""
-        SELECT title, description, hero_past, start_scene
+        ids.append(cursor.lastrowid)
+        conn.executemany("""
+            INSERT INTO characters (story_id, name, role, personality, known)
+            VALUES (?, ?, ?, ?, ?)
+        """, [(cursor.lastrowid, *character) for character in characters])
+
+    return ids
+
+
+async def get_stories_batch(after_id, limit):
+    """
+    Истории целиком с персонажами, по id после after_id (экспорт):
+    [(id, title, description, hero_past, start_scene,
+    cache_replies, [(name, role, personality, known)])].
+    """
+
+    return await get_db().read(_get_stories_batch, after_id, limit)
+
+
+def _get_stories_batch(conn, after_id, limit):
+    stories = conn.execute("""
+        SELECT id, title, description, hero_past, start_scene, cache_replies
         FROM stories
-        WHERE id = ?
-    """, (story_id,))
+        WHERE id > ?
+        ORDER BY id
+        LIMIT ?
+    """, (after_id, limit)).fetchall()
+
+    if not stories:
+        return []
+
+    characters = {}
+    for story_id, *character in conn.execute("""
+        SELECT story_id, name, role, personality, known
+        FROM characters
+        WHERE story_id BETWEEN ? AND ?
+        ORDER BY id
+    """, (stories[0][0], stories[-1][0])):
+        characters.setdefault(story_id, []).append(tuple(character))
+
+    return [(*story, characters.get(story[0], [])) for story in stories]
+
+
+async def get_stories():
+    return await get_db().read(_get_stories)
 
-    story = cursor.fetchone()
-    conn.close()
 
-    return story
+def _get_stories(conn):
+    return conn.execute("SELECT id, title FROM stories").fetchall()
+
+
+async def get_stories_page(cursor, limit, before=False):
+    """
+    Страница каталога по id (keyset): limit историй после
+    cursor или, если before, перед ним.
+    Возвращает ([(id, title, начало описания)], есть ли
+    предыдущая страница, есть ли следующая).
+    """
+
+    return await get_db().read(_get_stories_page, cursor, limit, before)
+
+
+def _get_stories_page(conn, cursor, limit, before):
+    if before:
+        sql = "SELECT id, title, substr(description, 1, 120) FROM stories " \
+              "WHERE id < ? ORDER BY id DESC LIMIT ?"
+    else:
+        sql = "SELECT id, title, substr(description, 1, 120) FROM stories " \
+              "WHERE id > ? ORDER BY id LIMIT ?"
+
+    rows = conn.execute(sql, (cursor, limit + 1)).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+
+    if before:
+        rows.reverse()
+
+    if not rows:
+        return rows, False, False
+
+    def exists(sql, story_id):
+        return conn.execute(f"SELECT EXISTS (SELECT 1 FROM stories WHERE {sql})",
+                            (story_id,)).fetchone()[0] == 1
+
+    if before:
+        return rows, more, exists("id > ?", rows[-1][0])
+
+    return rows, exists("id < ?", rows[0][0]), more
+
+
+async def get_story(story_id):
+    return await story_cache.get_or_load(
+        story_id, lambda: get_db().read(_get_story, story_id)
+    )
+
+
+def _get_story(conn, story_id):
+    return conn.execute("""
+        SELECT title, description, hero_past, start_scene
+        FROM stories
+        WHERE id = ?
+    """, (story_id,)).fetchone()
 
 
 # ================================
 # Персонажи
 # ================================
-def add_character(story_id, name, role, personality, known):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+async def add_character(story_id, name, role, personality, known):
+    await get_db().write(_add_character, story_id, name, role, personality, known)
+    characters_cache.invalidate(story_id)
 
-    cursor.execute("""
+
+def _add_character(conn, story_id, name, role, personality, known):
+    conn.execute("""
         INSERT INTO characters (story_id, name, role, personality, known)
         VALUES (?, ?, ?, ?, ?)
     """, (story_id, name, role, personality, known))
 
-    conn.commit()
-    conn.close()
 
+async def get_characters(story_id):
+    return await characters_cache.get_or_load(
+        story_id, lambda: get_db().read(_get_characters, story_id)
+    )
 
-def get_characters(story_id):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
 
-    cursor.execute("""
+def _get_characters(conn, story_id):
+    return conn.execute("""
         SELECT name, role, personality, known
         FROM characters
         WHERE story_id = ?
-    """, (story_id,))
+    """, (story_id,)).fetchall()
+
+
+# ================================
+# Журнал сообщений (write-behind)
+# ================================
+class MessageLog:
+    """
+    Очередь ещё не записанных сообщений всех игроков.
+
+    Пачка пишется одним executemany в одной транзакции —
+    одна фиксация на сотни строк вместо одной на строку.
+    Пачки пишутся строго по очереди, так что порядок id
+    совпадает с порядком save_message. При ошибке пачка
+    возвращается в начало очереди и пишется снова.
+    """
+
+    def __init__(self, flush_size=MESSAGE_FLUSH_SIZE, flush_interval=MESSAGE_FLUSH_INTERVAL,
+                 max_pending=MESSAGE_MAX_PENDING):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        # (user_id, story_id, sender, text, timestamp)
+        self._rows = []
+        self._timer = None
+        self._task = None
+
+        # Номер последнего добавленного и последнего записанного
+        self.appended = 0
+        self.written = 0
 
-    chars = cursor.fetchall()
-    conn.close()
-    return chars
+        self.flushes = 0
+        self.failures = 0
+        self.max_batch = 0
+
+    def __len__(self):
+        return len(self._rows)
+
+    @property
+    def full(self):
+        return len(self._rows) >= self.max_pending
+
+    def append(self, user_id, story_id, sender, text):
+        """
+        Ставит сообщение в очередь, возвращает его номер
+        (для wait()).
+        """
+
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+        self._rows.append((user_id, story_id, sender, text, timestamp))
+        self.appended += 1
+
+        if len(self._rows) >= self.flush_size:
+            self._start()
+        elif self._timer is None and self._task is None:
+            loop = asyncio.get_running_loop()
+            self._timer = loop.call_later(self.flush_interval, self._start)
+
+        return self.appended
+
+    def unflushed(self, key):
+        """
+        Ещё не отданные в БД сообщения сессии: (sender, text, timestamp).
+        Брать прямо перед запросом на чтение, без await между
+        ними — пачки, отданные раньше, запрос уже увидит.
+        """
+
+        user_id, story_id = key
+        return [
+            (sender, text, timestamp)
+            for u, s, sender, text, timestamp in self._rows
+            if u == user_id and s == story_id
+        ]
+
+    async def wait(self, number):
+        """
+        Ждёт, пока будут записаны сообщения до number включительно.
+        Ошибка записи пробрасывается.
+        """
+
+        while self.written < number:
+            if self._task is None:
+                self._start()
+
+            error = await asyncio.shield(self._task)
+            if error is not None:
+                raise error
+
+    async def flush(self):
+        """
+        Записывает всё, что добавлено до вызова.
+        """
+
+        await self.wait(self.appended)
+
+    def _start(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        if self._task is None and self._rows:
+            self._task = asyncio.get_running_loop().create_task(self._write())
+
+    async def _write(self):
+        rows, self._rows = self._rows, []
+        error = None
+
+        try:
+            await get_db().write(_save_messages, rows)
+            self.written += len(rows)
+            self.flushes += 1
+            self.max_batch = max(self.max_batch, len(rows))
+        except Exception as e:
+            # Обратно в начало, перед более новыми
+            self._rows[:0] = rows
+            self.failures += 1
+            error = e
+            log.exception("Не удалось записать %d сообщений", len(rows))
+        finally:
+            self._task = None
+
+            if self._rows and self._timer is None:
+                if len(self._rows) >= self.flush_size and error is None:
+                    self._start()
+                else:
+                    loop = asyncio.get_running_loop()
+                    self._timer = loop.call_later(self.flush_interval, self._start)
+
+        return error
+
+    def stats(self):
+        return {
+            "pending": len(self._rows),
+            "written": self.written,
+            "flushes": self.flushes,
+            "avg_batch": round(self.written / self.flushes, 1) if self.flushes else 0.0,
+            "max_batch": self.max_batch,
+            "failures": self.failures
+        }
+
+
+message_log = MessageLog()
+
+
+def _save_messages(conn, rows):
+    conn.executemany("""
+        INSERT INTO messages (user_id, story_id, sender, text, timestamp)
+        VALUES (?, ?, ?, ?, ?)
+    """, rows)
 
 
 # ================================
 # Сообщения (НОВОЕ)
 # ================================
 
-def save_message(user_id, story_id, sender, text):
+async def save_message(user_id, story_id, sender, text):
     """
     Сохраняет сообщение в историю диалога.
     sender = "player" или "character"
+
+    В БД сообщение попадает с ближайшей пачкой журнала;
+    чтения ниже видят его и до этого.
     """
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    # Сначала буфер, потом журнал: порядок сообщений в памяти
+    # совпадает с порядком вызовов
+    dialog_buffer.append((user_id, story_id), sender, text)
 
-    cursor.execute("""
-        INSERT INTO messages (user_id, story_id, sender, text)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, story_id, sender, text))
+    number = message_log.append(user_id, story_id, sender, text)
 
-    conn.commit()
-    conn.close()
+    if not MESSAGE_WRITE_BEHIND or message_log.full:
+        await message_log.wait(number)
 
 
-def get_last_messages(user_id, story_id, limit=20):
+async def get_last_messages(user_id, story_id, limit=20):
     """
     Возвращает последние limit сообщений
     для отправки в Groq.
+    Обычно берутся из памяти, без запроса к БД.
     """
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    key = (user_id, story_id)
+
+    async def load(n):
+        unflushed = [(sender, text) for sender, text, _ in message_log.unflushed(key)]
+        rows = await get_db().read(_get_last_messages, user_id, story_id, n)
+        return (rows + unflushed)[-n:]
 
-    cursor.execute("""
+    return await dialog_buffer.get_or_load(key, limit, load)
+
+
+def _get_last_messages(conn, user_id, story_id, limit):
+    rows = conn.execute("""
         SELECT sender, text
         FROM messages
         WHERE user_id = ? AND story_id = ?
         ORDER BY id DESC
         LIMIT ?
-    """, (user_id, story_id, limit))
+    """, (user_id, story_id, limit)).fetchall()
 
-    rows = cursor.fetchall()
-    conn.close()
+    rows.reverse()
 
-    return list(reversed(rows))
+    # Игрок вернулся к заархивированной сессии. У короткой сессии
+    # без архива это один пустой поиск по индексу, без распаковки
+    if len(rows) < limit:
+        need = limit - len(rows)
+        archived = _archived_tail(conn, user_id, story_id, need)
+        rows = [(sender, text) for _, sender, text, _ in archived[-need:]] + rows
 
+    return rows
 
-def get_full_dialog(user_id, story_id):
+
+async def read_last_messages(user_id, story_id, limit):
+    """
+    Последние limit сообщений прямо из БД, мимо буфера
+    (в рабочем процессе: сессию мог изменить другой процесс).
+    """
+
+    return await get_db().read(_get_last_messages, user_id, story_id, limit)
+
+
+async def get_full_dialog(user_id, story_id):
     """
     Возвращает весь диалог полностью.
     """
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+    unflushed = message_log.unflushed((user_id, story_id))
+    rows = await get_db().read(_get_full_dialog, user_id, story_id)
+    return rows + unflushed
 
-    cursor.execute("""
+
+def _get_full_dialog(conn, user_id, story_id):
+    rows = conn.execute("""
         SELECT sender, text, timestamp
         FROM messages
         WHERE user_id = ? AND story_id = ?
         ORDER BY id ASC
+    """, (user_id, story_id)).fetchall()
+
+    archived = [(sender, text, timestamp) for _, sender, text, timestamp
+                in _archived(conn, user_id, story_id)]
+    return archived + rows
+
+
+# ================================
+# Архив диалогов
+# ================================
+def _archived(conn, user_id, story_id):
+    """
+    Заархивированные сообщения сессии от старых к новым:
+    [id, sender, text, timestamp].
+    """
+
+    rows = []
+    for (data,) in conn.execute("""
+        SELECT data
+        FROM message_archive
+        WHERE user_id = ? AND story_id = ?
+        ORDER BY first_id
+    """, (user_id, story_id)):
+        rows.extend(json.loads(zlib.decompress(data)))
+
+    return rows
+
+
+def _archived_tail(conn, user_id, story_id, count):
+    """
+    Последние (не меньше count, если есть) заархивированные
+    сообщения сессии: распаковываются только нужные блоки с конца.
+    """
+
+    blocks = []
+    for data, size in conn.execute("""
+        SELECT data, count
+        FROM message_archive
+        WHERE user_id = ? AND story_id = ?
+        ORDER BY first_id DESC
+    """, (user_id, story_id)):
+        blocks.append(data)
+        count -= size
+        if count <= 0:
+            break
+
+    rows = []
+    for data in reversed(blocks):
+        rows.extend(json.loads(zlib.decompress(data)))
+
+    return rows
+
+
+async def find_idle_sessions(idle_before, finished_before):
+    """
+    Находит сессии, где последнее сообщение старше idle_before
+    (или finished_before, если игрок уже играет другую историю),
+    и запоминает их во временной таблице idle_sessions.
+    Время — строки "YYYY-MM-DD HH:MM:SS" в UTC.
+    Возвращает, сколько сессий найдено.
+    """
+
+    # Пишется только временная база соединения — хватает чтения
+    return await get_db().read(_find_idle_sessions, idle_before, finished_before)
+
+
+def _find_idle_sessions(conn, idle_before, finished_before):
+    conn.execute("DROP TABLE IF EXISTS temp.idle_sessions")
+    conn.execute("""
+        CREATE TEMP TABLE idle_sessions AS
+        SELECT s.user_id, s.story_id, s.last_id
+        FROM (
+            SELECT user_id, story_id, MAX(id) AS last_id
+            FROM messages
+            GROUP BY user_id, story_id
+        ) AS s
+        JOIN messages AS m ON m.id = s.last_id
+        LEFT JOIN active_stories AS a
+            ON a.user_id = s.user_id AND a.story_id = s.story_id
+        WHERE m.timestamp < CASE WHEN a.user_id IS NULL THEN ? ELSE ? END
+    """, (finished_before, idle_before))
+
+    return conn.execute("SELECT COUNT(*) FROM temp.idle_sessions").fetchone()[0]
+
+
+async def get_idle_sessions(after, limit):
+    """
+    Следующие limit сессий из find_idle_sessions:
+    [(номер, user_id, story_id, last_id)], номер > after.
+    """
+
+    return await get_db().read(_get_idle_sessions, after, limit)
+
+
+def _get_idle_sessions(conn, after, limit):
+    return conn.execute("""
+        SELECT rowid, user_id, story_id, last_id
+        FROM temp.idle_sessions
+        WHERE rowid > ?
+        ORDER BY rowid
+        LIMIT ?
+    """, (after, limit)).fetchall()
+
+
+async def forget_idle_sessions():
+    await get_db().read(_forget_idle_sessions)
+
+
+def _forget_idle_sessions(conn):
+    conn.execute("DROP TABLE IF EXISTS temp.idle_sessions")
+
+
+async def archive_session(user_id, story_id, last_id):
+    """
+    Переносит сообщения сессии с id <= last_id в архив
+    одной транзакцией. Возвращает (сообщений, байт до сжатия,
+    байт после).
+    """
+
+    return await get_db().write(_archive_session, user_id, story_id, last_id)
+
+
+def _archive_session(conn, user_id, story_id, last_id):
+    rows = conn.execute("""
+        SELECT id, sender, text, timestamp
+        FROM messages
+        WHERE user_id = ? AND story_id = ? AND id <= ?
+        ORDER BY id
+    """, (user_id, story_id, last_id)).fetchall()
+
+    if not rows:
+        return 0, 0, 0
+
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode()
+    data = zlib.compress(raw, 9)
+
+    conn.execute("""
+        INSERT INTO message_archive (user_id, story_id, first_id, last_id, count, data)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, (user_id, story_id, rows[0][0], rows[-1][0], len(rows), data))
+
+    conn.execute("""
+        DELETE FROM messages
+        WHERE user_id = ? AND story_id = ? AND id <= ?
+    """, (user_id, story_id, last_id))
+
+    return len(rows), len(raw), len(data)
+
+
+async def incremental_vacuum_enabled():
+    """
+    True, если база в режиме auto_vacuum = INCREMENTAL
+    (иначе incremental_vacuum ничего не возвращает ОС).
+    """
+
+    return await get_db().read(_incremental_vacuum_enabled)
+
+
+def _incremental_vacuum_enabled(conn):
+    return conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2
+
+
+async def enable_incremental_vacuum():
+    """
+    Переводит старую базу на auto_vacuum = INCREMENTAL.
+    Это полный VACUUM: файл переписывается целиком, поэтому
+    только вручную и при остановленном боте
+    (python retention.py convert). True, если перевод был.
+    """
+
+    return await get_db().read(_enable_incremental_vacuum)
+
+
+def _enable_incremental_vacuum(conn):
+    if _incremental_vacuum_enabled(conn):
+        return False
+
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return True
+
+
+async def incremental_vacuum(pages):
+    """
+    Возвращает ОС до pages свободных страниц.
+    Возвращает, сколько свободных страниц осталось.
+    """
+
+    return await get_db().read(_incremental_vacuum, pages)
+
+
+def _incremental_vacuum(conn, pages):
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    return conn.execute("PRAGMA freelist_count").fetchone()[0]
+
+
+async def checkpoint():
+    """
+    Переносит WAL в базу и обрезает файл WAL.
+    """
+
+    await get_db().read(_checkpoint)
+
+
+def _checkpoint(conn):
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+
+async def database_size():
+    """
+    (страниц всего, свободных страниц, размер страницы).
+    """
+
+    return await get_db().read(_database_size)
+
+
+def _database_size(conn):
+    return tuple(
+        conn.execute(f"PRAGMA {name}").fetchone()[0]
+        for name in ("page_count", "freelist_count", "page_size")
+    )
+
+
+# ================================
+# Краткое содержание диалога
+# ================================
+async def get_summary(user_id, story_id):
+    """
+    Возвращает (summary, upto_id) или ("", 0),
+    если старые сообщения ещё не сжимались.
+    """
+
+    return await summary_cache.get_or_load(
+        (user_id, story_id), lambda: get_db().read(_get_summary, user_id, story_id)
+    )
+
+
+def _get_summary(conn, user_id, story_id):
+    row = conn.execute("""
+        SELECT summary, upto_id
+        FROM summaries
+        WHERE user_id = ? AND story_id = ?
+    """, (user_id, story_id)).fetchone()
+
+    return row or ("", 0)
+
+
+async def save_summary(user_id, story_id, summary, upto_id):
+    key = (user_id, story_id)
+
+    summary_cache.invalidate(key)
+    await get_db().write(_save_summary, user_id, story_id, summary, upto_id)
+    summary_cache.set(key, (summary, upto_id))
+
+
+def _save_summary(conn, user_id, story_id, summary, upto_id):
+    conn.execute("""
+        INSERT INTO summaries (user_id, story_id, summary, upto_id)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (user_id, story_id) DO UPDATE SET
+            summary = excluded.summary,
+            upto_id = excluded.upto_id,
+            updated_at = CURRENT_TIMESTAMP
+    """, (user_id, story_id, summary, upto_id))
+
+
+async def get_aged_out_messages(user_id, story_id, after_id, keep):
+    """
+    Сообщения с id > after_id, кроме keep самых свежих
+    (они и так попадают в промпт). От старых к новым.
+    """
+
+    # Здесь нужны id — сначала дописываем журнал
+    await message_log.flush()
+    return await get_db().read(_get_aged_out_messages, user_id, story_id, after_id, keep)
+
+
+def _get_aged_out_messages(conn, user_id, story_id, after_id, keep):
+    rows = conn.execute("""
+        SELECT id, sender, text
+        FROM messages
+        WHERE user_id = ? AND story_id = ? AND id > ?
+        ORDER BY id DESC
+        LIMIT -1 OFFSET ?
+    """, (user_id, story_id, after_id, keep)).fetchall()
+
+    return list(reversed(rows))
+
+
+# ================================
+# Состояние FSM (aiogram)
+# ================================
+async def get_fsm(key):
+    """
+    Возвращает (state, data_json) или None.
+    """
+
+    return await get_db().read(_get_fsm, key)
+
+
+def _get_fsm(conn, key):
+    return conn.execute(
+        "SELECT state, data FROM fsm_states WHERE key = ?", (key,)
+    ).fetchone()
+
+
+async def set_fsm(key, state, data_json):
+    await get_db().write(_set_fsm, key, state, data_json)
+
+
+def _set_fsm(conn, key, state, data_json):
+    # Пустое состояние не храним
+    if state is None and data_json == "{}":
+        conn.execute("DELETE FROM fsm_states WHERE key = ?", (key,))
+        return
+
+    conn.execute("""
+        INSERT INTO fsm_states (key, state, data)
+        VALUES (?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET
+            state = excluded.state,
+            data = excluded.data
+    """, (key, state, data_json))
+
+
+# ================================
+# Активные истории игроков
+# ================================
+async def get_active_story(user_id):
+    """
+    id истории, которую играет игрок, или 0.
+    """
+
+    return await get_db().read(_get_active_story, user_id)
+
+
+def _get_active_story(conn, user_id):
+    row = conn.execute(
+        "SELECT story_id FROM active_stories WHERE user_id = ?", (user_id,)
+    ).fetchone()
+
+    return row[0] if row else 0
+
+
+async def set_active_story(user_id, story_id):
+    await get_db().write(_set_active_story, user_id, story_id)
+
+
+def _set_active_story(conn, user_id, story_id):
+    conn.execute("""
+        INSERT INTO active_stories (user_id, story_id)
+        VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET story_id = excluded.story_id
     """, (user_id, story_id))
 
-    dialog = cursor.fetchall()
-    conn.close()
 
-    return dialog
+# ================================
+# Черновики персонажей (при создании истории)
+# ================================
+async def get_draft_characters(user_id):
+    """
+    JSON-список персонажей черновика или None.
+    """
+
+    return await get_db().read(_get_draft_characters, user_id)
+
+
+def _get_draft_characters(conn, user_id):
+    row = conn.execute(
+        "SELECT characters FROM draft_characters WHERE user_id = ?", (user_id,)
+    ).fetchone()
+
+    return row[0] if row else None
+
+
+async def set_draft_characters(user_id, characters_json):
+    """
+    characters_json=None удаляет черновик.
+    """
+
+    await get_db().write(_set_draft_characters, user_id, characters_json)
+
+
+def _set_draft_characters(conn, user_id, characters_json):
+    if characters_json is None:
+        conn.execute("DELETE FROM draft_characters WHERE user_id = ?", (user_id,))
+        return
+
+    conn.execute("""
+        INSERT INTO draft_characters (user_id, characters)
+        VALUES (?, ?)
+        ON CONFLICT (user_id) DO UPDATE SET characters = excluded.characters
+    """, (user_id, characters_json))
+
+
+# ================================
+# Кэш ответов AI
+# ================================
+async def get_reply_caching(story_id):
+    """
+    Включён ли кэш ответов для истории.
+    """
+
+    return await get_db().read(_get_reply_caching, story_id)
+
+
+def _get_reply_caching(conn, story_id):
+    row = conn.execute(
+        "SELECT cache_replies FROM stories WHERE id = ?", (story_id,)
+    ).fetchone()
+
+    return bool(row and row[0])
+
+
+async def set_reply_caching(story_id, enabled):
+    """
+    Включает или выключает кэш ответов истории.
+    При выключении её ответы удаляются из кэша.
+    Возвращает False, если такой истории нет.
+    """
+
+    return await get_db().write(_set_reply_caching, story_id, enabled)
+
+
+def _set_reply_caching(conn, story_id, enabled):
+    cursor = conn.execute(
+        "UPDATE stories SET cache_replies = ? WHERE id = ?", (int(enabled), story_id)
+    )
+
+    if not enabled:
+        conn.execute("DELETE FROM reply_cache WHERE story_id = ?", (story_id,))
+
+    return cursor.rowcount > 0
+
+
+async def get_cached_reply(key, used_at):
+    """
+    Ответ из кэша (и отметка об использовании) или None.
+    """
+
+    return await get_db().write(_get_cached_reply, key, used_at)
+
+
+def _get_cached_reply(conn, key, used_at):
+    row = conn.execute(
+        "SELECT reply FROM reply_cache WHERE key = ?", (key,)
+    ).fetchone()
+
+    if row is None:
+        return None
+
+    conn.execute("""
+        UPDATE reply_cache
+        SET hits = hits + 1, used_at = ?
+        WHERE key = ?
+    """, (used_at, key))
+
+    return row[0]
+
+
+async def put_cached_reply(key, story_id, reply, used_at, max_bytes):
+    """
+    Кладёт ответ в кэш и вытесняет давно не использованные,
+    пока кэш не станет не больше max_bytes.
+    Возвращает размер кэша в байтах.
+    """
+
+    return await get_db().write(_put_cached_reply, key, story_id, reply, used_at, max_bytes)
+
+
+def _put_cached_reply(conn, key, story_id, reply, used_at, max_bytes):
+    conn.execute("""
+        INSERT INTO reply_cache (key, story_id, reply, size, used_at)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (key) DO UPDATE SET
+            reply = excluded.reply,
+            size = excluded.size,
+            used_at = excluded.used_at
+    """, (key, story_id, reply, len(reply.encode()), used_at))
+
+    total = _reply_cache_size(conn)
+    if total <= max_bytes:
+        return total
+
+    # Самые старые по used_at идут по индексу
+    evict = []
+    for old_key, size in conn.execute(
+        "SELECT key, size FROM reply_cache ORDER BY used_at"
+    ):
+        if total <= max_bytes:
+            break
+        evict.append((old_key,))
+        total -= size
+
+    conn.executemany("DELETE FROM reply_cache WHERE key = ?", evict)
+    return total
+
+
+async def reply_cache_info():
+    """
+    (записей, байт) в кэше ответов.
+    """
+
+    return await get_db().read(_reply_cache_info)
+
+
+def _reply_cache_info(conn):
+    return conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM reply_cache"
+    ).fetchone()
+
+
+def _reply_cache_size(conn):
+    return _reply_cache_info(conn)[1]
+
+
+# ================================
+# Очередь ходов (рабочие процессы)
+# ================================
+async def enqueue_turn(user_id, story_id, chat_id, text, created_at):
+    await get_db().write(_enqueue_turn, user_id, story_id, chat_id, text, created_at)
+
+
+def _enqueue_turn(conn, user_id, story_id, chat_id, text, created_at):
+    conn.execute("""
+        INSERT INTO turn_jobs (user_id, story_id, chat_id, text, created_at)
+        VALUES (?, ?, ?, ?, ?)
+    """, (user_id, story_id, chat_id, text, created_at))
+
+
+async def has_turns(partition, partitions, now):
+    """
+    Есть ли в своей части очереди ходы, которые можно забрать.
+    Чтение: пустая очередь не занимает запись в БД.
+    """
+
+    return await get_db().read(_has_turns, partition, partitions, now)
+
+
+def _has_turns(conn, partition, partitions, now):
+    return conn.execute("""
+        SELECT EXISTS (
+            SELECT 1 FROM turn_jobs
+            WHERE user_id % ? = ? AND lease_until <= ?
+        )
+    """, (partitions, partition, now)).fetchone()[0] == 1
+
+
+async def claim_turns(worker, partition, partitions, limit, now, lease_until):
+    """
+    Забирает до limit ходов своей части игроков
+    (user_id % partitions == partition). Ход — все ждущие
+    сообщения одной пары (user_id, story_id); пары, чей ход
+    уже выполняется, пропускаются. Возвращает
+    [(user_id, story_id, chat_id, [id], [text], attempts)].
+    """
+
+    return await get_db().write(
+        _claim_turns, worker, partition, partitions, limit, now, lease_until
+    )
+
+
+def _claim_turns(conn, worker, partition, partitions, limit, now, lease_until):
+    rows = conn.execute("""
+        SELECT id, user_id, story_id, chat_id, text, lease_until, attempts
+        FROM turn_jobs
+        WHERE user_id % ? = ?
+        ORDER BY id
+    """, (partitions, partition)).fetchall()
+
+    turns = {}
+    busy = set()
+
+    for job_id, user_id, story_id, chat_id, text, lease, attempts in rows:
+        key = (user_id, story_id)
+
+        if lease > now:
+            busy.add(key)
+            turns.pop(key, None)
+            continue
+
+        if key in busy:
+            continue
+
+        turn = turns.get(key)
+        if turn is None:
+            if len(turns) >= limit:
+                continue
+            turn = turns[key] = [user_id, story_id, chat_id, [], [], 0]
+
+        # Ответ — в чат последнего сообщения
+        turn[2] = chat_id
+        turn[3].append(job_id)
+        turn[4].append(text)
+        turn[5] = max(turn[5], attempts + 1)
+
+    ids = [(lease_until, worker, job_id) for turn in turns.values() for job_id in turn[3]]
+    conn.executemany("""
+        UPDATE turn_jobs
+        SET lease_until = ?, worker = ?, attempts = attempts + 1
+        WHERE id = ?
+    """, ids)
+
+    return [tuple(turn) for turn in turns.values()]
+
+
+async def extend_turns(job_ids, lease_until):
+    """
+    Продлевает аренду выполняющихся ходов.
+    """
+
+    await get_db().write(_extend_turns, job_ids, lease_until)
+
+
+def _extend_turns(conn, job_ids, lease_until):
+    conn.executemany(
+        "UPDATE turn_jobs SET lease_until = ? WHERE id = ?",
+        [(lease_until, job_id) for job_id in job_ids]
+    )
+
+
+async def finish_turn(job_ids, messages):
+    """
+    Записывает сообщения хода и удаляет его из очереди
+    одной транзакцией. messages — строки для _save_messages.
+    """
+
+    await get_db().write(_finish_turn, job_ids, messages)
+
+
+def _finish_turn(conn, job_ids, messages):
+    _save_messages(conn, messages)
+    _delete_turns(conn, job_ids)
+
+
+async def drop_turns(job_ids):
+    await get_db().write(_delete_turns, job_ids)
+
+
+def _delete_turns(conn, job_ids):
+    conn.executemany("DELETE FROM turn_jobs WHERE id = ?", [(job_id,) for job_id in job_ids])
+
+
+async def release_turns(job_ids):
+    """
+    Возвращает ходы в очередь (рабочий процесс останавливается).
+    """
+
+    await get_db().write(_extend_turns, job_ids, 0)
+
+
+async def turn_queue_info(now):
+    """
+    (ждут, выполняются) ходов в очереди.
+    """
+
+    return await get_db().read(_turn_queue_info, now)
+
+
+def _turn_queue_info(conn, now):
+    return conn.execute("""
+        SELECT
+            COALESCE(SUM(lease_until <= ?), 0),
+            COALESCE(SUM(lease_until > ?), 0)
+        FROM turn_jobs
+    """, (now, now)).fetchone()
@@ -0,0 +1,221 @@
+# ================================
+# fake_groq.py
+# Локальный фейковый Groq API
+# (для бенчмарков и проверки без ключа)
+# ================================
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import deque
+
+from aiohttp import web
+
+
+DEFAULT_REPLY = "Аня: ты здесь?\nМакс: не отвечай ему..."
+
+
+# ================================
+# Сервер
+# ================================
+class FakeGroq:
+    """
+    Отвечает на POST /openai/v1/chat/completions
+    как OpenAI-совместимый API, с искусственной задержкой.
+    При "stream": true отдаёт SSE: первый кусок через latency,
+    дальше по слову каждые token_delay секунд.
+
+    rate_limit=N, rate_window=T — не больше N запросов за T секунд,
+    сверх лимита — 429 с retry-after и x-ratelimit-* как у Groq.
+
+    Распределение задержки (distribution): "fixed" — ровно latency,
+    "uniform" — от 0.5 до 1.5 latency, "lognormal" — медиана latency
+    и разброс sigma (длинный хвост, как у настоящего API).
+
+    Сбои для проверки маршрутизатора: slow_rate — доля запросов
+    с задержкой slow_latency вместо обычной, error_rate — доля
+    ответов 503.
+    """
+
+    def __init__(self, latency=0.5, reply=DEFAULT_REPLY, token_delay=0.02,
+                 rate_limit=None, rate_window=60.0,
+                 slow_rate=0.0, slow_latency=5.0, error_rate=0.0, seed=None,
+                 distribution="fixed", sigma=0.5):
+        self.latency = latency
+        self.distribution = distribution
+        self.sigma = sigma
+        self.reply = reply
+        self.token_delay = token_delay
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.errors = 0
+        self.rejected = 0
+        self._accepted = deque()
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.runner = None
+        self.url = None
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/openai/v1/chat/completions", self.completions)
+        return app
+
+    def _check_rate_limit(self):
+        """
+        Заголовки x-ratelimit-* и, если лимит исчерпан, retry-after.
+        """
+
+        if self.rate_limit is None:
+            return {}, None
+
+        now = time.monotonic()
+        while self._accepted and self._accepted[0] <= now - self.rate_window:
+            self._accepted.popleft()
+
+        if len(self._accepted) >= self.rate_limit:
+            reset = self._accepted[0] + self.rate_window - now
+            headers = {
+                "x-ratelimit-limit-requests": str(self.rate_limit),
+                "x-ratelimit-remaining-requests": "0",
+                "x-ratelimit-reset-requests": f"{reset:.2f}s",
+                "retry-after": str(max(1, round(reset)))
+            }
+            return headers, reset
+
+        self._accepted.append(now)
+        reset = self._accepted[0] + self.rate_window - now
+        return {
+            "x-ratelimit-limit-requests": str(self.rate_limit),
+            "x-ratelimit-remaining-requests": str(self.rate_limit - len(self._accepted)),
+            "x-ratelimit-reset-requests": f"{reset:.2f}s"
+        }, None
+
+    async def completions(self, request):
+        payload = await request.json()
+
+        headers, limited = self._check_rate_limit()
+        if limited is not None:
+            self.rejected += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit reached", "type": "tokens", "code": "rate_limit_exceeded"}},
+                status=429,
+                headers=headers
+            )
+
+        self.requests += 1
+
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response(
+                {"error": {"message": "Service unavailable", "type": "internal_server_error"}},
+                status=503
+            )
+
+        latency = self.delay()
+        if self.random.random() < self.slow_rate:
+            latency = self.slow_latency
+
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            if payload.get("stream"):
+                return await self.stream(request, payload, headers, latency)
+
+            await asyncio.sleep(latency)
+        finally:
+            self.in_flight -= 1
+
+        return web.json_response({
+            "id": f"fake-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": self.reply},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        }, headers=headers)
+
+    def delay(self):
+        if self.distribution == "uniform":
+            return self.latency * self.random.uniform(0.5, 1.5)
+        if self.distribution == "lognormal":
+            return self.random.lognormvariate(0, self.sigma) * self.latency
+        return self.latency
+
+    async def stream(self, request, payload, headers, latency):
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", **headers})
+        await response.prepare(request)
+
+        await asyncio.sleep(latency)
+
+        words = self.reply.split(" ")
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(self.token_delay)
+                word = " " + word
+
+            chunk = {
+                "id": f"fake-{self.requests}",
+                "object": "chat.completion.chunk",
+                "model": payload.get("model"),
+                "choices": [{"index": 0, "delta": {"content": word}, "finish_reason": None}]
+            }
+            await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Запускает сервер; port=0 — любой свободный порт.
+        Возвращает URL для groq_ai.GROQ_URL.
+        """
+
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}/openai/v1/chat/completions"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# ================================
+# Запуск отдельно
+# ================================
+async def _serve(port, latency):
+    server = FakeGroq(latency=latency)
+    url = await server.start(port=port)
+    print(f"Fake Groq: {url} (задержка {latency} с)")
+    print(f"Запусти бота с GROQ_URL={url}")
+
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый Groq API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.5)
+    args = parser.parse_args()
+
+    asyncio.run(_serve(args.port, args.latency))
@@ -0,0 +1,174 @@
+# ================================
+# fake_telegram.py
+# Локальный фейковый Telegram Bot API
+# (для бенчмарков без настоящего Telegram)
+# ================================
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+from aiohttp import web
+
+
+# ================================
+# Сервер
+# ================================
+class FakeTelegram:
+    """
+    Отвечает на POST /bot<token>/<method> как Bot API.
+    Запоминает, сколько раз вызывался каждый метод.
+    on_send(chat_id, text) вызывается на каждое
+    sendMessage / editMessageText.
+    """
+
+    def __init__(self, latency=0.0, on_send=None):
+        self.latency = latency
+        self.on_send = on_send
+        self.calls = Counter()
+        self.runner = None
+        self.url = None
+        self._message_id = 0
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+    async def handle(self, request):
+        method = request.match_info["method"]
+        params = dict(await request.post())
+
+        self.calls[method] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getUpdates":
+            # Долгий опрос без новых апдейтов
+            await asyncio.sleep(min(float(params.get("timeout", 0) or 0), 1.0))
+            return self.ok([])
+
+        if method == "getMe":
+            return self.ok({
+                "id": 1, "is_bot": True, "first_name": "Horror-Studio", "username": "fake_bot"
+            })
+
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(params["chat_id"])
+            text = params.get("text", "")
+
+            if self.on_send is not None:
+                self.on_send(chat_id, text)
+
+            if method == "sendMessage":
+                self._message_id += 1
+                message_id = self._message_id
+            else:
+                message_id = int(params["message_id"])
+
+            return self.ok(make_message(message_id, chat_id, text))
+
+        # sendChatAction, answerCallbackQuery, setWebhook, ...
+        return self.ok(True)
+
+    @staticmethod
+    def ok(result):
+        return web.json_response({"ok": True, "result": result})
+
+    async def start(self, host="127.0.0.1", port=0):
+        """
+        Запускает сервер; port=0 — любой свободный порт.
+        Возвращает базовый URL для TELEGRAM_API_URL.
+        """
+
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+# ================================
+# Фейковые апдейты
+# ================================
+def make_user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Игрок {user_id}"}
+
+
+def make_message(message_id, chat_id, text, user_id=None):
+    message = {
+        "message_id": message_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "text": text
+    }
+
+    if user_id is not None:
+        message["from"] = make_user(user_id)
+
+    return message
+
+
+def make_message_update(update_id, user_id, text):
+    """
+    Игрок пишет текст боту в личку.
+    """
+
+    message = make_message(update_id, user_id, text, user_id)
+
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+
+    return {"update_id": update_id, "message": message}
+
+
+def make_callback_update(update_id, user_id, data):
+    """
+    Игрок нажимает inline-кнопку с callback_data.
+    """
+
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": make_user(user_id),
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": make_message(update_id, user_id, "меню", 1)
+        }
+    }
+
+
+# ================================
+# Запуск отдельно
+# ================================
+async def _serve(port, latency):
+    server = FakeTelegram(latency=latency)
+    server.on_send = lambda chat_id, text: print(f"→ {chat_id}: {json.dumps(text, ensure_ascii=False)}")
+    url = await server.start(port=port)
+    print(f"Fake Telegram: {url}")
+    print(f"Запусти бота с TELEGRAM_API_URL={url}")
+
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8082)
+    parser.add_argument("--latency", type=float, default=0.0)
+    args = parser.parse_args()
+
+    asyncio.run(_serve(args.port, args.latency))
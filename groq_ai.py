@@ -4,8 +4,20 @@
 # MEMORY + LOGIC + TELEGRAM STYLE
 # ================================
 
+import asyncio
+import json
 import os
-import requests
+import random
+import time
+from contextlib import aclosing, asynccontextmanager
+
+import aiohttp
+
+import metrics
+from prompts import prompt_builder, build_summary_messages, count_prompt_tokens, approx_tokens
+from ratelimit import ai_scheduler, parse_duration, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
+from reply_cache import reply_cache
+from router import ModelRouter, parse_backends
 
 
 # ================================
@@ -13,133 +25,424 @@ import requests
 # ================================
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
-GROQ_URL = "https://api.groq.com/openai/v1/chat/completions"
+GROQ_URL = os.getenv("GROQ_URL", "https://api.groq.com/openai/v1/chat/completions")
 
 MODEL = "llama-3.1-8b-instant"
 
+# Модели по порядку: "модель[@url],..." (без url — GROQ_URL).
+# Первая — основная, остальные — резерв и hedged-запросы
+AI_MODELS = os.getenv("AI_MODELS", f"{MODEL},llama-3.3-70b-versatile")
+
+# Пул соединений и таймауты (секунды)
+GROQ_MAX_CONNECTIONS = int(os.getenv("GROQ_MAX_CONNECTIONS", 20))
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", 30))
+GROQ_CONNECT_TIMEOUT = float(os.getenv("GROQ_CONNECT_TIMEOUT", 5))
+
+# Повторы при сетевых ошибках и 5xx (по кругу моделей AI_MODELS)
+GROQ_RETRIES = int(os.getenv("GROQ_RETRIES", 2))
+GROQ_BACKOFF = float(os.getenv("GROQ_BACKOFF", 0.5))
+GROQ_BACKOFF_MAX = float(os.getenv("GROQ_BACKOFF_MAX", 10))
+
+# Повторы после 429 (ждём, сколько скажет сервер)
+GROQ_RATE_LIMIT_RETRIES = int(os.getenv("GROQ_RATE_LIMIT_RETRIES", 6))
+
+# Длина конспекта старой переписки (токены ответа)
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", 300))
+
+AI_ERROR_REPLY = "⚠️ Ошибка AI. Попробуйте позже."
+
+
+# ================================
+# Общая HTTP-сессия (keep-alive)
+# ================================
+_session = None
+
+
+def get_session():
+    """
+    Возвращает одну общую aiohttp-сессию.
+    Соединения с Groq переиспользуются между ходами игроков.
+    """
+
+    global _session
+
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=GROQ_MAX_CONNECTIONS,
+            keepalive_timeout=60
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=GROQ_TIMEOUT,
+            # Только TCP-подключение: ожидание свободного
+            # соединения в пуле таймаутом не считается
+            sock_connect=GROQ_CONNECT_TIMEOUT
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    return _session
+
+
+async def close_session():
+    """
+    Закрывает общую сессию (при остановке бота).
+    """
+
+    global _session
+
+    if _session is not None and not _session.closed:
+        await _session.close()
+
+    _session = None
+
 
 # ================================
 # Главная функция генерации ответа
 # ================================
-def generate_story_reply(story, characters, dialog_context, user_message):
+async def generate_story_reply(story_id, story, characters, dialog_context, user_message,
+                               summary=None, priority=PRIORITY_INTERACTIVE):
     """
     Генерирует ответ AI как настоящую переписку Horror-Studio.
 
+    story_id        -> id истории (ключ кэша промпта)
     story           -> данные истории
     characters      -> список персонажей
-    dialog_context  -> последние 20 сообщений (память)
+    dialog_context  -> последние сообщения (память, режется по бюджету токенов)
     user_message    -> новое сообщение игрока
+    summary         -> краткое содержание более старой переписки
+    priority        -> фоновые запросы (заготовки) — без hedged-запросов
     """
 
-    title, description, hero_past, start_scene = story
-
-    # ----------------------------
-    # Персонажи (анкеты)
-    # ----------------------------
-    char_text = ""
-    for c in characters:
-        name, role, personality, known = c
-        char_text += f"- {name}: {role}, характер: {personality}, статус: {known}\n"
+    with metrics.stage("prompt_build"):
+        messages = prompt_builder.build_messages(
+            story_id, story, characters, dialog_context, user_message, summary
+        )
 
-    # ----------------------------
-    # Контекст последних сообщений
-    # ----------------------------
-    context_text = ""
-    for sender, text in dialog_context:
-        if sender == "player":
-            context_text += f"Игрок: {text}\n"
-        else:
-            context_text += f"Персонажи: {text}\n"
-
-    # ----------------------------
-    # SYSTEM PROMPT Horror-Studio V3
-    # ----------------------------
-    system_prompt = f"""
-Ты — Horror-Studio Engine.
+    payload = {
+        "model": MODEL,
+        "messages": messages,
+        "temperature": 0.75,
+        "max_tokens": 220
+    }
 
-Ты создаёшь НЕ рассказ.
-Ты создаёшь реалистичную переписку в Telegram.
+    # Одинаковые первые ходы — из кэша, если он включён у истории
+    cache_key = await reply_cache.key_for(story_id, dialog_context, user_message, summary, payload)
+    if cache_key is not None:
+        cached = await reply_cache.get(cache_key)
+        if cached is not None:
+            metrics.note("reply_cache", "hit")
+            return cached
 
-====================================================
-❗ ЖЁСТКИЕ ПРАВИЛА:
+    reply = None
 
-1. Формат ответа:
-Имя: сообщение
+    try:
+        result = await complete(payload, priority, hedge=priority == PRIORITY_INTERACTIVE)
+        if result is not None:
+            reply = result["choices"][0]["message"]["content"]
+    finally:
+        # Ждущие тот же ход получат ответ (или None — и пойдут сами)
+        if cache_key is not None:
+            await reply_cache.put(cache_key, story_id, reply)
 
-2. Только чат. Никаких описаний автора.
-НЕ пиши: "он пошёл", "вдруг случилось", "сцена".
+    if reply is None:
+        metrics.error("ai_unavailable")
+        return AI_ERROR_REPLY
 
-3. Сообщения короткие и живые.
-Как настоящие люди в Telegram.
+    return reply
 
-4. Максимум 2–4 сообщения за ответ.
 
-5. Персонажи НЕ могут внезапно умирать,
-если это не было событием сюжета.
+# ================================
+# Потоковая генерация ответа
+# ================================
+async def stream_story_reply(story_id, story, characters, dialog_context, user_message,
+                             summary=None):
+    """
+    То же, что generate_story_reply, но отдаёт ответ кусками
+    по мере генерации (SSE-поток OpenAI-совместимого API).
+    При ошибке до первого куска отдаёт AI_ERROR_REPLY.
+    """
 
-6. Всегда соблюдай логику:
-- кто рядом
-- кто жив
-- что происходило в последних сообщениях
+    with metrics.stage("prompt_build"):
+        messages = prompt_builder.build_messages(
+            story_id, story, characters, dialog_context, user_message, summary
+        )
 
-7. Не придумывай новых персонажей.
+    payload = {
+        "model": MODEL,
+        "messages": messages,
+        "temperature": 0.75,
+        "max_tokens": 220,
+        "stream": True
+    }
 
-8. Атмосфера должна быть:
-напряжённой, страшной, реалистичной.
+    # Кэш общий с generate_story_reply: "stream" в ключ не входит
+    cache_key = await reply_cache.key_for(story_id, dialog_context, user_message, summary, payload)
+    if cache_key is not None:
+        cached = await reply_cache.get(cache_key)
+        if cached is not None:
+            metrics.note("reply_cache", "hit")
+            yield cached
+            return
+
+    parts = []
+    finished = False
+
+    try:
+        async for delta in route_stream(payload):
+            parts.append(delta)
+            yield delta
+        finished = bool(parts)
+    except (aiohttp.ClientError, asyncio.TimeoutError):
+        metrics.error("ai_stream_broken")
+    finally:
+        # Оборванный ответ в кэш не кладём
+        if cache_key is not None:
+            reply = "".join(parts).strip() if finished else None
+            await reply_cache.put(cache_key, story_id, reply)
+
+    if not parts:
+        metrics.error("ai_unavailable")
+        yield AI_ERROR_REPLY
 
-====================================================
 
-📖 История:
-Название: {title}
+# ================================
+# Обновление конспекта старых сообщений
+# ================================
+async def summarize_dialog(previous, dialog):
+    """
+    Возвращает новый конспект или None при ошибке AI.
+    previous -> прежний конспект
+    dialog   -> [(sender, text), ...] вышедшие из окна памяти
+    """
 
-Описание автора:
-{description}
+    payload = {
+        "model": MODEL,
+        "messages": build_summary_messages(previous, dialog),
+        "temperature": 0.2,
+        "max_tokens": SUMMARY_MAX_TOKENS
+    }
 
-Прошлое героя:
-{hero_past}
+    # Конспект ждёт, пока не обслужены ходы игроков
+    result = await complete(payload, PRIORITY_BACKGROUND, hedge=False)
+    if result is None:
+        return None
 
-Начальная сцена:
-{start_scene}
+    return result["choices"][0]["message"]["content"].strip()
 
-Персонажи:
-{char_text}
 
-====================================================
+# ================================
+# Запрос в Groq (с повторами)
+# ================================
+def backoff_delay(attempt):
+    """
+    Экспоненциальная задержка с джиттером: половина
+    фиксированная, половина случайная, чтобы повторы
+    разных игроков не били в API одновременно.
+    """
 
-Последний контекст переписки (память):
+    delay = min(GROQ_BACKOFF * 2 ** (attempt - 1), GROQ_BACKOFF_MAX)
+    return delay / 2 + random.uniform(0, delay / 2)
 
-{context_text}
 
-====================================================
+def estimate_tokens(payload):
+    """
+    Сколько токенов запрос займёт в минутном бюджете.
+    """
 
-Игрок написал новое сообщение:
+    return count_prompt_tokens(payload["messages"]) + payload.get("max_tokens", 0)
 
-{user_message}
 
-Теперь ответь как настоящая переписка.
-"""
+@asynccontextmanager
+async def open_completion(payload, priority=PRIORITY_INTERACTIVE, url=None, retries=GROQ_RETRIES):
+    """
+    Отправляет payload через планировщик ai_scheduler и отдаёт
+    ответ со статусом 200 (или None, если не удалось).
+    Место в планировщике держится, пока ответ читается.
+
+    429 -> пауза по retry-after / x-ratelimit-reset-*, повтор
+    (до GROQ_RATE_LIMIT_RETRIES раз); сетевые ошибки и 5xx ->
+    повтор с джиттером (до retries раз); прочие 4xx -> None.
+    url=None — GROQ_URL.
+    """
 
-    # ----------------------------
-    # Запрос в Groq
-    # ----------------------------
     headers = {
         "Authorization": f"Bearer {GROQ_API_KEY}",
         "Content-Type": "application/json"
     }
 
-    payload = {
-        "model": MODEL,
-        "messages": [
-            {"role": "system", "content": system_prompt}
-        ],
-        "temperature": 0.75,
-        "max_tokens": 220
-    }
+    if payload.get("stream"):
+        headers["Accept"] = "text/event-stream"
+
+    session = get_session()
+    tokens = estimate_tokens(payload)
+    failures = limited = 0
+
+    while True:
+        status = None
+        retry_after = None
+
+        async with ai_scheduler.slot(priority, tokens):
+            try:
+                response = await session.post(url or GROQ_URL, json=payload, headers=headers)
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                metrics.error("ai_network")
+                response = None
+
+            if response is not None:
+                async with response:
+                    ai_scheduler.observe(response.headers)
+
+                    if response.status == 200:
+                        yield response
+                        return
+
+                    status = response.status
+                    metrics.error("ai_rate_limited" if status == 429 else f"ai_http_{status // 100}xx")
+                    retry_after = parse_duration(response.headers.get("retry-after"))
+
+                    # Отклонённый запрос токенов не тратит, а повтор
+                    # займёт их заново
+                    ai_scheduler.settle(tokens, 0)
+
+        if status == 429:
+            limited += 1
+            if limited > GROQ_RATE_LIMIT_RETRIES:
+                break
+
+            ai_scheduler.pause(retry_after or backoff_delay(limited))
+            continue
+
+        if status is not None and status < 500:
+            break
+
+        failures += 1
+        if failures > retries:
+            break
+
+        await asyncio.sleep(backoff_delay(failures))
+
+    yield None
+
+
+async def request_completion(payload, priority=PRIORITY_INTERACTIVE, url=None, retries=GROQ_RETRIES):
+    """
+    Отправляет payload в Groq и возвращает JSON ответа.
+    None — если не удалось.
+    """
+
+    async with open_completion(payload, priority, url, retries) as response:
+        if response is None:
+            return None
+
+        result = await response.json()
+
+    usage = result.get("usage") or {}
+    if usage.get("total_tokens"):
+        ai_scheduler.settle(estimate_tokens(payload), usage["total_tokens"])
+        count_tokens(payload["model"], usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+    else:
+        content = result["choices"][0]["message"]["content"] or ""
+        tokens_in = count_prompt_tokens(payload["messages"])
+        ai_scheduler.settle(estimate_tokens(payload), tokens_in + approx_tokens(content))
+        count_tokens(payload["model"], tokens_in, approx_tokens(content))
 
-    response = requests.post(GROQ_URL, json=payload, headers=headers)
+    return result
 
-    if response.status_code != 200:
-        return "⚠️ Ошибка AI. Попробуйте позже."
 
-    result = response.json()
-    return result["choices"][0]["message"]["content"]
+def count_tokens(model, tokens_in, tokens_out):
+    metrics.ai_tokens.inc(tokens_in, model=model, direction="in")
+    metrics.ai_tokens.inc(tokens_out, model=model, direction="out")
+    metrics.note("tokens_in", tokens_in)
+    metrics.note("tokens_out", tokens_out)
+
+
+async def request_stream(payload, priority=PRIORITY_INTERACTIVE, url=None, retries=GROQ_RETRIES):
+    """
+    Открывает SSE-поток и отдаёт текстовые дельты.
+    Повторы — только до начала потока; оборванный
+    посреди ответа поток не повторяется.
+    """
+
+    async with open_completion(payload, priority, url, retries) as response:
+        if response is None:
+            return
+
+        parts = []
+
+        async for line in response.content:
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+
+            data = line[5:].strip()
+            if data == b"[DONE]":
+                break
+
+            chunk = json.loads(data)
+            delta = chunk["choices"][0].get("delta", {}).get("content")
+            if delta:
+                parts.append(delta)
+                yield delta
+
+        # Неистраченный max_tokens — обратно в бюджет (usage в потоке нет)
+        ai_scheduler.settle(
+            estimate_tokens(payload),
+            count_prompt_tokens(payload["messages"]) + approx_tokens("".join(parts))
+        )
+
+
+# ================================
+# Через маршрутизатор моделей
+# ================================
+router = ModelRouter(parse_backends(AI_MODELS, MODEL), retries=GROQ_RETRIES, backoff=backoff_delay)
+
+
+async def complete(payload, priority=PRIORITY_INTERACTIVE, hedge=True):
+    """
+    JSON ответа первой успевшей модели из AI_MODELS
+    (с резервом, hedged-запросами и дедлайном) или None.
+    """
+
+    async def attempt(backend):
+        started = time.perf_counter()
+        result = await request_completion(
+            {**payload, "model": backend.model}, priority, backend.url, retries=0
+        )
+        if result is not None:
+            metrics.ai_request_seconds.observe(time.perf_counter() - started, model=backend.model)
+            metrics.note("model", backend.model)
+            yield result
+
+    async with aclosing(router.route(attempt, hedge)) as results:
+        async for result in results:
+            return result
+
+    return None
+
+
+async def route_stream(payload, priority=PRIORITY_INTERACTIVE):
+    """
+    Поток дельт через маршрутизатор: резерв и hedged-запрос
+    работают до первого куска, дальше читается один поток.
+    """
+
+    async def attempt(backend):
+        started = time.perf_counter()
+        parts = []
+
+        async for delta in request_stream(
+            {**payload, "model": backend.model}, priority, backend.url, retries=0
+        ):
+            if not parts:
+                metrics.ai_request_seconds.observe(time.perf_counter() - started, model=backend.model)
+                metrics.note("model", backend.model)
+            parts.append(delta)
+            yield delta
+
+        # В потоке usage нет — считаем примерно
+        if parts:
+            count_tokens(backend.model, count_prompt_tokens(payload["messages"]),
+                         approx_tokens("".join(parts)))
+
+    async with aclosing(router.route(attempt)) as deltas:
+        async for delta in deltas:
+            yield delta
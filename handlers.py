@@ -0,0 +1,528 @@
+# ================================
+# handlers.py
+# Horror-Studio Bot V2.0: диспетчер и обработчики
+# MEMORY + LOGIC + TELEGRAM CHAT STYLE
+#
+# Тяжёлый модуль (aiogram, AI): bot.py загружает
+# его уже после того, как поднял healthcheck
+# ================================
+
+import asyncio
+import time
+
+from aiogram import Dispatcher, F
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiogram.types import Message, CallbackQuery
+from aiogram.filters import CommandStart, Command
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.utils.chat_action import ChatActionSender
+from aiogram.fsm.context import FSMContext
+from aiogram.exceptions import TelegramBadRequest
+
+from config import ADMIN_ID
+from states import StoryCreation
+
+from db import (
+    add_story_with_characters,
+    get_story,
+    get_characters,
+    save_message,
+    get_last_messages,
+    get_summary,
+    cache_stats,
+    reply_cache_info,
+    turn_queue_info,
+    message_log,
+    DIALOG_BUFFER_SIZE
+)
+
+from groq_ai import generate_story_reply, stream_story_reply, router
+from prompts import prompt_builder
+from streaming import STREAM_REPLIES, stream_to_chat
+from summary import summary_memory
+from sessions import SQLiteStorage, session_store
+from turns import turn_scheduler
+from ratelimit import ai_scheduler
+import metrics
+from metrics import stage
+from reply_cache import reply_cache
+from retention import retention
+from catalog import PLAY, LIST, story_catalog
+from outbox import outbox, answer
+from telegram import create_bot
+from worker import WORKER_PROCESSES, enqueue_turn, supervisor
+from warmup import first_turn
+
+# ================================
+# Бот и диспетчер
+# ================================
+bot = create_bot()
+
+# FSM, активные истории и черновики персонажей хранятся в SQLite
+# (переживают перезапуск, общие для нескольких инстансов)
+dp = Dispatcher(storage=SQLiteStorage())
+
+
+@dp.update.outer_middleware()
+async def count_updates(handler, update, data):
+    metrics.updates.inc(type=update.event_type)
+    return await handler(update, data)
+
+
+# Очереди и модели AI — считаются в момент запроса /metrics
+metrics.add_gauge("horror_turns_active", "Игроки, чей ход сейчас выполняется",
+                  lambda: turn_scheduler.stats()["active"])
+metrics.add_gauge("horror_ai_in_flight", "Запросы к AI в работе",
+                  lambda: ai_scheduler.in_flight)
+metrics.add_gauge("horror_ai_waiting", "Запросы к AI в очереди планировщика",
+                  lambda: ai_scheduler.stats()["waiting"])
+metrics.add_gauge("horror_outbox_pending", "Сообщения в очереди отправки в Telegram",
+                  outbox.pending)
+metrics.add_gauge("horror_ai_backend_open", "Модель выведена из ротации (circuit breaker)",
+                  lambda: {(b.name,): int(b.state != "closed") for b in router.backends},
+                  labels=("backend",))
+
+
+# ================================
+# Главное меню
+# ================================
+def main_menu(is_admin=False):
+    kb = InlineKeyboardBuilder()
+
+    if is_admin:
+        kb.button(text="➕ Создать историю", callback_data="create_story")
+
+    kb.button(text="📚 Список историй", callback_data="list_stories")
+    kb.button(text="▶️ Начать историю", callback_data="play_story")
+
+    kb.adjust(1)
+    return kb.as_markup()
+
+
+# ================================
+# Меню персонажей
+# ================================
+def character_menu():
+    kb = InlineKeyboardBuilder()
+    kb.button(text="➕ Добавить персонажа", callback_data="add_character")
+    kb.button(text="📜 Список персонажей", callback_data="show_characters")
+    kb.button(text="✅ Создать историю", callback_data="finish_story")
+    kb.adjust(1)
+    return kb.as_markup()
+
+
+# ================================
+# /start
+# ================================
+@dp.message(CommandStart())
+async def start(message: Message):
+    is_admin = (message.from_user.id == ADMIN_ID)
+
+    answer(
+        message,
+        "👻 Добро пожаловать в нашу студию!\n"
+        "Это панель автора, у вас нету права на ошибки или даже молитвы.\n\n"
+        "Внизу есть кнопки:\n"
+        "#1 Создать историю\n"
+        "#2 Список историй\n"
+        "#3 Начать историю",
+        reply_markup=main_menu(is_admin)
+    )
+
+
+# ================================
+# /stats (автор): состояние кэшей
+# ================================
+@dp.message(Command("stats"))
+async def stats(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    lines = ["📊 Кэши:"]
+    for name, s in {**cache_stats(), **session_store.stats(),
+                    "catalog": story_catalog.stats()}.items():
+        lines.append(f"{name}: {s['size']} шт., попаданий {s['hits']}, промахов {s['misses']}")
+
+    lines.append("")
+    lines.append("⏳ Очереди:")
+    if WORKER_PROCESSES:
+        waiting, running = await turn_queue_info(time.time())
+        lines.append(f"workers: waiting {waiting}, running {running}, " +
+                     ", ".join(f"{k} {v}" for k, v in supervisor.stats().items()))
+    for name, s in (("turns", turn_scheduler.stats()), ("ai", ai_scheduler.stats()),
+                    ("messages", message_log.stats()), ("archive", retention.stats()),
+                    ("outbox", outbox.stats()), ("warmup", first_turn.stats())):
+        lines.append(f"{name}: " + ", ".join(f"{k} {v}" for k, v in s.items()))
+
+    r = router.stats()
+    lines.append("")
+    lines.append(f"🧭 Модели AI (hedged {r['hedged']}, дедлайн {r['timeouts']}, "
+                 f"все недоступны {r['unavailable']}):")
+    for name, s in r["backends"].items():
+        lines.append(f"{name}: " + ", ".join(f"{k} {v}" for k, v in s.items()))
+
+    entries, size = await reply_cache_info()
+    s = reply_cache.stats()
+    lines.append("")
+    lines.append("💾 Кэш ответов AI:")
+    lines.append(f"{entries} шт., {size} байт; попаданий {s['hits']}, промахов {s['misses']} "
+                 f"({s['hit_ratio']:.0%}), сэкономлено {s['bytes_saved']} байт")
+
+    answer(message, "\n".join(lines))
+
+
+# ================================
+# /reply_cache <id> on|off (автор):
+# кэш ответов AI для начала истории
+# ================================
+@dp.message(Command("reply_cache"))
+async def toggle_reply_cache(message: Message):
+    if message.from_user.id != ADMIN_ID:
+        return
+
+    args = (message.text or "").split()[1:]
+    if len(args) != 2 or not args[0].isdigit() or args[1] not in ("on", "off"):
+        answer(message, "Использование: /reply_cache <id истории> on|off")
+        return
+
+    story_id, enabled = int(args[0]), args[1] == "on"
+
+    if not await reply_cache.set_enabled(story_id, enabled):
+        answer(message, "❌ Нет такой истории.")
+        return
+
+    answer(message, f"💾 Кэш ответов для истории {story_id} "
+                    f"{'включён' if enabled else 'выключен'}.")
+
+
+# ================================
+# Создание истории (автор)
+# ================================
+@dp.callback_query(F.data == "create_story")
+async def create_story(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+
+    if callback.from_user.id != ADMIN_ID:
+        answer(callback.message, "❌ Только автор может создавать истории.")
+        return
+
+    answer(callback.message, "Введите название истории:")
+    await state.set_state(StoryCreation.title)
+
+
+@dp.message(StoryCreation.title)
+async def set_title(message: Message, state: FSMContext):
+    await state.update_data(title=message.text)
+    answer(message, "Введите описание истории (для ИИ):")
+    await state.set_state(StoryCreation.description)
+
+
+@dp.message(StoryCreation.description)
+async def set_description(message: Message, state: FSMContext):
+    await state.update_data(description=message.text)
+    answer(message, "Введите прошлое главного героя:")
+    await state.set_state(StoryCreation.hero_past)
+
+
+@dp.message(StoryCreation.hero_past)
+async def set_hero_past(message: Message, state: FSMContext):
+    await state.update_data(hero_past=message.text)
+    answer(message, "Введите вступительную сцену:")
+    await state.set_state(StoryCreation.start_scene)
+
+
+@dp.message(StoryCreation.start_scene)
+async def set_start_scene(message: Message, state: FSMContext):
+    await state.update_data(start_scene=message.text)
+
+    await session_store.set_draft(message.from_user.id, [])
+
+    answer(
+        message,
+        "История почти готова.\nДобавьте персонажей (до 15).",
+        reply_markup=character_menu()
+    )
+
+
+# ================================
+# Добавление персонажей
+# ================================
+@dp.callback_query(F.data == "add_character")
+async def add_char(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+
+    answer(callback.message, "Введите имя персонажа:")
+    await state.set_state(StoryCreation.char_name)
+
+
+@dp.message(StoryCreation.char_name)
+async def char_name(message: Message, state: FSMContext):
+    await state.update_data(char_name=message.text)
+    answer(message, "Сколько ему лет?")
+    await state.set_state(StoryCreation.char_age)
+
+
+@dp.message(StoryCreation.char_age)
+async def char_age(message: Message, state: FSMContext):
+    await state.update_data(char_age=message.text)
+    answer(message, "Введите роль персонажа:")
+    await state.set_state(StoryCreation.char_role)
+
+
+@dp.message(StoryCreation.char_role)
+async def char_role(message: Message, state: FSMContext):
+    await state.update_data(char_role=message.text)
+    answer(message, "Опишите характер персонажа:")
+    await state.set_state(StoryCreation.char_personality)
+
+
+@dp.message(StoryCreation.char_personality)
+async def char_personality(message: Message, state: FSMContext):
+    await state.update_data(char_personality=message.text)
+
+    kb = InlineKeyboardBuilder()
+    kb.button(text="Знакомый", callback_data="known_yes")
+    kb.button(text="Незнакомый", callback_data="known_no")
+    kb.adjust(2)
+
+    answer(message, "Вы знакомы с ним?", reply_markup=kb.as_markup())
+
+
+@dp.callback_query(F.data.startswith("known_"))
+async def char_known(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+
+    data = await state.get_data()
+    known_status = "знакомый" if callback.data == "known_yes" else "незнакомый"
+
+    await session_store.add_to_draft(callback.from_user.id, {
+        "name": data["char_name"],
+        "age": data["char_age"],
+        "role": data["char_role"],
+        "personality": data["char_personality"],
+        "known": known_status
+    })
+
+    answer(callback.message, "✅ Персонаж добавлен!")
+    answer(callback.message, "Продолжить:", reply_markup=character_menu())
+
+
+# ================================
+# Завершение истории
+# ================================
+@dp.callback_query(F.data == "finish_story")
+async def finish_story(callback: CallbackQuery, state: FSMContext):
+    await callback.answer()
+
+    data = await state.get_data()
+    draft = await session_store.get_draft(callback.from_user.id)
+
+    # История и персонажи — одной транзакцией
+    await add_story_with_characters(
+        data["title"],
+        data["description"],
+        data["hero_past"],
+        data["start_scene"],
+        [
+            (c["name"], f"{c['role']} ({c['age']} лет)", c["personality"], c["known"])
+            for c in draft
+        ]
+    )
+
+    await session_store.clear_draft(callback.from_user.id)
+    story_catalog.invalidate()
+
+    answer(callback.message, "История создана! ✔️")
+    answer(callback.message, "Главное меню:", reply_markup=main_menu(True))
+
+    await state.clear()
+
+
+# ================================
+# Каталог историй (по страницам)
+# ================================
+@dp.callback_query(F.data == "play_story")
+async def play_story(callback: CallbackQuery):
+    await callback.answer()
+
+    text, markup = await story_catalog.page(PLAY)
+    answer(callback.message, text, reply_markup=markup)
+
+
+@dp.callback_query(F.data == "list_stories")
+async def list_stories(callback: CallbackQuery):
+    await callback.answer()
+
+    text, markup = await story_catalog.page(LIST)
+    answer(callback.message, text, reply_markup=markup)
+
+
+@dp.callback_query(F.data.startswith("catalog:"))
+async def catalog_page(callback: CallbackQuery):
+    await callback.answer()
+
+    text, markup = await story_catalog.page_from_callback(callback.data)
+
+    # Листаем в том же сообщении; повторное нажатие
+    # на ту же страницу Telegram отклоняет — не страшно
+    try:
+        await callback.message.edit_text(text, reply_markup=markup)
+    except TelegramBadRequest:
+        pass
+
+
+# ================================
+# Начать историю
+# ================================
+
+
+@dp.callback_query(F.data.startswith("start_"))
+async def start_story(callback: CallbackQuery):
+    await callback.answer()
+
+    story_id = int(callback.data.split("_")[1])
+    story = await get_story(story_id)
+
+    await session_store.set_active_story(callback.from_user.id, story_id)
+
+    title, desc, past, start_scene = story
+
+    # Сохраняем вступление в память диалога
+    await save_message(callback.from_user.id, story_id, "character", start_scene)
+
+    # Пока игрок читает сцену — заготовка первого хода
+    # (в режиме рабочих процессов ходы идут не здесь)
+    if not WORKER_PROCESSES:
+        first_turn.start(callback.from_user.id, story_id)
+
+    answer(
+        callback.message,
+        f"📖 История началась:\n\n{start_scene}\n\n"
+        "✍️ Напишите первое сообщение..."
+    )
+
+
+# ================================
+# Игровой чат (AI + память)
+# ================================
+@dp.message()
+async def game_chat(message: Message):
+    user_id = message.from_user.id
+
+    story_id = await session_store.get_active_story(user_id)
+    if story_id is None or message.text is None:
+        return
+
+    # Ход выполнит рабочий процесс (worker.py)
+    if WORKER_PROCESSES:
+        await enqueue_turn(user_id, story_id, message.chat.id, message.text)
+        return
+
+    # Ходы игрока идут по очереди: сообщения, пришедшие
+    # пока AI отвечает, уйдут одним следующим ходом
+    await turn_scheduler.submit(
+        (user_id, story_id),
+        message.text,
+        lambda texts: play_turn(message, story_id, texts)
+    )
+
+
+async def play_turn(message: Message, story_id, texts):
+    user_id = message.from_user.id
+    user_message = "\n".join(texts)
+
+    # Время каждого этапа — в /metrics и в JSON-лог хода
+    with metrics.turn_timing(user_id, story_id):
+        metrics.note("messages", len(texts))
+
+        # 1) Сохраняем сообщения игрока
+        with stage("db_write"):
+            for text in texts:
+                await save_message(user_id, story_id, "player", text)
+
+        # 2) Получаем последние сообщения (в промпт попадут те,
+        #    что влезут в бюджет токенов); сообщения этого хода
+        #    уйдут в промпт одним последним сообщением игрока
+        with stage("context_read"):
+            dialog_context = await get_last_messages(user_id, story_id, limit=DIALOG_BUFFER_SIZE)
+            dialog_context = dialog_context[:-len(texts)]
+
+        # 3) Загружаем историю, персонажей и конспект старой переписки
+        with stage("story_load"):
+            story_data = await get_story(story_id)
+            characters = await get_characters(story_id)
+            summary, _ = await get_summary(user_id, story_id)
+
+        # 4) Генерация AI ответа (пока ждём — "печатает...");
+        #    первый ход мог быть заготовлен при начале истории
+        async with ChatActionSender.typing(bot=message.bot, chat_id=message.chat.id):
+            prepared = None
+            if first_turn.enabled:
+                with stage("warmup"):
+                    prepared = await first_turn.take(
+                        user_id, story_id, dialog_context, user_message, summary
+                    )
+
+            if prepared is not None:
+                reply = prepared
+            elif STREAM_REPLIES:
+                # Ответ показывается по мере генерации
+                with stage("ai_stream"):
+                    reply = await stream_to_chat(
+                        message.bot,
+                        message.chat.id,
+                        stream_story_reply(
+                            story_id,
+                            story_data,
+                            characters,
+                            dialog_context,
+                            user_message,
+                            summary
+                        )
+                    )
+            else:
+                with stage("ai"):
+                    reply = await generate_story_reply(
+                        story_id,
+                        story_data,
+                        characters,
+                        dialog_context,
+                        user_message,
+                        summary
+                    )
+
+        # 5) Сохраняем ответ AI
+        with stage("db_write"):
+            await save_message(user_id, story_id, "character", reply)
+
+        # 6) Отправляем игроку (в потоковом режиме уже отправлен);
+        #    ход не ждёт отправки — сообщение стоит в очереди чата,
+        #    время отправки замеряет outbox
+        if prepared is not None or not STREAM_REPLIES:
+            answer(message, reply)
+
+    # 7) В фоне сжимаем в конспект всё, что не уместилось в промпт:
+    #    окно — сообщения, попавшие в него целиком, и этот ход
+    kept = prompt_builder.kept_messages(
+        story_id, story_data, characters, dialog_context, user_message, summary
+    )
+    summary_memory.schedule(
+        user_id, story_id, new_messages=len(texts) + 1, keep=kept + len(texts) + 1
+    )
+
+
+# ================================
+# Приём апдейтов (webhook)
+# ================================
+class WebhookHandler(SimpleRequestHandler):
+    """
+    Приём апдейтов от Telegram. Перед остановкой
+    дожидается апдейтов, которые ещё обрабатываются.
+    """
+
+    async def close(self):
+        tasks = self._background_feed_update_tasks
+        if tasks:
+            await asyncio.wait(tasks, timeout=30)
+
+        await super().close()
@@ -0,0 +1,423 @@
+# ================================
+# loadtest.py
+# Нагрузочный тест бота целиком:
+# настоящий Dispatcher и обработчики handlers.py,
+# фейковые Telegram Bot API и Groq в том же процессе
+#
+# python loadtest.py --users 2000 --turns 5
+# python loadtest.py --users 500 --ai-latency 0.8 --ai-dist lognormal --stream
+# python loadtest.py --users 1000 --json > before.json
+# ================================
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import tempfile
+import time
+
+
+# ================================
+# Статистика
+# ================================
+def percentile(values, p):
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+
+def summarize(values):
+    """
+    p50/p95/p99/max в миллисекундах.
+    """
+
+    return {
+        "p50": round(percentile(values, 50) * 1000, 1),
+        "p95": round(percentile(values, 95) * 1000, 1),
+        "p99": round(percentile(values, 99) * 1000, 1),
+        "max": round(max(values, default=0.0) * 1000, 1)
+    }
+
+
+class LoopLag:
+    """
+    Насколько event loop опаздывает будить задачу,
+    заснувшую на interval секунд. Большой лаг — значит,
+    что-то блокирует loop (синхронный код, тяжёлый CPU).
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - started - self.interval, 0.0))
+
+    def start(self):
+        self._task = asyncio.create_task(self._watch())
+
+    async def stop(self):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+# ================================
+# Чаты: что бот прислал игрокам
+# ================================
+class Chats:
+    """
+    Сообщения бота (sendMessage / editMessageText) по чатам,
+    с временем прихода.
+    """
+
+    def __init__(self):
+        self.queues = {}
+
+    def queue(self, chat_id):
+        queue = self.queues.get(chat_id)
+        if queue is None:
+            queue = self.queues[chat_id] = asyncio.Queue()
+        return queue
+
+    def on_send(self, chat_id, text):
+        self.queue(chat_id).put_nowait((time.perf_counter(), text))
+
+    def drain(self, chat_id):
+        queue = self.queue(chat_id)
+        while not queue.empty():
+            queue.get_nowait()
+
+    async def first(self, chat_id, timeout):
+        return await asyncio.wait_for(self.queue(chat_id).get(), timeout)
+
+
+# ================================
+# Нагрузочный тест
+# ================================
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.chats = Chats()
+        self.lag = LoopLag()
+
+        self.update_ids = iter(range(1, 10 ** 12))
+        self.updates = 0
+        self.update_times = []
+        self.turn_times = []
+        self.first_reply_times = []
+        self.first_turn_times = []
+        self.missing_replies = 0
+        self.errors = 0
+
+    # ----------------------------
+    # Окружение
+    # ----------------------------
+    async def setup(self):
+        from fake_groq import FakeGroq
+        from fake_telegram import FakeTelegram
+
+        args = self.args
+
+        self.telegram = FakeTelegram(latency=args.tg_latency, on_send=self.chats.on_send)
+        self.groq = FakeGroq(
+            latency=args.ai_latency,
+            distribution=args.ai_dist,
+            sigma=args.ai_sigma,
+            token_delay=args.token_delay,
+            slow_rate=args.ai_slow_rate,
+            slow_latency=args.ai_slow_latency,
+            error_rate=args.ai_error_rate,
+            seed=args.seed
+        )
+
+        # handlers.py читает настройки при импорте
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+
+        os.environ.update({
+            "TELEGRAM_API_URL": await self.telegram.start(),
+            "GROQ_URL": await self.groq.start(),
+            "STREAM_REPLIES": "1" if args.stream else "0",
+            "FIRST_TURN_WARMUP": "1" if args.warmup else "0",
+            "TURN_TIMING_LOG": "0",
+            "PORT": str(port),
+        })
+        if args.ai_connections:
+            os.environ["GROQ_MAX_CONNECTIONS"] = str(args.ai_connections)
+
+        # Рабочие процессы читают лимиты из окружения
+        if args.workers:
+            os.environ["WORKER_PROCESSES"] = str(args.workers)
+            if not args.ai_limits:
+                os.environ.update({
+                    "AI_REQUESTS_PER_MINUTE": "1e9", "AI_BURST": "1000000000",
+                    "AI_TOKENS_PER_MINUTE": "1e12",
+                    "AI_MAX_CONCURRENCY": os.getenv("GROQ_MAX_CONNECTIONS", "20")
+                })
+            if not args.tg_limits:
+                os.environ.update({
+                    "TELEGRAM_SENDS_PER_SECOND": "1e9", "TELEGRAM_SENDS_BURST": "1000000000"
+                })
+
+        import db
+        db.DB_NAME = args.db or os.path.join(tempfile.mkdtemp(), "loadtest.db")
+        os.environ["DB_NAME"] = db.DB_NAME
+
+        import handlers
+        self.handlers = handlers
+
+        if not args.ai_limits:
+            from bench import _unlimited_ai
+            _unlimited_ai()
+
+        # Фейковый Bot API не ограничивает отправки
+        if not args.tg_limits:
+            from ratelimit import TokenBucket
+            handlers.outbox.bucket = TokenBucket(1e9, 1e9)
+
+        await db.init_db()
+
+        # Часы запускаются, когда все процессы загрузились
+        if args.workers:
+            handlers.supervisor.start()
+            await asyncio.wait_for(handlers.supervisor.wait_ready(), 120)
+
+    async def teardown(self):
+        await self.handlers.supervisor.close()
+        await self.handlers.first_turn.close()
+        await self.handlers.summary_memory.close()
+        await self.handlers.outbox.close()
+        await self.handlers.bot.session.close()
+
+        from groq_ai import close_session
+        await close_session()
+
+        import db
+        await db.close_db()
+
+        await self.groq.stop()
+        await self.telegram.stop()
+
+    # ----------------------------
+    # Апдейты
+    # ----------------------------
+    async def feed(self, update):
+        """
+        Прогоняет апдейт через Dispatcher, как при polling.
+        """
+
+        started = time.perf_counter()
+        try:
+            await self.handlers.dp.feed_raw_update(self.handlers.bot, update)
+        except Exception:
+            self.errors += 1
+        finally:
+            self.updates += 1
+            self.update_times.append(time.perf_counter() - started)
+
+    async def message(self, user_id, text):
+        from fake_telegram import make_message_update
+        await self.feed(make_message_update(next(self.update_ids), user_id, text))
+
+    async def callback(self, user_id, data):
+        from fake_telegram import make_callback_update
+        await self.feed(make_callback_update(next(self.update_ids), user_id, data))
+
+    async def think(self):
+        if self.args.think:
+            await asyncio.sleep(self.rng.expovariate(1 / self.args.think))
+
+    # ----------------------------
+    # Сценарии
+    # ----------------------------
+    async def author(self, user_id):
+        """
+        Автор создаёт историю через FSM: название, описание,
+        прошлое героя, сцена, персонажи, готово.
+        """
+
+        await self.message(user_id, "/start")
+        await self.callback(user_id, "create_story")
+
+        for text in ("Дом на холме", "Заброшенный дом, ночь, гроза",
+                     "Герой потерял память", "Ты просыпаешься в тёмной комнате"):
+            await self.message(user_id, text)
+
+        for i in range(self.args.characters):
+            await self.callback(user_id, "add_character")
+            for text in (f"Персонаж {i}", "17", "сосед", "тихий, нервный"):
+                await self.message(user_id, text)
+            await self.callback(user_id, "known_yes" if i % 2 else "known_no")
+
+        await self.callback(user_id, "finish_story")
+
+    async def player(self, user_id, story_ids):
+        """
+        Игрок: /start, выбор истории, несколько ходов.
+        Каждый следующий ход — после ответа на предыдущий.
+        """
+
+        await asyncio.sleep(self.rng.uniform(0, self.args.ramp))
+
+        await self.message(user_id, "/start")
+        await self.callback(user_id, "play_story")
+        await self.callback(user_id, f"start_{self.rng.choice(story_ids)}")
+
+        for turn in range(self.args.turns):
+            await self.think()
+
+            self.chats.drain(user_id)
+            started = time.perf_counter()
+            await self.message(user_id, self.rng.choice(PLAYER_LINES))
+            self.turn_times.append(time.perf_counter() - started)
+
+            try:
+                sent_at, _ = await self.chats.first(user_id, timeout=self.args.reply_timeout)
+                self.first_reply_times.append(sent_at - started)
+                if turn == 0:
+                    self.first_turn_times.append(sent_at - started)
+            except asyncio.TimeoutError:
+                self.missing_replies += 1
+
+    # ----------------------------
+    # Запуск
+    # ----------------------------
+    async def run(self):
+        import db
+
+        args = self.args
+        await self.setup()
+
+        try:
+            # Истории создаются через тот же FSM, что у автора
+            started = time.perf_counter()
+            for _ in range(args.stories):
+                await self.author(self.handlers.ADMIN_ID)
+            authoring = time.perf_counter() - started
+
+            story_ids = [story_id for story_id, _ in await db.get_stories()]
+
+            self.update_times.clear()
+            self.lag.start()
+
+            started = time.perf_counter()
+            await asyncio.gather(*(
+                self.player(1_000_000 + i, story_ids) for i in range(args.users)
+            ))
+            elapsed = time.perf_counter() - started
+
+            await self.lag.stop()
+        finally:
+            await self.teardown()
+
+        # Ходы в /metrics бота (с --workers — присланные процессами)
+        import metrics
+        metric_turns = sum(count for _, _, count in metrics.turn_seconds.values.values())
+
+        turns = len(self.turn_times)
+        return {
+            "users": args.users,
+            "turns": turns,
+            "updates": self.updates,
+            "seconds": round(elapsed, 2),
+            "authoring_seconds": round(authoring, 2),
+            "turns_per_second": round(turns / elapsed, 1),
+            "updates_per_second": round(len(self.update_times) / elapsed, 1),
+            "turn_ms": summarize(self.turn_times),
+            "first_reply_ms": summarize(self.first_reply_times),
+            "first_turn_ms": summarize(self.first_turn_times),
+            "update_ms": summarize(self.update_times),
+            "loop_lag_ms": summarize(self.lag.samples),
+            "errors": self.errors,
+            "missing_replies": self.missing_replies,
+            "metric_turns": metric_turns,
+            "ai_requests": self.groq.requests,
+            "ai_max_in_flight": self.groq.max_in_flight,
+            "telegram_calls": dict(self.telegram.calls)
+        }
+
+
+PLAYER_LINES = [
+    "привет", "кто здесь?", "я открываю дверь", "иду на звук",
+    "Аня, ты где?", "я не понимаю, что происходит", "бегу к выходу",
+    "смотрю в окно", "кто это был?", "включаю фонарик"
+]
+
+
+def print_report(result):
+    print(f"Игроков:              {result['users']}")
+    print(f"Ходов:                {result['turns']} за {result['seconds']} с "
+          f"({result['turns_per_second']} в секунду)")
+    print(f"Апдейтов в секунду:   {result['updates_per_second']}")
+    print(f"Создание историй:     {result['authoring_seconds']} с")
+
+    for key, name in (("turn_ms", "Ход целиком"), ("first_reply_ms", "Первый ответ"),
+                      ("first_turn_ms", "1-й ход истории"),
+                      ("update_ms", "Любой апдейт"), ("loop_lag_ms", "Лаг event loop")):
+        s = result[key]
+        print(f"{name + ', мс:':22}p50 {s['p50']}  p95 {s['p95']}  p99 {s['p99']}  max {s['max']}")
+
+    print(f"Ошибок:               {result['errors']}, без ответа: {result['missing_replies']}")
+    print(f"Ходов в /metrics:     {result['metric_turns']}")
+    print(f"Запросов к AI:        {result['ai_requests']} (одновременно до {result['ai_max_in_flight']})")
+    print(f"Вызовы Bot API:       {result['telegram_calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест Horror-Studio Bot")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--stories", type=int, default=3, help="сколько историй создать через FSM")
+    parser.add_argument("--characters", type=int, default=3, help="персонажей в истории")
+    parser.add_argument("--ramp", type=float, default=5.0, help="игроки приходят в течение N секунд")
+    parser.add_argument("--think", type=float, default=0.5, help="средняя пауза между ходами (с)")
+    parser.add_argument("--stream", action="store_true", help="потоковые ответы (STREAM_REPLIES=1)")
+    parser.add_argument("--warmup", action="store_true",
+                        help="заготовка первого хода (FIRST_TURN_WARMUP=1)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="ходы в N рабочих процессах (WORKER_PROCESSES)")
+
+    parser.add_argument("--ai-latency", type=float, default=0.5, help="медиана задержки Groq (с)")
+    parser.add_argument("--ai-dist", choices=("fixed", "uniform", "lognormal"), default="lognormal")
+    parser.add_argument("--ai-sigma", type=float, default=0.5, help="разброс lognormal")
+    parser.add_argument("--ai-slow-rate", type=float, default=0.0)
+    parser.add_argument("--ai-slow-latency", type=float, default=5.0)
+    parser.add_argument("--ai-error-rate", type=float, default=0.0)
+    parser.add_argument("--ai-connections", type=int, help="GROQ_MAX_CONNECTIONS (по умолчанию 20)")
+    parser.add_argument("--ai-limits", action="store_true",
+                        help="оставить лимиты AI_REQUESTS_PER_MINUTE и т.п.")
+    parser.add_argument("--token-delay", type=float, default=0.02, help="между словами потока (с)")
+    parser.add_argument("--tg-latency", type=float, default=0.0, help="задержка фейкового Bot API (с)")
+    parser.add_argument("--tg-limits", action="store_true",
+                        help="оставить лимит TELEGRAM_SENDS_PER_SECOND")
+
+    parser.add_argument("--reply-timeout", type=float, default=60.0)
+    parser.add_argument("--db", help="файл БД (по умолчанию временный)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="результат одной JSON-строкой")
+    args = parser.parse_args()
+
+    result = asyncio.run(LoadTest(args).run())
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+# ================================
+# metrics.py
+# Метрики в формате Prometheus (/metrics)
+# и структурный лог времени каждого хода
+# ================================
+
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+log = logging.getLogger(__name__)
+
+
+# ================================
+# Настройки
+# ================================
+# Писать JSON-строку с разбивкой времени на каждый ход
+TURN_TIMING_LOG = os.getenv("TURN_TIMING_LOG", "1") == "1"
+
+# Игрок считается активным столько секунд после последнего хода
+ACTIVE_SESSION_WINDOW = float(os.getenv("ACTIVE_SESSION_WINDOW", 300))
+
+# Границы корзин гистограмм (секунды)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30)
+
+
+# ================================
+# Типы метрик
+# ================================
+def _labels(names, values):
+    if not names:
+        return ""
+
+    pairs = (f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return lines
+
+    def samples(self):
+        return []
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def merge(self, key, value):
+        self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+
+
+class Gauge(Metric):
+    """
+    Значение задаётся set() или считается функцией
+    source() в момент запроса /metrics.
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), source=None):
+        super().__init__(name, help, labels)
+        self.values = {}
+        self.source = source
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def samples(self):
+        values = self.values
+        if self.source is not None:
+            values = {(): self.source()} if not self.label_names else self.source()
+
+        for key, value in values.items():
+            yield f"{self.name}{_labels(self.label_names, key)} {_number(value)}"
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        counts = entry[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+
+        entry[1] += value
+        entry[2] += 1
+
+    def merge(self, key, value):
+        counts, total, count = value
+
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+
+        entry[0] = [a + b for a, b in zip(entry[0], counts)]
+        entry[1] += total
+        entry[2] += count
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self):
+        names = self.label_names + ("le",)
+
+        for key, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket{_labels(names, key + (_number(bound),))} {cumulative}"
+
+            labels = _labels(self.label_names, key)
+            yield f"{self.name}_sum{labels} {_number(total)}"
+            yield f"{self.name}_count{labels} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+# ================================
+# Метрики бота
+# ================================
+turn_seconds = registry.register(Histogram(
+    "horror_turn_seconds", "Время хода игрока целиком"
+))
+stage_seconds = registry.register(Histogram(
+    "horror_turn_stage_seconds", "Время этапа хода", ("stage",)
+))
+ai_request_seconds = registry.register(Histogram(
+    "horror_ai_request_seconds", "Время запроса к модели AI (для потока — до первого куска)",
+    ("model",)
+))
+ai_tokens = registry.register(Counter(
+    "horror_ai_tokens_total", "Токены промпта (in) и ответа (out)", ("model", "direction")
+))
+errors = registry.register(Counter(
+    "horror_errors_total", "Ошибки по типам", ("type",)
+))
+updates = registry.register(Counter(
+    "horror_updates_total", "Апдейты Telegram по типам", ("type",)
+))
+
+
+class ActivePlayers:
+    """
+    Игроки, делавшие ход за последние ACTIVE_SESSION_WINDOW секунд.
+    """
+
+    def __init__(self, window=ACTIVE_SESSION_WINDOW):
+        self.window = window
+        self._seen = {}
+
+    def touch(self, user_id):
+        self._seen.pop(user_id, None)
+        self._seen[user_id] = time.monotonic()
+
+    def count(self):
+        # dict хранит порядок вставки: самые старые — в начале
+        cutoff = time.monotonic() - self.window
+        while self._seen:
+            user_id, seen = next(iter(self._seen.items()))
+            if seen >= cutoff:
+                break
+            del self._seen[user_id]
+
+        return len(self._seen)
+
+    def since(self, moment):
+        """
+        Игроки, делавшие ход после moment (time.monotonic()).
+        """
+
+        # Заодно забываем тех, кто вышел из окна
+        self.count()
+
+        users = []
+        for user_id, seen in reversed(self._seen.items()):
+            if seen < moment:
+                break
+            users.append(user_id)
+
+        return users
+
+
+active_players = ActivePlayers()
+
+registry.register(Gauge(
+    "horror_active_sessions", "Игроки, делавшие ход за последние ACTIVE_SESSION_WINDOW секунд",
+    source=active_players.count
+))
+
+
+def add_gauge(name, help, source, labels=()):
+    """
+    Метрика, значение которой берётся из source()
+    при каждом запросе /metrics.
+    """
+
+    registry.register(Gauge(name, help, labels, source))
+
+
+# ================================
+# Метрики рабочих процессов (worker.py)
+# ================================
+def snapshot(since):
+    """
+    Счётчики и гистограммы, накопленные с прошлого вызова
+    (после вызова обнуляются), и игроки, ходившие после since.
+    Рабочий процесс отправляет это боту, тот складывает
+    в свой registry через merge().
+    """
+
+    data = {"metrics": {}, "players": active_players.since(since)}
+
+    for metric in registry.metrics:
+        if isinstance(metric, (Counter, Histogram)) and metric.values:
+            data["metrics"][metric.name] = [[list(key), value] for key, value in metric.values.items()]
+            metric.values = {}
+
+    return data
+
+
+def merge(data):
+    by_name = {metric.name: metric for metric in registry.metrics}
+
+    for name, values in data["metrics"].items():
+        metric = by_name.get(name)
+        if metric is not None:
+            for key, value in values:
+                metric.merge(tuple(key), value)
+
+    for user_id in data["players"]:
+        active_players.touch(user_id)
+
+
+# ================================
+# Время этапов хода
+# ================================
+_turn = ContextVar("turn_timing", default=None)
+
+
+@contextmanager
+def turn_timing(user_id, story_id):
+    """
+    Замеряет ход целиком. Этапы (stage) внутри попадают
+    и в гистограммы, и в JSON-строку лога этого хода.
+    """
+
+    stages, fields = {}, {}
+    token = _turn.set((stages, fields))
+    active_players.touch(user_id)
+    started = time.perf_counter()
+
+    try:
+        yield
+    except BaseException as e:
+        fields["error"] = type(e).__name__
+        raise
+    finally:
+        _turn.reset(token)
+        total = time.perf_counter() - started
+        turn_seconds.observe(total)
+
+        if TURN_TIMING_LOG:
+            record = {
+                "event": "turn",
+                "user_id": user_id,
+                "story_id": story_id,
+                "total_ms": round(total * 1000, 1),
+                **{f"{name}_ms": round(value * 1000, 1) for name, value in stages.items()},
+                **fields
+            }
+            log.info(json.dumps(record, ensure_ascii=False))
+
+
+@contextmanager
+def stage(name):
+    """
+    with stage("db_write"): ...
+    Повторные замеры одного этапа за ход складываются.
+    """
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=name)
+
+        turn = _turn.get()
+        if turn is not None:
+            turn[0][name] = turn[0].get(name, 0.0) + elapsed
+
+
+def note(name, value):
+    """
+    Дополнительное поле в лог хода (модель, токены, кэш...).
+    """
+
+    turn = _turn.get()
+    if turn is not None:
+        turn[1][name] = value
+
+
+def error(kind):
+    errors.inc(type=kind)
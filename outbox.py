@@ -0,0 +1,275 @@
+# ================================
+# outbox.py
+# Исходящие сообщения в Telegram:
+# очередь на каждый чат, общий лимит отправок,
+# повтор после 429 (retry_after), склейка сообщений
+# ================================
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError
+)
+
+import metrics
+from ratelimit import TokenBucket
+
+
+log = logging.getLogger(__name__)
+
+
+# ================================
+# Настройки
+# ================================
+# Не больше стольких отправок в секунду на бота
+# (у Telegram — около 30) и размер всплеска
+TELEGRAM_SENDS_PER_SECOND = float(os.getenv("TELEGRAM_SENDS_PER_SECOND", 25))
+TELEGRAM_SENDS_BURST = int(os.getenv("TELEGRAM_SENDS_BURST", 30))
+
+# Сколько раз повторять отправку после 429 или сетевой ошибки
+OUTBOX_RETRIES = int(os.getenv("OUTBOX_RETRIES", 5))
+
+# Сколько ждать отправки оставшегося при остановке (с)
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv("OUTBOX_DRAIN_TIMEOUT", 10))
+
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+# Между склеенными сообщениями
+SEPARATOR = "\n\n"
+
+
+def split_text(text, limit=MESSAGE_LIMIT):
+    """
+    Режет длинный текст на части не длиннее limit,
+    по возможности по переводу строки.
+    """
+
+    parts = []
+
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+
+    parts.append(text)
+    return parts
+
+
+class Outbox:
+    """
+    send() ставит сообщение в очередь чата и сразу возвращает
+    Future (Message или None, если отправить не удалось).
+
+    Сообщения одного чата уходят строго по порядку. Всё, что
+    накопилось в очереди чата, пока он ждал лимита, уходит одним
+    сообщением (кнопки — только у последнего). Все чаты делят
+    общий лимит отправок; 429 от Telegram останавливает
+    отправку всем на retry_after секунд.
+    """
+
+    def __init__(self, rate=TELEGRAM_SENDS_PER_SECOND, burst=TELEGRAM_SENDS_BURST,
+                 retries=OUTBOX_RETRIES):
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.paused_until = 0.0
+
+        # chat_id -> deque[(text, reply_markup, future)]
+        self._queues = {}
+        self._workers = {}
+
+        self.sent = 0
+        self.merged = 0
+        self.retried = 0
+        self.failed = 0
+
+    # ----------------------------
+    # Постановка в очередь
+    # ----------------------------
+    def send(self, bot, chat_id, text, reply_markup=None):
+        future = asyncio.get_running_loop().create_future()
+
+        queue = self._queues.get(chat_id)
+        if queue is None:
+            queue = self._queues[chat_id] = deque()
+
+        parts = split_text(text)
+        for part in parts[:-1]:
+            queue.append((part, None, None))
+        queue.append((parts[-1], reply_markup, future))
+
+        if chat_id not in self._workers:
+            self._workers[chat_id] = asyncio.create_task(self._drain(bot, chat_id))
+
+        return future
+
+    def pending(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    async def idle(self, chat_id):
+        """
+        Ждёт, пока в чат уйдёт всё, что стоит в очереди
+        (перед отправкой мимо очереди, например потоком).
+        """
+
+        worker = self._workers.get(chat_id)
+        if worker is not None:
+            await asyncio.shield(worker)
+
+    # ----------------------------
+    # Общий лимит
+    # ----------------------------
+    async def throttle(self):
+        """
+        Ждёт места в общем лимите отправок и конца паузы после 429.
+        """
+
+        while True:
+            wait = max(self.paused_until - time.monotonic(), self.bucket.wait_time(1))
+            if wait <= 0:
+                self.bucket.take(1)
+                return
+            await asyncio.sleep(wait)
+
+    def retry_after(self, seconds):
+        """
+        Telegram ответил 429: пауза для всех чатов.
+        """
+
+        metrics.error("telegram_retry_after")
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # ----------------------------
+    # Отправка
+    # ----------------------------
+    def _take(self, queue):
+        """
+        Первое сообщение очереди и все следующие, которые
+        влезают с ним в одно: (text, reply_markup, [futures]).
+        """
+
+        text, markup, future = queue.popleft()
+        futures = [future]
+
+        while queue and markup is None:
+            nxt_text, nxt_markup, nxt_future = queue[0]
+            if len(text) + len(SEPARATOR) + len(nxt_text) > MESSAGE_LIMIT:
+                break
+
+            queue.popleft()
+            text = text + SEPARATOR + nxt_text
+            markup = nxt_markup
+            futures.append(nxt_future)
+            self.merged += 1
+
+        return text, markup, futures
+
+    async def _drain(self, bot, chat_id):
+        queue = self._queues[chat_id]
+
+        try:
+            while queue:
+                # Пока ждём лимит, в очередь могут прийти ещё сообщения
+                await self.throttle()
+
+                text, markup, futures = self._take(queue)
+
+                # Этап хода telegram_send — сама отправка с повторами,
+                # без ожидания в очереди (ход её не ждёт)
+                started = time.perf_counter()
+                message = await self._deliver(bot, chat_id, text, markup)
+                metrics.stage_seconds.observe(time.perf_counter() - started, stage="telegram_send")
+
+                for future in futures:
+                    if future is not None and not future.done():
+                        future.set_result(message)
+        finally:
+            # Если остановлены (cancel) — оставшимся ждать нечего
+            for _, _, future in queue:
+                if future is not None and not future.done():
+                    future.set_result(None)
+
+            del self._workers[chat_id]
+            del self._queues[chat_id]
+
+    async def _deliver(self, bot, chat_id, text, markup):
+        for attempt in range(self.retries + 1):
+            try:
+                message = await bot.send_message(chat_id, text, reply_markup=markup)
+                self.sent += 1
+                return message
+
+            except TelegramRetryAfter as e:
+                self.retry_after(e.retry_after)
+
+            except (TelegramNetworkError, TelegramServerError) as e:
+                metrics.error("telegram_network")
+                log.warning("Не удалось отправить в чат %s: %s", chat_id, e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                # Бот заблокирован, чат удалён, неверный текст — повтор не поможет
+                metrics.error("telegram_rejected")
+                log.warning("Telegram не принял сообщение в чат %s: %s", chat_id, e)
+                break
+
+            except Exception:
+                log.exception("Ошибка отправки в чат %s", chat_id)
+                break
+
+            if attempt < self.retries:
+                self.retried += 1
+                await self.throttle()
+
+        self.failed += 1
+        metrics.error("telegram_send_failed")
+        return None
+
+    async def close(self, timeout=OUTBOX_DRAIN_TIMEOUT):
+        """
+        Дожидается отправки очередей (не дольше timeout),
+        остальное отменяет.
+        """
+
+        workers = list(self._workers.values())
+        if not workers:
+            return
+
+        _, pending = await asyncio.wait(workers, timeout=timeout)
+        for worker in pending:
+            worker.cancel()
+
+        if pending:
+            log.warning("При остановке не отправлены сообщения в %d чатов", len(pending))
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "chats": len(self._workers),
+            "pending": self.pending(),
+            "sent": self.sent,
+            "merged": self.merged,
+            "retried": self.retried,
+            "failed": self.failed
+        }
+
+
+outbox = Outbox()
+
+
+def answer(message, text, reply_markup=None):
+    """
+    Как message.answer(), но через очередь: не ждёт отправки.
+    """
+
+    return outbox.send(message.bot, message.chat.id, text, reply_markup)
@@ -0,0 +1,414 @@
+# ================================
+# prompts.py
+# Сборка промпта Horror-Studio Engine
+# ================================
+
+import functools
+import math
+import os
+import re
+
+from cache import LRUCache
+
+
+# ================================
+# Бюджет контекста (в токенах)
+# ================================
+# Весь промпт: system + диалог + новое сообщение игрока
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
+
+# Служебные токены на каждое chat-сообщение (роль, разделители)
+MESSAGE_OVERHEAD = 4
+
+# Старое сообщение обрезается, только если от него останется
+# хотя бы столько токенов; иначе оно отбрасывается целиком
+MIN_TRUNCATED_TOKENS = 24
+
+# Новое сообщение игрока может занять не больше этой доли
+# оставшегося бюджета, чтобы в промпте осталась память диалога
+MAX_USER_MESSAGE_SHARE = 0.5
+
+# Эта доля бюджета всегда остаётся диалогу и сообщению игрока:
+# слишком большая история или много персонажей урезаются
+MIN_DIALOG_SHARE = 0.25
+
+TRUNCATION_MARK = "…"
+
+
+# ================================
+# SYSTEM PROMPT Horror-Studio V3 (статичная часть)
+# ================================
+RULES = """
+Ты — Horror-Studio Engine.
+
+Ты создаёшь НЕ рассказ.
+Ты создаёшь реалистичную переписку в Telegram.
+
+====================================================
+❗ ЖЁСТКИЕ ПРАВИЛА:
+
+1. Формат ответа:
+Имя: сообщение
+
+2. Только чат. Никаких описаний автора.
+НЕ пиши: "он пошёл", "вдруг случилось", "сцена".
+
+3. Сообщения короткие и живые.
+Как настоящие люди в Telegram.
+
+4. Максимум 2–4 сообщения за ответ.
+
+5. Персонажи НЕ могут внезапно умирать,
+если это не было событием сюжета.
+
+6. Всегда соблюдай логику:
+- кто рядом
+- кто жив
+- что происходило в последних сообщениях
+
+7. Не придумывай новых персонажей.
+
+8. Атмосфера должна быть:
+напряжённой, страшной, реалистичной.
+
+====================================================
+"""
+
+STORY_TEMPLATE = """
+📖 История:
+Название: {title}
+
+Описание автора:
+{description}
+
+Прошлое героя:
+{hero_past}
+
+Начальная сцена:
+{start_scene}
+
+Персонажи:
+{characters}
+====================================================
+
+Дальше — переписка с игроком (память).
+Сообщения игрока приходят от user, твои ответы — assistant.
+Отвечай на последнее сообщение игрока как настоящая переписка.
+"""
+
+
+SUMMARY_TEMPLATE = """
+====================================================
+Что было раньше (краткое содержание старой переписки):
+{summary}
+====================================================
+"""
+
+SUMMARY_RULES = """
+Ты ведёшь краткий конспект хоррор-переписки в Telegram.
+Тебе дают прежний конспект и новые сообщения.
+Верни обновлённый конспект: кто где находится, кто жив,
+что уже произошло, какие тайны и угрозы открыты.
+Пиши сжато, фактами, без диалогов, не больше 10 пунктов.
+"""
+
+
+# ================================
+# Приблизительный токенайзер
+# ================================
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+
+@functools.lru_cache(maxsize=8192)
+def approx_tokens(text):
+    """
+    Оценка числа токенов без настоящего токенайзера.
+    Латиница ~4 символа на токен, кириллица и прочее ~2.5,
+    каждый знак препинания — отдельный токен.
+    Оценка с запасом: реальное число обычно меньше.
+    Сообщения диалога повторяются от хода к ходу,
+    поэтому результат кэшируется.
+    """
+
+    if not text:
+        return 0
+
+    return _count_tokens(text)
+
+
+def _count_tokens(text):
+    return sum(_word_tokens(match.group()) for match in _TOKEN_RE.finditer(text))
+
+
+def _word_tokens(word):
+    if word.isascii():
+        return math.ceil(len(word) / 4)
+    return math.ceil(len(word) / 2.5)
+
+
+def truncate_to_tokens(text, budget, keep="tail"):
+    """
+    Обрезает текст, чтобы он уложился в budget токенов.
+    keep="tail" — оставить конец, keep="head" — начало.
+    """
+
+    if approx_tokens(text) <= budget:
+        return text
+
+    # Один проход по токенам (с нужного конца): сколько символов влезает
+    limit = budget - 1
+    if limit < 0:
+        return ""
+
+    matches = list(_TOKEN_RE.finditer(text))
+    if keep == "tail":
+        matches.reverse()
+
+    low = len(text)
+    for match in matches:
+        word = match.group()
+        cost = _word_tokens(word)
+        if cost <= limit:
+            limit -= cost
+            continue
+
+        # Влезает только часть слова: двоичный поиск по её длине
+        chars, high = 0, min(len(word), limit * 4)
+        while chars < high:
+            mid = (chars + high + 1) // 2
+            part = word[-mid:] if keep == "tail" else word[:mid]
+            if _word_tokens(part) <= limit:
+                chars = mid
+            else:
+                high = mid - 1
+
+        low = match.start() + chars if keep != "tail" else len(text) - match.end() + chars
+        break
+
+    if not low:
+        return ""
+
+    if keep == "tail":
+        return TRUNCATION_MARK + text[-low:]
+    return text[:low] + TRUNCATION_MARK
+
+
+def fit_context(context, budget):
+    """
+    Берёт самые свежие сообщения, пока они влезают в budget.
+    Первое не влезающее сообщение обрезается с начала
+    (если от него остаётся достаточно), более старые отбрасываются.
+    """
+
+    fitted = []
+
+    for sender, text in reversed(context):
+        cost = approx_tokens(text) + MESSAGE_OVERHEAD
+
+        if cost <= budget:
+            fitted.append((sender, text))
+            budget -= cost
+            continue
+
+        room = budget - MESSAGE_OVERHEAD
+        if room >= MIN_TRUNCATED_TOKENS:
+            fitted.append((sender, truncate_to_tokens(text, room, keep="tail")))
+        break
+
+    fitted.reverse()
+    return fitted
+
+
+def share_tokens(texts, budget):
+    """
+    Делит budget между текстами: короткие берут сколько
+    нужно, остаток поровну достаётся длинным, а они
+    обрезаются с конца.
+    """
+
+    sizes = [approx_tokens(text) for text in texts]
+    shares = [0] * len(texts)
+    left = max(budget, 0)
+
+    order = sorted(range(len(texts)), key=sizes.__getitem__)
+    for n, i in enumerate(order):
+        shares[i] = min(sizes[i], left // (len(order) - n))
+        left -= shares[i]
+
+    return [truncate_to_tokens(text, share, keep="head") for text, share in zip(texts, shares)]
+
+
+# ================================
+# Сборщик промпта
+# ================================
+class PromptBuilder:
+    """
+    Статичный блок (правила + история + персонажи) рендерится
+    один раз на историю и кэшируется по story_id.
+    На каждом ходе добавляется только хвост диалога
+    отдельными сообщениями user/assistant — так префикс
+    одинаков от хода к ходу и провайдер может его кэшировать.
+    """
+
+    def __init__(self, maxsize=256, budget=CONTEXT_TOKEN_BUDGET):
+        self.cache = LRUCache(maxsize)
+        self.budget = budget
+
+        # Потолок статичного блока вместе с его служебными токенами
+        self.system_budget = budget - int(budget * MIN_DIALOG_SHARE)
+
+    def system_prompt(self, story_id, story, characters):
+        """
+        Статичный system-блок истории и его размер в токенах
+        (из кэша, если история и персонажи не менялись).
+        Блок не больше system_budget.
+        """
+
+        entry = self.cache.get(story_id)
+        if entry is not None and entry[0] == story and entry[1] == characters:
+            return entry[2], entry[3]
+
+        text = render_system_prompt(story, characters, self.system_budget - MESSAGE_OVERHEAD)
+        tokens = approx_tokens(text) + MESSAGE_OVERHEAD
+        self.cache.set(story_id, (story, characters, text, tokens))
+        return text, tokens
+
+    def build_messages(self, story_id, story, characters, dialog_context, user_message,
+                       summary=None):
+        """
+        Список chat-сообщений для OpenAI-совместимого API,
+        уложенный в бюджет токенов.
+        summary — краткое содержание сообщений старше окна памяти.
+        """
+
+        messages, _, context, user_message = self._pack(
+            story_id, story, characters, dialog_context, user_message, summary
+        )
+
+        messages.extend(
+            {"role": "user" if sender == "player" else "assistant", "content": text}
+            for sender, text in context
+        )
+        messages.append({"role": "user", "content": user_message})
+
+        return messages
+
+    def kept_messages(self, story_id, story, characters, dialog_context, user_message,
+                      summary=None):
+        """
+        Сколько последних сообщений dialog_context попадёт в промпт
+        целиком (обрезанное не считается). Всё, что старше, должно
+        быть в конспекте.
+        """
+
+        _, source, context, _ = self._pack(
+            story_id, story, characters, dialog_context, user_message, summary
+        )
+
+        kept = 0
+        for fitted, original in zip(reversed(context), reversed(source)):
+            if fitted[1] != original[1]:
+                break
+            kept += 1
+
+        # Сообщение игрока, совпавшее с последним в контексте, — тоже в промпте
+        return kept + len(dialog_context) - len(source)
+
+    def _pack(self, story_id, story, characters, dialog_context, user_message, summary):
+        """
+        (system-сообщения, хвост диалога до упаковки,
+        упакованный хвост, сообщение игрока).
+        """
+
+        system, budget = self.system_prompt(story_id, story, characters)
+        budget = self.budget - budget
+
+        messages = [{"role": "system", "content": system}]
+
+        # Конспект меняется редко — идёт сразу за статичным блоком
+        if summary:
+            summary = truncate_to_tokens(
+                SUMMARY_TEMPLATE.format(summary=summary),
+                max(budget // 3 - MESSAGE_OVERHEAD, 0),
+                keep="head"
+            )
+            messages.append({"role": "system", "content": summary})
+            budget -= approx_tokens(summary) + MESSAGE_OVERHEAD
+
+        # Сообщение игрока обычно уже сохранено и есть в контексте
+        source = list(dialog_context)
+        if source and tuple(source[-1]) == ("player", user_message):
+            source.pop()
+
+        # Новое сообщение игрока важнее старых: место под него — первым
+        room = int(budget * MAX_USER_MESSAGE_SHARE) - MESSAGE_OVERHEAD
+        user_message = truncate_to_tokens(user_message or "", max(room, 0), keep="head")
+        budget -= approx_tokens(user_message) + MESSAGE_OVERHEAD
+
+        return messages, source, fit_context(source, budget), user_message
+
+
+def render_system_prompt(story, characters, budget=None):
+    """
+    Статичный system-блок. Если он не влезает в budget токенов,
+    правила остаются целиком, а описание, прошлое героя,
+    сцена и анкеты персонажей урезаются.
+    """
+
+    title, description, hero_past, start_scene = story
+
+    # Персонажи (анкеты)
+    char_text = "".join(
+        f"- {name}: {role}, характер: {personality}, статус: {known}\n"
+        for name, role, personality, known in characters
+    )
+
+    fields = {
+        "title": title,
+        "description": description,
+        "hero_past": hero_past,
+        "start_scene": start_scene,
+        "characters": char_text
+    }
+
+    text = RULES + STORY_TEMPLATE.format(**fields)
+    if budget is None or approx_tokens(text) <= budget:
+        return text
+
+    room = budget - approx_tokens(RULES + STORY_TEMPLATE.format(**dict.fromkeys(fields, "")))
+    fields = dict(zip(fields, share_tokens(list(fields.values()), room)))
+
+    # Разметка на стыках может дать лишний токен-другой
+    return truncate_to_tokens(RULES + STORY_TEMPLATE.format(**fields), budget, keep="head")
+
+
+def build_summary_messages(previous, dialog):
+    """
+    Промпт для обновления конспекта:
+    прежний конспект + сообщения, вышедшие из окна памяти.
+    """
+
+    lines = "\n".join(
+        f"{'Игрок' if sender == 'player' else 'Персонажи'}: {text}"
+        for sender, text in dialog
+    )
+
+    return [
+        {"role": "system", "content": SUMMARY_RULES},
+        {"role": "user", "content": "".join((
+            "Прежний конспект:\n", previous or "(пусто)",
+            "\n\nНовые сообщения:\n", lines,
+            "\n\nОбнови конспект."
+        ))}
+    ]
+
+
+def count_prompt_tokens(messages):
+    """
+    Оценка размера готового промпта в токенах.
+    """
+
+    return sum(approx_tokens(m["content"]) + MESSAGE_OVERHEAD for m in messages)
+
+
+prompt_builder = PromptBuilder()
@@ -0,0 +1,315 @@
+# ================================
+# ratelimit.py
+# Планировщик запросов к AI:
+# приоритетная очередь, лимиты запросов и токенов
+# в минуту, паузы по 429 и заголовкам x-ratelimit-*
+# ================================
+
+import asyncio
+import heapq
+import itertools
+import os
+import re
+import time
+from contextlib import asynccontextmanager
+
+
+# ================================
+# Настройки
+# ================================
+# Сколько запросов к AI одновременно
+AI_MAX_CONCURRENCY = int(os.getenv("AI_MAX_CONCURRENCY", 16))
+
+# Сколько запросов в минуту и размер всплеска
+AI_REQUESTS_PER_MINUTE = float(os.getenv("AI_REQUESTS_PER_MINUTE", 30))
+AI_BURST = int(os.getenv("AI_BURST", 10))
+
+# Сколько токенов (промпт + ответ) в минуту
+AI_TOKENS_PER_MINUTE = float(os.getenv("AI_TOKENS_PER_MINUTE", 6000))
+
+# Приоритеты: меньше — раньше
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+
+class TokenBucket:
+    """
+    rate токенов в секунду, не больше capacity про запас.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount):
+        """
+        Через сколько секунд наберётся amount токенов.
+        """
+
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def limit(self, remaining):
+        """
+        Сервер сообщил, сколько осталось на самом деле.
+        """
+
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+
+
+# ================================
+# Заголовки Groq
+# ================================
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+
+def parse_duration(value):
+    """
+    "2m59.56s", "7.66s", "120ms", "3" -> секунды (float) или None.
+    """
+
+    if not value:
+        return None
+
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    parts = _DURATION_RE.findall(value)
+    if not parts:
+        return None
+
+    return sum(float(number) * _UNITS[unit] for number, unit in parts)
+
+
+class ServerWindow:
+    """
+    Сколько запросов (или токенов) сервер ещё разрешает
+    до сброса окна — по последним x-ratelimit-* заголовкам.
+    """
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = 0.0
+
+    def wait_time(self, amount, in_flight):
+        if self.remaining is None:
+            return 0.0
+
+        now = time.monotonic()
+
+        # Окно сбросилось: снова доступен весь лимит
+        if now >= self.reset_at:
+            self.remaining = self.limit
+            self.reset_at = float("inf")
+            if self.remaining is None:
+                return 0.0
+
+        if self.remaining >= min(amount, self.limit or amount):
+            return 0.0
+
+        # Время сброса неизвестно и спросить не у кого — не ждём вечно
+        if self.reset_at == float("inf"):
+            if not in_flight:
+                self.remaining = None
+                return 0.0
+            return 0.05
+
+        return self.reset_at - now
+
+    def take(self, amount):
+        if self.remaining is not None:
+            self.remaining -= amount
+
+    def update(self, limit, remaining, reset):
+        if limit is not None:
+            self.limit = limit
+
+        # Ответы приходят не по порядку: в пределах окна
+        # сервер не знает о запросах, которые ещё в пути
+        if self.remaining is not None and time.monotonic() < self.reset_at:
+            remaining = min(remaining, self.remaining)
+
+        self.remaining = remaining
+        self.reset_at = time.monotonic() + reset if reset is not None else float("inf")
+
+
+def _header_float(headers, name):
+    value = headers.get(name)
+    if value is None:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+# ================================
+# Планировщик
+# ================================
+class AIScheduler:
+    """
+    Все запросы к AI проходят через slot(priority, tokens).
+    Запрос ждёт в приоритетной очереди, пока не будет:
+    свободного места (AI_MAX_CONCURRENCY), запроса и токенов
+    в минутных бюджетах, и пока не кончится пауза после 429.
+    Бюджеты подстраиваются под заголовки x-ratelimit-* ответа.
+    """
+
+    def __init__(self, concurrency=AI_MAX_CONCURRENCY, per_minute=AI_REQUESTS_PER_MINUTE,
+                 burst=AI_BURST, tokens_per_minute=AI_TOKENS_PER_MINUTE):
+        self.concurrency = concurrency
+        self.requests = TokenBucket(per_minute / 60, burst)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self.server = {"requests": ServerWindow(), "tokens": ServerWindow()}
+
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.max_waiting = 0
+        self.rate_limited = 0
+
+        self._queue = []
+        self._seq = itertools.count()
+        self._timer = None
+
+    # ----------------------------
+    # Очередь
+    # ----------------------------
+    @asynccontextmanager
+    async def slot(self, priority=PRIORITY_INTERACTIVE, tokens=0):
+        await self.acquire(priority, tokens)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    async def acquire(self, priority=PRIORITY_INTERACTIVE, tokens=0):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._seq), tokens, future))
+        self.max_waiting = max(self.max_waiting, len(self._queue))
+
+        self._dispatch()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            # Место уже выдано, но ждущий отменён — возвращаем
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def has_capacity(self):
+        """
+        Новый запрос уйдёт сразу: никто не ждёт в очереди
+        и есть свободное место.
+        """
+
+        return self.in_flight < self.concurrency and \
+            not any(not item[3].done() for item in self._queue)
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        while self._queue:
+            priority, seq, tokens, future = self._queue[0]
+
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+
+            if self.in_flight >= self.concurrency:
+                return
+
+            wait = max(
+                self.paused_until - time.monotonic(),
+                self.requests.wait_time(1),
+                self.tokens.wait_time(tokens),
+                self.server["requests"].wait_time(1, self.in_flight),
+                self.server["tokens"].wait_time(tokens, self.in_flight)
+            )
+            if wait > 0:
+                self._timer = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+
+            heapq.heappop(self._queue)
+            self.requests.take(1)
+            self.tokens.take(tokens)
+            self.server["requests"].take(1)
+            self.server["tokens"].take(tokens)
+            self.in_flight += 1
+            future.set_result(None)
+
+    # ----------------------------
+    # Обратная связь от сервера
+    # ----------------------------
+    def observe(self, headers):
+        """
+        Подстраивает бюджеты под x-ratelimit-* заголовки.
+        """
+
+        for kind, window in self.server.items():
+            remaining = _header_float(headers, f"x-ratelimit-remaining-{kind}")
+            if remaining is None:
+                continue
+
+            window.update(
+                _header_float(headers, f"x-ratelimit-limit-{kind}"),
+                remaining,
+                parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            )
+
+        self._dispatch()
+
+    def pause(self, seconds):
+        """
+        Сервер ответил 429: никто не идёт в API seconds секунд.
+        """
+
+        self.rate_limited += 1
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def settle(self, estimated, actual):
+        """
+        Возвращает в бюджет разницу между оценкой
+        токенов запроса и реальным расходом.
+        """
+
+        self.tokens.tokens = min(self.tokens.capacity, self.tokens.tokens + estimated - actual)
+
+    def stats(self):
+        return {
+            "waiting": sum(1 for item in self._queue if not item[3].done()),
+            "in_flight": self.in_flight,
+            "max_waiting": self.max_waiting,
+            "rate_limited": self.rate_limited,
+            "paused": round(max(self.paused_until - time.monotonic(), 0), 1)
+        }
+
+
+ai_scheduler = AIScheduler()
@@ -0,0 +1,175 @@
+# ================================
+# reply_cache.py
+# Кэш ответов AI для начала историй:
+# одинаковые первые ходы разных игроков
+# получают готовый ответ без запроса в Groq
+# ================================
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+
+import db
+from cache import LRUCache
+
+
+# ================================
+# Настройки
+# ================================
+# Выключить кэш ответов целиком (0), не глядя на истории
+REPLY_CACHE = os.getenv("REPLY_CACHE", "1") == "1"
+
+# Максимальный размер кэша в SQLite (байт текста ответов)
+REPLY_CACHE_MAX_BYTES = int(os.getenv("REPLY_CACHE_MAX_BYTES", 5_000_000))
+
+# Кэшировать ходы, перед которыми не больше стольких сообщений
+# (дальше переписки игроков расходятся и попаданий почти нет)
+REPLY_CACHE_MAX_CONTEXT = int(os.getenv("REPLY_CACHE_MAX_CONTEXT", 6))
+
+# Сколько секунд помнить, включён ли кэш у истории
+REPLY_CACHE_FLAG_TTL = float(os.getenv("REPLY_CACHE_FLAG_TTL", 60))
+
+_TRAILING = " \t\n.,!?…)"
+
+
+def normalize(text):
+    """
+    "  Привет!!! " и "привет" — один и тот же ход.
+    """
+
+    return " ".join((text or "").lower().split()).rstrip(_TRAILING)
+
+
+class ReplyCache:
+    """
+    Ключ — хэш нормализованного промпта: история, вся
+    (короткая) переписка, сообщение игрока, модель и температура.
+    Ответы лежат в SQLite, старые вытесняются по used_at,
+    когда кэш превышает max_bytes. Включается для каждой
+    истории отдельно (/reply_cache <id> on).
+
+    Одинаковые ходы, пришедшие одновременно, не идут в AI
+    каждый: первый генерирует, остальные ждут его ответ.
+    """
+
+    def __init__(self, allowed=REPLY_CACHE, max_bytes=REPLY_CACHE_MAX_BYTES,
+                 max_context=REPLY_CACHE_MAX_CONTEXT):
+        self.allowed = allowed
+        self.max_bytes = max_bytes
+        self.max_context = max_context
+        self.flags = LRUCache(10_000, REPLY_CACHE_FLAG_TTL)
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+        # key -> Future ответа, который сейчас генерируется
+        self._pending = {}
+
+    # ----------------------------
+    # Включение для истории
+    # ----------------------------
+    async def enabled(self, story_id):
+        return await self.flags.get_or_load(story_id, lambda: db.get_reply_caching(story_id))
+
+    async def set_enabled(self, story_id, enabled):
+        """
+        False, если такой истории нет.
+        """
+
+        self.flags.invalidate(story_id)
+        return await db.set_reply_caching(story_id, enabled)
+
+    # ----------------------------
+    # Ключ
+    # ----------------------------
+    async def key_for(self, story_id, dialog_context, user_message, summary, payload):
+        """
+        Ключ кэша или None, если ход не кэшируется:
+        кэш выключен (весь или у истории), переписка
+        уже длинная или есть конспект старых сообщений.
+        """
+
+        if not self.allowed or summary or len(dialog_context) > self.max_context:
+            return None
+
+        if not await self.enabled(story_id):
+            return None
+
+        prompt = {
+            "story_id": story_id,
+            "context": [(sender, normalize(text)) for sender, text in dialog_context],
+            "message": normalize(user_message),
+            "model": payload["model"],
+            "temperature": payload.get("temperature"),
+            "max_tokens": payload.get("max_tokens")
+        }
+        data = json.dumps(prompt, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    # ----------------------------
+    # Чтение и запись
+    # ----------------------------
+    async def get(self, key):
+        """
+        Ответ из кэша или None. Получивший None генерирует
+        ответ сам и обязательно вызывает put(), даже при
+        ошибке (с reply=None) — иначе его ждут другие.
+        """
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            reply = await asyncio.shield(pending)
+            return self._count(reply)
+
+        future = self._pending[key] = asyncio.get_running_loop().create_future()
+
+        try:
+            reply = await db.get_cached_reply(key, time.time())
+        except BaseException:
+            self._resolve(key, None)
+            raise
+
+        if reply is not None:
+            self._resolve(key, reply)
+
+        return self._count(reply)
+
+    async def put(self, key, story_id, reply):
+        """
+        Отдаёт ответ ждущим и, если он есть, кладёт в кэш.
+        """
+
+        self._resolve(key, reply)
+
+        if reply:
+            await db.put_cached_reply(key, story_id, reply, time.time(), self.max_bytes)
+
+    def _resolve(self, key, reply):
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(reply)
+
+    def _count(self, reply):
+        if reply is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.bytes_saved += len(reply.encode())
+        return reply
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / requests, 2) if requests else 0.0,
+            "bytes_saved": self.bytes_saved,
+            "generating": len(self._pending)
+        }
+
+
+reply_cache = ReplyCache()
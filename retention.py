@@ -0,0 +1,218 @@
+# ================================
+# retention.py
+# Архив старых диалогов: неактивные сессии
+# уходят из таблицы messages в сжатые блоки,
+# освободившееся место возвращается ОС
+#
+# Старую базу (до auto_vacuum = INCREMENTAL) один раз,
+# при остановленном боте: python retention.py convert
+# ================================
+
+import argparse
+import asyncio
+import logging
+import os
+import time
+
+import db
+
+
+log = logging.getLogger(__name__)
+
+
+# ================================
+# Настройки
+# ================================
+RETENTION = os.getenv("RETENTION", "1") == "1"
+
+# Архивировать сессию, если в ней не было сообщений столько дней...
+RETENTION_IDLE_DAYS = float(os.getenv("RETENTION_IDLE_DAYS", 14))
+
+# ...или столько, если игрок уже перешёл к другой истории
+RETENTION_FINISHED_DAYS = float(os.getenv("RETENTION_FINISHED_DAYS", 2))
+
+# Как часто проверять (с) и сколько найденных сессий
+# читать за раз (ищутся они один раз за проход)
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", 3600))
+RETENTION_BATCH = int(os.getenv("RETENTION_BATCH", 500))
+
+# incremental_vacuum по столько страниц за шаг,
+# чтобы не занимать поток БД надолго
+RETENTION_VACUUM_STEP = int(os.getenv("RETENTION_VACUUM_STEP", 256))
+
+
+def _utc(seconds_ago):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - seconds_ago))
+
+
+class Retention:
+    """
+    Фоновая задача: раз в interval секунд переносит неактивные
+    сессии в message_archive (по одной транзакции на сессию)
+    и по шагам делает incremental VACUUM.
+
+    Чтения (get_full_dialog, get_last_messages) склеивают
+    архив и таблицу messages сами, игрок ничего не замечает.
+    """
+
+    def __init__(self, idle_days=RETENTION_IDLE_DAYS, finished_days=RETENTION_FINISHED_DAYS,
+                 interval=RETENTION_INTERVAL, batch=RETENTION_BATCH,
+                 vacuum_step=RETENTION_VACUUM_STEP):
+        self.idle = idle_days * 86400
+        self.finished = finished_days * 86400
+        self.interval = interval
+        self.batch = batch
+        self.vacuum_step = vacuum_step
+
+        self.sessions = 0
+        self.messages = 0
+        self.bytes_raw = 0
+        self.bytes_archived = 0
+        self.pages_freed = 0
+        self.last_run = None
+
+        # None — режим auto_vacuum базы ещё не проверялся
+        self._incremental = None
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def close(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                log.exception("Архивация диалогов не удалась")
+
+            await asyncio.sleep(self.interval)
+
+    async def run_once(self):
+        """
+        Один проход: находит неактивные сессии (один запрос),
+        архивирует их и сжимает файл базы.
+        """
+
+        started = time.monotonic()
+
+        if self._incremental is None:
+            self._incremental = await db.incremental_vacuum_enabled()
+            if not self._incremental:
+                log.warning("База не в режиме auto_vacuum = INCREMENTAL, место после "
+                            "архивации не вернётся ОС. Один раз при остановленном боте: "
+                            "python retention.py convert")
+
+        sessions = messages = 0
+        after = 0
+
+        try:
+            found = await db.find_idle_sessions(_utc(self.idle), _utc(self.finished))
+
+            while found:
+                idle = await db.get_idle_sessions(after, self.batch)
+
+                for after, user_id, story_id, last_id in idle:
+                    count, raw, archived = await db.archive_session(user_id, story_id, last_id)
+                    sessions += 1
+                    messages += count
+                    self.bytes_raw += raw
+                    self.bytes_archived += archived
+
+                if len(idle) < self.batch:
+                    break
+        finally:
+            await db.forget_idle_sessions()
+
+        pages = await self.compact() if messages and self._incremental else 0
+
+        self.sessions += sessions
+        self.messages += messages
+        self.last_run = time.time()
+
+        if sessions:
+            log.info("В архив: %d сессий, %d сообщений; освобождено %d страниц за %.1f с",
+                     sessions, messages, pages, time.monotonic() - started)
+
+        return {"sessions": sessions, "messages": messages, "pages_freed": pages}
+
+    async def compact(self):
+        """
+        Возвращает ОС свободные страницы по vacuum_step за раз,
+        между шагами поток БД успевает выполнить другие запросы.
+        """
+
+        _, free, _ = await db.database_size()
+        freed = 0
+
+        while free:
+            left = await db.incremental_vacuum(self.vacuum_step)
+            if left >= free:
+                break
+            freed += free - left
+            free = left
+
+        await db.checkpoint()
+
+        self.pages_freed += freed
+        return freed
+
+    def stats(self):
+        return {
+            "sessions": self.sessions,
+            "messages": self.messages,
+            "ratio": round(self.bytes_archived / self.bytes_raw, 2) if self.bytes_raw else 0.0,
+            "pages_freed": self.pages_freed
+        }
+
+
+retention = Retention()
+
+
+# ================================
+# Запуск вручную
+# ================================
+async def run(args):
+    if args.db:
+        db.DB_NAME = args.db
+
+    await db.init_db()
+
+    started = time.perf_counter()
+    try:
+        if args.command == "convert":
+            converted = await db.enable_incremental_vacuum()
+            result = "переведена на auto_vacuum = INCREMENTAL" if converted \
+                else "уже в режиме auto_vacuum = INCREMENTAL"
+        else:
+            result = await Retention().run_once()
+    finally:
+        await db.close_db()
+
+    print(f"База {db.DB_NAME}: {result} за {time.perf_counter() - started:.2f} с")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Архив старых диалогов")
+    parser.add_argument("command", choices=("convert", "run"),
+                        help="convert — перевести старую базу на incremental vacuum "
+                             "(полный VACUUM, бот должен быть остановлен); "
+                             "run — один проход архивации")
+    parser.add_argument("--db", help=f"файл БД (по умолчанию {db.DB_NAME})")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,331 @@
+# ================================
+# router.py
+# Маршрутизация запросов к AI:
+# резервные модели, hedged-запросы,
+# circuit breaker и дедлайн на ход
+# ================================
+
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+
+import metrics
+from ratelimit import ai_scheduler
+
+
+log = logging.getLogger(__name__)
+
+
+# ================================
+# Настройки
+# ================================
+# Дедлайн на ответ (для потока — на первый кусок), секунды
+AI_DEADLINE = float(os.getenv("AI_DEADLINE", 25))
+
+# Задержка hedged-запроса, пока не набралась статистика (с)
+AI_HEDGE_DELAY = float(os.getenv("AI_HEDGE_DELAY", 3))
+
+# Не раньше стольких секунд, даже если p95 меньше
+AI_HEDGE_MIN_DELAY = float(os.getenv("AI_HEDGE_MIN_DELAY", 0.2))
+
+# По скольким последним ответам бэкенда считать p95
+AI_LATENCY_WINDOW = int(os.getenv("AI_LATENCY_WINDOW", 200))
+AI_LATENCY_MIN_SAMPLES = 20
+
+# Circuit breaker: столько ошибок подряд выводят бэкенд
+# из ротации на AI_BREAKER_COOLDOWN секунд
+AI_BREAKER_FAILURES = int(os.getenv("AI_BREAKER_FAILURES", 5))
+AI_BREAKER_COOLDOWN = float(os.getenv("AI_BREAKER_COOLDOWN", 15))
+
+
+def parse_backends(value, default_model):
+    """
+    "модель[@url],модель[@url]" -> [(model, url или None)].
+    Без url — основной GROQ_URL.
+    """
+
+    backends = []
+
+    for item in (value or "").split(","):
+        item = item.strip()
+        if not item:
+            continue
+
+        model, _, url = item.partition("@")
+        backends.append((model.strip() or default_model, url.strip() or None))
+
+    return backends or [(default_model, None)]
+
+
+# ================================
+# Бэкенд (модель + адрес)
+# ================================
+class Backend:
+    """
+    Модель на конкретном адресе: задержки последних
+    ответов и состояние circuit breaker.
+
+    closed    -> запросы идут
+    open      -> после AI_BREAKER_FAILURES ошибок подряд,
+                 запросы не идут AI_BREAKER_COOLDOWN секунд
+    half-open -> после паузы пропускается один пробный запрос:
+                 успех закрывает breaker, ошибка снова открывает
+    """
+
+    def __init__(self, model, url=None, failures=AI_BREAKER_FAILURES,
+                 cooldown=AI_BREAKER_COOLDOWN):
+        self.model = model
+        self.url = url
+        self.max_failures = failures
+        self.cooldown = cooldown
+
+        self.latencies = deque(maxlen=AI_LATENCY_WINDOW)
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+        self.requests = 0
+        self.errors = 0
+        self.wins = 0
+
+    @property
+    def name(self):
+        return self.model if self.url is None else f"{self.model}@{self.url}"
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def available(self):
+        state = self.state
+        return state == "closed" or (state == "half-open" and not self.probing)
+
+    def begin(self):
+        self.requests += 1
+        if self.opened_at is not None:
+            self.probing = True
+
+    def success(self, latency):
+        self.latencies.append(latency)
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self):
+        self.errors += 1
+        self.failures += 1
+        self.probing = False
+
+        if self.opened_at is not None or self.failures >= self.max_failures:
+            if self.opened_at is None:
+                log.warning("AI-бэкенд %s выведен из ротации", self.name)
+            self.opened_at = time.monotonic()
+
+    def abandon(self):
+        """
+        Запрос отменён (проиграл hedged-гонку или дедлайн):
+        ни успех, ни ошибка.
+        """
+
+        self.probing = False
+
+    def p95(self):
+        if len(self.latencies) < AI_LATENCY_MIN_SAMPLES:
+            return None
+
+        values = sorted(self.latencies)
+        return values[int(len(values) * 0.95)]
+
+    def hedge_delay(self):
+        p95 = self.p95()
+        if p95 is None:
+            return AI_HEDGE_DELAY
+        return max(p95, AI_HEDGE_MIN_DELAY)
+
+    def stats(self):
+        p95 = self.p95()
+        return {
+            "state": self.state,
+            "requests": self.requests,
+            "errors": self.errors,
+            "wins": self.wins,
+            "p95_ms": None if p95 is None else round(p95 * 1000)
+        }
+
+
+# ================================
+# Маршрутизатор
+# ================================
+class ModelRouter:
+    """
+    Запрос идёт в первый доступный бэкенд списка. Если он
+    ошибся — сразу в следующий; если не ответил за свой p95 —
+    параллельно запускается hedged-запрос в следующий, и
+    побеждает тот, кто ответит первым (второй отменяется).
+    Всё укладывается в дедлайн; после него — None.
+
+    retries — сколько раз можно пройти по кругу сверх
+    списка бэкендов; backoff(n) — пауза перед n-м кругом.
+    """
+
+    def __init__(self, backends, retries=0, backoff=None, deadline=AI_DEADLINE):
+        self.backends = [Backend(model, url) for model, url in backends]
+        self.retries = retries
+        self.backoff = backoff
+        self.deadline = deadline
+
+        self.hedged = 0
+        self.timeouts = 0
+        self.unavailable = 0
+
+    @property
+    def primary(self):
+        return self.backends[0]
+
+    def _plan(self):
+        """
+        Порядок попыток: доступные бэкенды по кругу.
+        """
+
+        healthy = [b for b in self.backends if b.available()]
+        if not healthy:
+            return []
+
+        attempts = max(len(healthy), self.retries + 1)
+        return [healthy[i % len(healthy)] for i in range(attempts)]
+
+    async def route(self, attempt, hedge=True):
+        """
+        attempt(backend) -> async-итератор ответа на этом бэкенде
+        (пустой, если ответа нет). Отдаёт элементы попытки, первой
+        выдавшей первый элемент; если никто не успел — ничего.
+        """
+
+        loop = asyncio.get_running_loop()
+        ends = loop.time() + self.deadline
+        plan = self._plan()
+        running = {}
+        winner = None
+        launched = 0
+
+        if not plan:
+            self.unavailable += 1
+            metrics.error("ai_all_backends_open")
+            return
+
+        def launch():
+            nonlocal launched
+
+            while launched < len(plan):
+                backend = plan[launched]
+                launched += 1
+
+                # Пробный запрос half-open бэкенда уже занят
+                if not backend.available():
+                    continue
+
+                backend.begin()
+                iterator = attempt(backend).__aiter__()
+                task = asyncio.ensure_future(iterator.__anext__())
+                running[task] = (backend, iterator, loop.time())
+                return True
+
+            return False
+
+        try:
+            launch()
+
+            while winner is None and running:
+                timeout = ends - loop.time()
+
+                # Hedged-запрос — только пока у AI есть свободные места
+                hedge_at = None
+                if hedge and len(running) == 1 and launched < len(plan) \
+                        and ai_scheduler.has_capacity():
+                    backend, _, started = next(iter(running.values()))
+                    hedge_at = started + backend.hedge_delay()
+                    timeout = min(timeout, hedge_at - loop.time())
+
+                done = set()
+                if timeout > 0:
+                    done, _ = await asyncio.wait(
+                        running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                    )
+
+                if not done:
+                    if loop.time() >= ends:
+                        self.timeouts += 1
+                        metrics.error("ai_deadline")
+                        return
+
+                    if launch():
+                        self.hedged += 1
+                    continue
+
+                failed = False
+                for task in done:
+                    backend, iterator, started = running.pop(task)
+
+                    try:
+                        first = task.result()
+                    except StopAsyncIteration:
+                        backend.failure()
+                        failed = True
+                        continue
+                    except Exception:
+                        log.exception("Ошибка запроса к %s", backend.name)
+                        backend.failure()
+                        failed = True
+                        continue
+
+                    backend.success(loop.time() - started)
+
+                    if winner is None:
+                        backend.wins += 1
+                        winner = (iterator, first)
+                    else:
+                        await iterator.aclose()
+
+                # Ошибка — сразу следующая попытка (на новом круге — с паузой)
+                if failed and winner is None and not running:
+                    circle = launched // len(set(plan))
+                    if circle and self.backoff is not None and launched < len(plan):
+                        delay = min(self.backoff(circle), ends - loop.time())
+                        if delay > 0:
+                            await asyncio.sleep(delay)
+                    launch()
+
+        finally:
+            for task, (backend, iterator, _) in running.items():
+                task.cancel()
+                backend.abandon()
+
+            if running:
+                await asyncio.gather(*running, return_exceptions=True)
+                for backend, iterator, _ in running.values():
+                    await iterator.aclose()
+
+        if winner is None:
+            return
+
+        iterator, first = winner
+        try:
+            yield first
+            async for item in iterator:
+                yield item
+        finally:
+            await iterator.aclose()
+
+    def stats(self):
+        return {
+            "hedged": self.hedged,
+            "timeouts": self.timeouts,
+            "unavailable": self.unavailable,
+            "backends": {b.name: b.stats() for b in self.backends}
+        }
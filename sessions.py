@@ -0,0 +1,167 @@
+# ================================
+# sessions.py
+# Состояние игроков и авторов:
+# FSM aiogram, активные истории, черновики персонажей.
+# Хранится в SQLite, читается из кэша в памяти.
+# ================================
+
+import json
+import os
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+import db
+from cache import LRUCache
+
+
+# ================================
+# Настройки
+# ================================
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 50_000))
+
+# Сколько секунд доверять кэшу. При нескольких инстансах
+# это максимальное время, за которое изменение, сделанное
+# другим инстансом, станет видно здесь.
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 60))
+
+
+# ================================
+# FSM-хранилище для Dispatcher
+# ================================
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в SQLite с write-through кэшем:
+    чтения обычно из памяти, каждая запись сразу уходит в БД.
+    """
+
+    def __init__(self, cache_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.cache = LRUCache(cache_size, ttl)
+
+    @staticmethod
+    def _key(key: StorageKey):
+        return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id}:{key.destiny}"
+
+    async def _entry(self, key):
+        """
+        [state, data] из кэша или из БД.
+        """
+
+        return await self.cache.get_or_load(key, lambda: self._load(key))
+
+    @staticmethod
+    async def _load(key):
+        row = await db.get_fsm(key)
+        if row is None:
+            return [None, {}]
+
+        state, data = row
+        return [state, json.loads(data) if data else {}]
+
+    async def _save(self, key, entry):
+        self.cache.set(key, entry)
+
+        try:
+            await db.set_fsm(key, entry[0], json.dumps(entry[1], ensure_ascii=False))
+        except BaseException:
+            self.cache.invalidate(key)
+            raise
+
+    async def set_state(self, key: StorageKey, state=None):
+        key = self._key(key)
+        entry = await self._entry(key)
+
+        state = state.state if isinstance(state, State) else state
+        await self._save(key, [state, entry[1]])
+
+    async def get_state(self, key: StorageKey):
+        return (await self._entry(self._key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data):
+        key = self._key(key)
+        entry = await self._entry(key)
+
+        await self._save(key, [entry[0], dict(data)])
+
+    async def get_data(self, key: StorageKey):
+        return dict((await self._entry(self._key(key)))[1])
+
+    async def close(self):
+        # Соединение с БД закрывает bot.main (db.close_db)
+        pass
+
+
+# ================================
+# Активные истории и черновики персонажей
+# ================================
+class SessionStore:
+    """
+    Какую историю играет игрок и какие персонажи
+    добавлены в черновик автора. Write-through кэш над SQLite.
+    """
+
+    def __init__(self, cache_size=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.active = LRUCache(cache_size, ttl)
+        self.drafts = LRUCache(cache_size, ttl)
+
+    # ----------------------------
+    # Активная история
+    # ----------------------------
+    async def get_active_story(self, user_id):
+        """
+        id истории или None, если игрок ничего не играет.
+        """
+
+        story_id = await self.active.get_or_load(
+            user_id, lambda: db.get_active_story(user_id)
+        )
+        return story_id or None
+
+    async def set_active_story(self, user_id, story_id):
+        self.active.set(user_id, story_id)
+
+        try:
+            await db.set_active_story(user_id, story_id)
+        except BaseException:
+            self.active.invalidate(user_id)
+            raise
+
+    # ----------------------------
+    # Черновик персонажей
+    # ----------------------------
+    async def get_draft(self, user_id):
+        draft = await self.drafts.get_or_load(user_id, lambda: self._load_draft(user_id))
+        return list(draft)
+
+    @staticmethod
+    async def _load_draft(user_id):
+        data = await db.get_draft_characters(user_id)
+        return json.loads(data) if data else []
+
+    async def set_draft(self, user_id, characters):
+        characters = list(characters)
+        self.drafts.set(user_id, characters)
+
+        try:
+            await db.set_draft_characters(user_id, json.dumps(characters, ensure_ascii=False))
+        except BaseException:
+            self.drafts.invalidate(user_id)
+            raise
+
+    async def add_to_draft(self, user_id, character):
+        draft = await self.get_draft(user_id)
+        draft.append(character)
+        await self.set_draft(user_id, draft)
+
+    async def clear_draft(self, user_id):
+        self.drafts.invalidate(user_id)
+        await db.set_draft_characters(user_id, None)
+
+    def stats(self):
+        return {
+            "active_stories": self.active.stats(),
+            "drafts": self.drafts.stats()
+        }
+
+
+session_store = SessionStore()
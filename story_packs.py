@@ -0,0 +1,354 @@
+# ================================
+# story_packs.py
+# Импорт и экспорт наборов историй (JSON, JSONL, YAML)
+# за один потоковый проход по файлу
+#
+# python story_packs.py export pack.jsonl
+# python story_packs.py import pack.jsonl
+# python story_packs.py import pack.yaml --db stories.db
+# ================================
+
+import argparse
+import asyncio
+import json
+import os
+import re
+import time
+
+import db
+
+
+# ================================
+# Настройки
+# ================================
+# Сколько историй записывать одной транзакцией
+STORY_PACK_BATCH = int(os.getenv("STORY_PACK_BATCH", 200))
+
+_CHUNK = 1 << 16
+
+# История в файле:
+# {"title": ..., "description": ..., "hero_past": ..., "start_scene": ...,
+#  "cache_replies": false,
+#  "characters": [{"name": ..., "role": ..., "age": ..., "personality": ...,
+#                  "known": "знакомый"}]}
+# age необязателен: как в боте, дописывается к роли
+
+
+def pack_format(path, fmt=None):
+    """
+    json, jsonl или yaml — явно или по расширению файла.
+    """
+
+    if fmt:
+        return fmt
+
+    ext = os.path.splitext(path)[1].lower()
+    if ext in (".yaml", ".yml"):
+        return "yaml"
+    if ext in (".jsonl", ".ndjson"):
+        return "jsonl"
+    return "json"
+
+
+def _yaml():
+    # PyYAML необязателен: нужен только для .yaml
+    try:
+        import yaml
+    except ImportError:
+        raise RuntimeError("Для YAML нужен PyYAML: pip install pyyaml") from None
+    return yaml
+
+
+# ================================
+# Чтение
+# ================================
+# Начала значений, которые может разрезать граница чтения
+_LITERALS = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+_NUMBER_START = re.compile(r"-?(\d+(\.\d*)?([eE][+-]?\d*)?)?")
+_LAST_TOKEN = re.compile(r"[-+.\w]*$")
+
+
+def _incomplete(e, buf):
+    """
+    Ошибка raw_decode из-за того, что элемент ещё не дочитан
+    (а не из-за неверного JSON).
+    """
+
+    tail = buf[e.pos:].rstrip()
+    if not tail or e.msg.startswith("Unterminated string"):
+        return True
+    if e.msg.startswith("Invalid \\uXXXX escape"):
+        return len(tail) < 6
+
+    # Число или литерал, оборванные на конце буфера: «1500.» разбирается
+    # как 1500, и ошибка указывает уже на точку
+    token = _LAST_TOKEN.search(buf)
+    if e.pos < token.start():
+        return False
+    token = token.group()
+    return bool(
+        _NUMBER_START.fullmatch(token)
+        or any(literal.startswith(token) for literal in _LITERALS)
+    )
+
+
+def read_json_array(f):
+    """
+    Элементы JSON-массива по одному, не загружая файл целиком.
+    """
+
+    decoder = json.JSONDecoder()
+    buf = ""
+    started = False
+
+    # Сколько символов файла уже разобрано и сколько элементов прочитано
+    offset = 0
+    number = 0
+
+    for chunk in iter(lambda: f.read(_CHUNK), ""):
+        buf += chunk
+
+        while True:
+            stripped = buf.lstrip()
+            offset += len(buf) - len(stripped)
+            buf = stripped
+            if not buf:
+                break
+
+            if not started:
+                if buf[0] != "[":
+                    raise ValueError("Ожидался JSON-массив историй")
+                buf = buf[1:]
+                offset += 1
+                started = True
+                continue
+
+            if buf[0] == ",":
+                buf = buf[1:]
+                offset += 1
+                continue
+
+            if buf[0] == "]":
+                return
+
+            try:
+                item, end = decoder.raw_decode(buf)
+            except json.JSONDecodeError as e:
+                if _incomplete(e, buf):
+                    break
+                raise ValueError(
+                    f"История №{number + 1}: неверный JSON в символе {offset + e.pos}: {e.msg}"
+                ) from None
+
+            number += 1
+            yield item
+            buf = buf[end:]
+            offset += end
+
+    raise ValueError("JSON-массив историй оборван")
+
+
+def read_pack(f, fmt):
+    """
+    Истории из файла по одной (словари).
+    """
+
+    if fmt == "jsonl":
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+    elif fmt == "yaml":
+        # Документ — история или список историй
+        yaml = _yaml()
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+        for document in yaml.load_all(f, Loader=loader):
+            if isinstance(document, list):
+                yield from document
+            elif document is not None:
+                yield document
+
+    else:
+        yield from read_json_array(f)
+
+
+def story_row(item, number):
+    """
+    Словарь из файла -> строка для db.add_stories.
+    """
+
+    if not isinstance(item, dict) or not item.get("title") or not item.get("start_scene"):
+        raise ValueError(f"История №{number}: нужны title и start_scene")
+
+    characters = []
+    for c in item.get("characters") or []:
+        if not isinstance(c, dict) or not c.get("name"):
+            raise ValueError(f"История №{number}: у персонажа нет name")
+
+        role = c.get("role", "")
+        if c.get("age"):
+            role = f"{role} ({c['age']} лет)"
+
+        characters.append((c["name"], role, c.get("personality", ""), c.get("known", "незнакомый")))
+
+    return (
+        item["title"],
+        item.get("description", ""),
+        item.get("hero_past", ""),
+        item["start_scene"],
+        bool(item.get("cache_replies", False)),
+        characters
+    )
+
+
+def read_rows(f, fmt):
+    """
+    Строки для db.add_stories из файла по одной.
+    """
+
+    for number, item in enumerate(read_pack(f, fmt), start=1):
+        yield story_row(item, number)
+
+
+async def import_pack(f, fmt, batch=STORY_PACK_BATCH):
+    """
+    Записывает истории пачками по batch, каждая пачка —
+    одна транзакция. Возвращает число историй.
+
+    Файл читается дважды: сначала проверяется целиком (ошибка
+    в любой истории — ничего не записано), потом пишется.
+    """
+
+    total = sum(1 for _ in read_rows(f, fmt))
+    f.seek(0)
+
+    rows = []
+    count = 0
+
+    try:
+        for row in read_rows(f, fmt):
+            rows.append(row)
+
+            if len(rows) >= batch:
+                await db.add_stories(rows)
+                count += len(rows)
+                rows = []
+
+        if rows:
+            await db.add_stories(rows)
+            count += len(rows)
+
+    except Exception as e:
+        raise RuntimeError(f"Записано {count} из {total} историй (первые {count} в файле): {e}") from e
+
+    return count
+
+
+# ================================
+# Запись
+# ================================
+def story_dict(story):
+    story_id, title, description, hero_past, start_scene, cache_replies, characters = story
+
+    return {
+        "title": title,
+        "description": description,
+        "hero_past": hero_past,
+        "start_scene": start_scene,
+        "cache_replies": bool(cache_replies),
+        "characters": [
+            {"name": name, "role": role, "personality": personality, "known": known}
+            for name, role, personality, known in characters
+        ]
+    }
+
+
+async def export_pack(f, fmt, batch=STORY_PACK_BATCH):
+    """
+    Выгружает все истории, читая БД страницами по id.
+    Возвращает число историй.
+    """
+
+    if fmt == "yaml":
+        yaml = _yaml()
+        dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+
+    after_id = 0
+    count = 0
+
+    if fmt == "json":
+        f.write("[")
+
+    while True:
+        stories = await db.get_stories_batch(after_id, batch)
+        if not stories:
+            break
+
+        for story in stories:
+            item = story_dict(story)
+
+            if fmt == "jsonl":
+                f.write(json.dumps(item, ensure_ascii=False) + "\n")
+            elif fmt == "yaml":
+                f.write(yaml.dump(item, Dumper=dumper, allow_unicode=True,
+                                  explicit_start=True, sort_keys=False))
+            else:
+                f.write(("," if count else "") + "\n" + json.dumps(item, ensure_ascii=False))
+
+            count += 1
+
+        after_id = stories[-1][0]
+
+    if fmt == "json":
+        f.write("\n]\n")
+
+    return count
+
+
+# ================================
+# Запуск
+# ================================
+async def run(args):
+    if args.db:
+        db.DB_NAME = args.db
+
+    fmt = pack_format(args.path, args.format)
+    await db.init_db()
+
+    started = time.perf_counter()
+    try:
+        if args.command == "import":
+            with open(args.path, encoding="utf-8") as f:
+                count = await import_pack(f, fmt, args.batch)
+        else:
+            with open(args.path, "w", encoding="utf-8") as f:
+                count = await export_pack(f, fmt, args.batch)
+    finally:
+        await db.close_db()
+
+    elapsed = time.perf_counter() - started
+    action = "Импортировано" if args.command == "import" else "Выгружено"
+    print(f"{action} историй: {count} за {elapsed:.2f} с ({fmt})")
+
+    # Кэш каталога живёт в процессе бота, отсюда его не сбросить
+    if args.command == "import" and count:
+        print("Работающий бот покажет их в каталоге не позже чем через "
+              "CATALOG_CACHE_TTL (600 с) или после перезапуска")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт и экспорт историй")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("path")
+    parser.add_argument("--format", choices=("json", "jsonl", "yaml"),
+                        help="по умолчанию — по расширению файла")
+    parser.add_argument("--db", help=f"файл БД (по умолчанию {db.DB_NAME})")
+    parser.add_argument("--batch", type=int, default=STORY_PACK_BATCH,
+                        help="историй в одной транзакции")
+
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
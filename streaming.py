@@ -0,0 +1,127 @@
+# ================================
+# streaming.py
+# Ответ AI по частям: одно сообщение в Telegram,
+# которое дописывается по мере генерации
+# ================================
+
+import asyncio
+import os
+import time
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+
+from outbox import outbox
+
+
+# ================================
+# Настройки
+# ================================
+# Включить потоковые ответы
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+
+# Не чаще одного редактирования в столько секунд на чат
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.0))
+
+# Лимит длины сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+class StreamingReply:
+    """
+    Получает куски ответа и показывает игроку готовые строки
+    "Имя: сообщение": первая строка отправляется сразу,
+    следующие дописываются редактированием того же сообщения
+    не чаще STREAM_EDIT_INTERVAL. finish() показывает весь текст.
+    """
+
+    def __init__(self, bot, chat_id, interval=STREAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+
+        self.text = ""
+        self._shown = ""
+        self._message_id = None
+        self._next_edit = 0.0
+
+    async def feed(self, delta):
+        self.text += delta
+
+        # Показываем только законченные строки
+        end = self.text.rfind("\n")
+        if end <= 0:
+            return
+
+        visible = self.text[:end].rstrip()
+        if not visible or visible == self._shown:
+            return
+
+        if time.monotonic() < self._next_edit:
+            return
+
+        await self._show(visible)
+
+    async def finish(self):
+        """
+        Показывает окончательный текст и возвращает его.
+        """
+
+        text = self.text.strip()
+        if not text:
+            return text
+
+        await self._show(text[:MESSAGE_LIMIT], final=True)
+
+        # Всё, что не влезло в одно сообщение, — через очередь чата
+        if len(text) > MESSAGE_LIMIT:
+            outbox.send(self.bot, self.chat_id, text[MESSAGE_LIMIT:])
+
+        return text
+
+    async def _show(self, text, final=False):
+        text = text[:MESSAGE_LIMIT]
+
+        # Правки тоже идут в общий лимит отправок бота
+        await outbox.throttle()
+
+        try:
+            if self._message_id is None:
+                message = await self.bot.send_message(self.chat_id, text)
+                self._message_id = message.message_id
+            elif text != self._shown:
+                await self.bot.edit_message_text(
+                    text, chat_id=self.chat_id, message_id=self._message_id
+                )
+
+            self._shown = text
+            self._next_edit = time.monotonic() + self.interval
+
+        except TelegramRetryAfter as e:
+            # Промежуточные правки можно пропустить, финальную — нет
+            outbox.retry_after(e.retry_after)
+            self._next_edit = time.monotonic() + e.retry_after
+            if final:
+                await asyncio.sleep(e.retry_after)
+                await self._show(text, final=True)
+
+        except TelegramBadRequest:
+            # "message is not modified" и т.п. — не критично
+            if final and self._message_id is None:
+                raise
+
+
+async def stream_to_chat(bot, chat_id, chunks):
+    """
+    Передаёт куски из async-генератора в чат.
+    Возвращает полный текст ответа.
+    """
+
+    # Сначала то, что уже стоит в очереди чата
+    await outbox.idle(chat_id)
+
+    reply = StreamingReply(bot, chat_id)
+
+    async for delta in chunks:
+        await reply.feed(delta)
+
+    return await reply.finish()
@@ -0,0 +1,136 @@
+# ================================
+# summary.py
+# Фоновое сжатие старой переписки в конспект
+# ================================
+
+import asyncio
+import logging
+import os
+
+import db
+import groq_ai
+from cache import LRUCache
+from prompts import approx_tokens, truncate_to_tokens
+
+
+log = logging.getLogger(__name__)
+
+
+# ================================
+# Настройки
+# ================================
+# Сколько свежих сообщений не сжимать, если ход не сообщил,
+# сколько их на самом деле уместилось в промпт
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", 20))
+
+# Сжимать, когда из окна вышло хотя бы столько сообщений
+SUMMARY_BATCH = int(os.getenv("SUMMARY_BATCH", 10))
+
+# Сколько токенов старых сообщений отдавать в один запрос
+SUMMARY_INPUT_TOKENS = int(os.getenv("SUMMARY_INPUT_TOKENS", 2500))
+
+
+class SummaryMemory:
+    """
+    Инкрементальный конспект для каждой пары (user_id, story_id).
+
+    После хода вызывается schedule(): обновление идёт в фоне,
+    вне пути ответа игроку. В конспект добавляются только сообщения,
+    вышедшие из окна памяти с прошлого раза. Окно — столько
+    последних сообщений, сколько уместилось в промпт хода
+    (PromptBuilder.kept_messages), а не фиксированное число.
+    """
+
+    def __init__(self, keep_recent=SUMMARY_KEEP_RECENT, batch=SUMMARY_BATCH,
+                 input_tokens=SUMMARY_INPUT_TOKENS):
+        self.keep_recent = keep_recent
+        self.batch = batch
+        self.input_tokens = input_tokens
+
+        # Примерное число новых сообщений с последней проверки;
+        # по нему решаем, стоит ли вообще идти в БД
+        self._unsummarized = LRUCache(maxsize=100_000)
+        self._tasks = {}
+
+    def schedule(self, user_id, story_id, new_messages=2, keep=None):
+        """
+        Отмечает новые сообщения и при необходимости
+        запускает фоновое обновление конспекта.
+        keep — сколько последних сообщений есть в промпте
+        (их сжимать не нужно); по умолчанию keep_recent.
+        """
+
+        key = (user_id, story_id)
+        keep = self.keep_recent if keep is None else keep
+
+        count = self._unsummarized.get(key, keep + self.batch) + new_messages
+        self._unsummarized.set(key, count)
+
+        if count < keep + self.batch or key in self._tasks:
+            return
+
+        task = asyncio.create_task(self._update(key, keep))
+        self._tasks[key] = task
+        task.add_done_callback(lambda t: self._tasks.pop(key, None))
+
+    async def _update(self, key, keep):
+        user_id, story_id = key
+
+        try:
+            while True:
+                summary, upto_id = await db.get_summary(user_id, story_id)
+                rows = await db.get_aged_out_messages(
+                    user_id, story_id, upto_id, keep
+                )
+
+                self._unsummarized.set(key, keep + len(rows))
+                if len(rows) < self.batch:
+                    return
+
+                chunk = self._take_chunk(rows)
+                new_summary = await groq_ai.summarize_dialog(
+                    summary, [(sender, text) for _, sender, text in chunk]
+                )
+                if new_summary is None:
+                    return
+
+                await db.save_summary(user_id, story_id, new_summary, chunk[-1][0])
+
+                if len(chunk) == len(rows):
+                    self._unsummarized.set(key, keep)
+                    return
+
+        except Exception:
+            log.exception("Не удалось обновить конспект %s", key)
+
+    def _take_chunk(self, rows):
+        """
+        Самые старые сообщения, которые влезают в SUMMARY_INPUT_TOKENS
+        (минимум одно).
+        """
+
+        budget = self.input_tokens
+        chunk = []
+
+        for msg_id, sender, text in rows:
+            budget -= approx_tokens(text)
+            if chunk and budget < 0:
+                break
+            chunk.append((msg_id, sender, truncate_to_tokens(text or "", self.input_tokens)))
+
+        return chunk
+
+    async def close(self):
+        """
+        Отменяет незавершённые обновления: сообщения
+        останутся несжатыми и сожмутся при следующем ходе.
+        """
+
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+summary_memory = SummaryMemory()
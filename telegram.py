@@ -0,0 +1,27 @@
+# ================================
+# telegram.py
+# Клиент Bot API (общий для бота и рабочих процессов)
+# ================================
+
+import os
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from config import BOT_TOKEN
+
+
+# ================================
+# Настройки
+# ================================
+# Свой адрес Bot API (локальный сервер или фейк для бенчмарков)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+
+def create_bot():
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+        return Bot(token=BOT_TOKEN, session=session)
+
+    return Bot(token=BOT_TOKEN)
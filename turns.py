@@ -0,0 +1,69 @@
+# ================================
+# turns.py
+# Ходы игроков: строго по очереди для каждой
+# пары (user_id, story_id), с объединением сообщений
+# ================================
+
+import logging
+
+import metrics
+
+
+log = logging.getLogger(__name__)
+
+
+class TurnScheduler:
+    """
+    Пока AI отвечает на ход игрока, его новые сообщения
+    не запускают отдельные запросы, а копятся и уходят
+    одним следующим ходом. Ответы приходят по порядку,
+    и один игрок не может занять весь лимит AI.
+    """
+
+    def __init__(self):
+        self._pending = {}
+        self.turns = 0
+        self.merged = 0
+
+    async def submit(self, key, text, run_turn):
+        """
+        Добавляет сообщение игрока. Если ход уже идёт —
+        сообщение войдёт в следующий ход, вернётся False.
+        Иначе ходы выполняются здесь через await run_turn(texts),
+        пока есть накопленные сообщения; вернётся True.
+        """
+
+        pending = self._pending.get(key)
+        if pending is not None:
+            pending.append(text)
+            self.merged += 1
+            return False
+
+        pending = self._pending[key] = [text]
+
+        try:
+            while pending:
+                texts = pending[:]
+                pending.clear()
+
+                self.turns += 1
+                try:
+                    await run_turn(texts)
+                except Exception as e:
+                    metrics.error(f"turn_{type(e).__name__}")
+                    log.exception("Ошибка хода %s", key)
+        finally:
+            del self._pending[key]
+
+        return True
+
+    def stats(self):
+        return {
+            "active": len(self._pending),
+            "queued": sum(len(p) for p in self._pending.values()),
+            "turns": self.turns,
+            "merged": self.merged
+        }
+
+
+turn_scheduler = TurnScheduler()
@@ -0,0 +1,291 @@
+# ================================
+# warmup.py
+# Заготовка первого хода: пока игрок читает
+# начальную сцену, в фоне готовятся контекст
+# и ответы на самые частые первые сообщения
+# ================================
+
+import asyncio
+import logging
+import os
+from collections import Counter
+
+import db
+import metrics
+from cache import LRUCache
+from groq_ai import generate_story_reply, AI_ERROR_REPLY
+from prompts import prompt_builder
+from ratelimit import ai_scheduler, PRIORITY_BACKGROUND
+from reply_cache import normalize
+
+
+log = logging.getLogger(__name__)
+
+
+# ================================
+# Настройки
+# ================================
+# Включить заготовку первого хода (запросы к AI, которые могут не пригодиться)
+FIRST_TURN_WARMUP = os.getenv("FIRST_TURN_WARMUP", "0") == "1"
+
+# Сколько самых частых первых сообщений истории заготавливать
+# (0 — только контекст и промпт, без запросов к AI)
+FIRST_TURN_GUESSES = int(os.getenv("FIRST_TURN_GUESSES", 2))
+
+# Сколько заготовок генерируется одновременно (на весь бот)
+FIRST_TURN_CONCURRENCY = int(os.getenv("FIRST_TURN_CONCURRENCY", 4))
+
+# Сколько секунд заготовка ждёт первого сообщения игрока
+FIRST_TURN_TTL = float(os.getenv("FIRST_TURN_TTL", 120))
+
+# Не больше стольких игроков с заготовкой одновременно
+FIRST_TURN_MAX_SESSIONS = int(os.getenv("FIRST_TURN_MAX_SESSIONS", 1000))
+
+# Заготавливать только сообщения, которые писали хотя бы столько игроков
+FIRST_TURN_MIN_COUNT = 2
+
+# Сколько разных первых сообщений помнить на историю
+_OPENINGS_KEPT = 64
+
+
+class _Session:
+    """
+    Заготовка одного игрока: контекст, с которым
+    генерировались ответы, и задачи генерации.
+    """
+
+    __slots__ = ("task", "timer", "context", "summary", "replies")
+
+    def __init__(self):
+        self.task = None
+        self.timer = None
+        self.context = None
+        self.summary = None
+
+        # normalize(сообщение) -> Task с ответом
+        self.replies = {}
+
+    def cancel(self):
+        self.timer.cancel()
+        self.task.cancel()
+        for task in self.replies.values():
+            task.cancel()
+
+
+class FirstTurnWarmup:
+    """
+    start() вызывается при начале истории. В фоне:
+    1) история, персонажи, конспект и последние сообщения
+       читаются в кэши, статичный блок промпта рендерится;
+    2) на guesses самых частых первых сообщений этой истории
+       (по прошлым игрокам) генерируются ответы — с фоновым
+       приоритетом, только пока у AI есть свободные места.
+
+    take() вызывается первым ходом игрока: если его сообщение
+    совпало с заготовкой и контекст не менялся, ход получает
+    готовый (или уже генерирующийся) ответ. Остальные
+    заготовки отменяются.
+    """
+
+    def __init__(self, enabled=FIRST_TURN_WARMUP, guesses=FIRST_TURN_GUESSES,
+                 concurrency=FIRST_TURN_CONCURRENCY, ttl=FIRST_TURN_TTL,
+                 max_sessions=FIRST_TURN_MAX_SESSIONS):
+        self.enabled = enabled
+        self.guesses = guesses
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+        # story_id -> (Counter normalize(текст), {normalize(текст): текст})
+        self.openings = LRUCache(maxsize=10_000)
+
+        # (user_id, story_id) -> _Session
+        self._sessions = {}
+
+        # Заготовки, ждущие места в semaphore
+        self._queued = set()
+
+        self.started = 0
+        self.generated = 0
+        self.used = 0
+        self.cancelled = 0
+        self.skipped = 0
+
+    # ----------------------------
+    # Начало истории
+    # ----------------------------
+    def start(self, user_id, story_id):
+        if not self.enabled:
+            return
+
+        key = (user_id, story_id)
+        self.cancel(key)
+
+        if len(self._sessions) >= self.max_sessions:
+            self.skipped += 1
+            return
+
+        session = _Session()
+        session.task = asyncio.create_task(self._warm(key, session))
+        session.timer = asyncio.get_running_loop().call_later(self.ttl, self.cancel, key)
+
+        self._sessions[key] = session
+        self.started += 1
+
+    def cancel(self, key):
+        session = self._sessions.pop(key, None)
+        if session is not None:
+            self.cancelled += len(session.replies)
+            session.cancel()
+
+    async def _warm(self, key, session):
+        user_id, story_id = key
+
+        try:
+            story = await db.get_story(story_id)
+            characters = await db.get_characters(story_id)
+            summary, _ = await db.get_summary(user_id, story_id)
+            context = await db.get_last_messages(user_id, story_id, limit=db.DIALOG_BUFFER_SIZE)
+
+            if story is None:
+                return
+
+            prompt_builder.system_prompt(story_id, story, characters)
+            session.context = [tuple(m) for m in context]
+            session.summary = summary
+
+            for text in self.likely_openings(story_id):
+                # AI занят ходами игроков — не мешаем
+                if not ai_scheduler.has_capacity():
+                    break
+
+                session.replies[normalize(text)] = asyncio.create_task(self._generate(
+                    story_id, story, characters, context, text, summary
+                ))
+
+        except Exception:
+            log.exception("Не удалось заготовить первый ход %s", key)
+
+    async def _generate(self, story_id, story, characters, context, text, summary):
+        task = asyncio.current_task()
+        self._queued.add(task)
+
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self._queued.discard(task)
+
+        try:
+            reply = await generate_story_reply(
+                story_id, story, characters, context, text, summary,
+                priority=PRIORITY_BACKGROUND
+            )
+        finally:
+            self.semaphore.release()
+
+        self.generated += 1
+        return None if reply == AI_ERROR_REPLY else reply
+
+    # ----------------------------
+    # Первый ход игрока
+    # ----------------------------
+    async def take(self, user_id, story_id, dialog_context, user_message, summary):
+        """
+        Заготовленный ответ на user_message или None.
+        """
+
+        session = self._sessions.pop((user_id, story_id), None)
+        if session is None:
+            return None
+
+        self.learn(story_id, user_message)
+
+        task = session.replies.pop(normalize(user_message), None)
+        session.cancel()
+        self.cancelled += len(session.replies)
+
+        if task is None:
+            return None
+
+        # Ответ годится, только если переписка с тех пор не менялась
+        # (заготовка могла видеть больше старых сообщений — не страшно)
+        context = [tuple(m) for m in dialog_context]
+        skip = len(session.context) - len(context)
+        if session.summary != summary or skip < 0 or session.context[skip:] != context \
+                or task in self._queued:
+            # Заготовка ещё не начиналась — быстрее сгенерировать обычным ходом
+            task.cancel()
+            self.cancelled += 1
+            return None
+
+        try:
+            reply = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            # Отменили сам ход, а не заготовку
+            if not task.cancelled():
+                raise
+            reply = None
+        except Exception:
+            log.exception("Заготовка первого хода не удалась")
+            reply = None
+
+        if reply is None:
+            return None
+
+        self.used += 1
+        metrics.note("warmup", "hit")
+        return reply
+
+    # ----------------------------
+    # Частые первые сообщения
+    # ----------------------------
+    def learn(self, story_id, user_message):
+        entry = self.openings.get(story_id)
+        if entry is None:
+            entry = (Counter(), {})
+            self.openings.set(story_id, entry)
+
+        counts, texts = entry
+        key = normalize(user_message)
+        if not key:
+            return
+
+        counts[key] += 1
+        texts.setdefault(key, user_message)
+
+        if len(counts) > _OPENINGS_KEPT * 2:
+            for rare, _ in counts.most_common()[_OPENINGS_KEPT:]:
+                del counts[rare]
+                del texts[rare]
+
+    def likely_openings(self, story_id):
+        entry = self.openings.get(story_id)
+        if entry is None:
+            return []
+
+        counts, texts = entry
+        return [
+            texts[key] for key, count in counts.most_common(self.guesses)
+            if count >= FIRST_TURN_MIN_COUNT
+        ]
+
+    async def close(self):
+        sessions = list(self._sessions.values())
+        for key in list(self._sessions):
+            self.cancel(key)
+
+        tasks = [s.task for s in sessions] + [t for s in sessions for t in s.replies.values()]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "sessions": len(self._sessions),
+            "started": self.started,
+            "generated": self.generated,
+            "used": self.used,
+            "cancelled": self.cancelled,
+            "skipped": self.skipped
+        }
+
+
+first_turn = FirstTurnWarmup()
@@ -0,0 +1,492 @@
+# ================================
+# worker.py
+# Рабочие процессы: ходы игроков из очереди
+# turn_jobs (SQLite) -> AI -> ответ в Telegram
+#
+# bot.py с WORKER_PROCESSES=N сам запускает
+# и перезапускает N таких процессов:
+# python worker.py --index 0 --count N
+# ================================
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from aiogram.utils.chat_action import ChatActionSender
+
+import db
+import metrics
+from groq_ai import generate_story_reply, stream_story_reply, close_session
+from metrics import stage
+from outbox import outbox
+from prompts import prompt_builder
+from ratelimit import TokenBucket
+from streaming import STREAM_REPLIES, stream_to_chat
+from summary import summary_memory
+from telegram import create_bot
+
+
+log = logging.getLogger(__name__)
+
+
+# ================================
+# Настройки
+# ================================
+# Сколько рабочих процессов запускает bot.py (0 — ходы в самом bot.py)
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", 0))
+
+# Сколько ходов один процесс выполняет одновременно
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", 32))
+
+# Как часто проверять очередь, когда она пуста (с)
+WORKER_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL", 0.05))
+
+# Аренда хода: если процесс упал, через столько секунд
+# ход заберёт перезапущенный процесс. Продлевается каждые LEASE/3
+TURN_LEASE = float(os.getenv("TURN_LEASE", 60))
+
+# После стольких попыток ход выбрасывается
+TURN_MAX_ATTEMPTS = int(os.getenv("TURN_MAX_ATTEMPTS", 5))
+
+# Сколько ждать текущие ходы при остановке (с)
+WORKER_STOP_TIMEOUT = float(os.getenv("WORKER_STOP_TIMEOUT", 20))
+
+# Как часто процесс отправляет боту свои метрики (с):
+# /metrics бота показывает ходы и ошибки всех процессов
+WORKER_METRICS_INTERVAL = float(os.getenv("WORKER_METRICS_INTERVAL", 1))
+
+# Лимиты, которые делятся между процессами поровну
+SHARED_LIMITS = (
+    "AI_MAX_CONCURRENCY", "AI_REQUESTS_PER_MINUTE", "AI_BURST", "AI_TOKENS_PER_MINUTE",
+    "GROQ_MAX_CONNECTIONS"
+)
+
+# В Telegram отправляет и сам бот (меню, каталог, начальные сцены),
+# поэтому эти лимиты делятся на N процессов + бот
+TELEGRAM_LIMITS = ("TELEGRAM_SENDS_PER_SECOND", "TELEGRAM_SENDS_BURST")
+
+
+# Строки в stdout процесса для бота: процесс загрузился
+# и берёт ходы; метрики с прошлой отправки (JSON)
+_READY = b"ready\n"
+_METRICS = b"metrics "
+
+
+def _utc():
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+
+# ================================
+# Приём хода (handlers.py)
+# ================================
+async def enqueue_turn(user_id, story_id, chat_id, text):
+    """
+    Ставит сообщение игрока в очередь рабочих процессов.
+    Незаписанные сообщения сессии (например, вступление
+    истории) сначала дописываются в БД: процесс прочитает их оттуда.
+    """
+
+    if db.message_log.unflushed((user_id, story_id)):
+        await db.message_log.flush()
+
+    await db.enqueue_turn(user_id, story_id, chat_id, text, time.time())
+
+
+# ================================
+# Рабочий процесс
+# ================================
+class Worker:
+    """
+    Забирает ходы своей части игроков (user_id % count == index):
+    сообщения одного игрока всегда у одного процесса, по порядку,
+    и пока его ход выполняется, новые сообщения копятся и уходят
+    одним следующим ходом.
+
+    Ход выполняется хотя бы один раз: сообщения хода и удаление
+    его из очереди записываются одной транзакцией уже после
+    отправки ответа. Упавший процесс перезапускается, и его ходы
+    с истёкшей арендой выполняются заново (ответ может прийти дважды,
+    но история в БД — без дублей).
+    """
+
+    def __init__(self, bot, index=0, count=1, concurrency=WORKER_CONCURRENCY,
+                 poll_interval=WORKER_POLL_INTERVAL, lease=TURN_LEASE):
+        self.bot = bot
+        self.index = index
+        self.count = count
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+
+        # task -> id сообщений хода
+        self._running = {}
+        self._stopping = asyncio.Event()
+        self._wakeup = asyncio.Event()
+
+        self.turns = 0
+        self.retried = 0
+        self.dropped = 0
+
+    # ----------------------------
+    # Цикл
+    # ----------------------------
+    async def run(self):
+        renewer = asyncio.create_task(self._renew())
+
+        try:
+            while not self._stopping.is_set():
+                free = self.concurrency - len(self._running)
+                claimed = []
+
+                now = time.time()
+                if free > 0 and await db.has_turns(self.index, self.count, now):
+                    claimed = await db.claim_turns(
+                        self.name, self.index, self.count, free, now, now + self.lease
+                    )
+
+                for turn in claimed:
+                    task = asyncio.create_task(self._play(*turn))
+                    self._running[task] = turn[3]
+                    task.add_done_callback(self._done)
+
+                # Забрали столько, сколько могли, — сразу снова
+                if claimed and len(claimed) == free:
+                    continue
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            renewer.cancel()
+            await self._finish_running()
+
+    def _done(self, task):
+        self._running.pop(task, None)
+        self._wakeup.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wakeup.set()
+
+    async def _finish_running(self):
+        """
+        Даёт текущим ходам закончиться, остальные возвращает в очередь.
+        """
+
+        if not self._running:
+            return
+
+        _, pending = await asyncio.wait(list(self._running), timeout=WORKER_STOP_TIMEOUT)
+
+        job_ids = [job_id for task in pending for job_id in self._running.get(task, ())]
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        if job_ids:
+            await db.release_turns(job_ids)
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+
+            job_ids = [job_id for ids in self._running.values() for job_id in ids]
+            if job_ids:
+                try:
+                    await db.extend_turns(job_ids, time.time() + self.lease)
+                except Exception:
+                    log.exception("Не удалось продлить аренду ходов")
+
+    # ----------------------------
+    # Ход
+    # ----------------------------
+    async def _play(self, user_id, story_id, chat_id, job_ids, texts, attempts):
+        if attempts > TURN_MAX_ATTEMPTS:
+            self.dropped += 1
+            metrics.error("turn_job_dropped")
+            log.error("Ход %s выброшен после %d попыток", (user_id, story_id), attempts - 1)
+            await db.drop_turns(job_ids)
+            return
+
+        if attempts > 1:
+            self.retried += 1
+
+        self.turns += 1
+
+        try:
+            await play_turn(self.bot, user_id, story_id, chat_id, job_ids, texts)
+        except Exception as e:
+            metrics.error(f"turn_{type(e).__name__}")
+            log.exception("Ошибка хода %s", (user_id, story_id))
+
+            # Повтор — с растущей паузой
+            await db.extend_turns(job_ids, time.time() + min(2 ** attempts, self.lease))
+
+    def stats(self):
+        return {
+            "running": len(self._running),
+            "turns": self.turns,
+            "retried": self.retried,
+            "dropped": self.dropped
+        }
+
+
+async def play_turn(bot, user_id, story_id, chat_id, job_ids, texts):
+    """
+    Ход игрока в рабочем процессе: то же, что handlers.play_turn,
+    но сообщения записываются в конце, вместе с удалением
+    хода из очереди.
+    """
+
+    user_message = "\n".join(texts)
+
+    with metrics.turn_timing(user_id, story_id):
+        metrics.note("messages", len(texts))
+
+        with stage("context_read"):
+            dialog_context = await db.read_last_messages(
+                user_id, story_id, db.DIALOG_BUFFER_SIZE
+            )
+
+        with stage("story_load"):
+            story_data = await db.get_story(story_id)
+            characters = await db.get_characters(story_id)
+            summary, _ = await db.get_summary(user_id, story_id)
+
+        if story_data is None:
+            await db.drop_turns(job_ids)
+            return
+
+        async with ChatActionSender.typing(bot=bot, chat_id=chat_id):
+            if STREAM_REPLIES:
+                with stage("ai_stream"):
+                    reply = await stream_to_chat(bot, chat_id, stream_story_reply(
+                        story_id, story_data, characters, dialog_context, user_message, summary
+                    ))
+            else:
+                with stage("ai"):
+                    reply = await generate_story_reply(
+                        story_id, story_data, characters, dialog_context, user_message, summary
+                    )
+
+                # Ход закрывается только после отправки: очередь чата
+                # и сама отправка (её отдельно замеряет outbox)
+                with stage("telegram_wait"):
+                    await outbox.send(bot, chat_id, reply)
+
+        timestamp = _utc()
+        rows = [(user_id, story_id, "player", text, timestamp) for text in texts]
+        rows.append((user_id, story_id, "character", reply, timestamp))
+
+        with stage("db_write"):
+            await db.finish_turn(job_ids, rows)
+
+    # Конспект — всё, что не уместилось в промпт (как в handlers.play_turn)
+    kept = prompt_builder.kept_messages(
+        story_id, story_data, characters, dialog_context, user_message, summary
+    )
+    summary_memory.schedule(
+        user_id, story_id, new_messages=len(texts) + 1, keep=kept + len(texts) + 1
+    )
+
+
+# ================================
+# Запуск процессов (bot.py)
+# ================================
+class Supervisor:
+    """
+    Запускает count рабочих процессов и перезапускает упавшие.
+    Общие лимиты AI делятся между ними поровну,
+    лимиты Telegram — между ними и самим ботом.
+    """
+
+    def __init__(self, count=WORKER_PROCESSES):
+        self.count = count
+        self.restarts = 0
+        self._processes = {}
+        self._tasks = []
+        self._stopping = False
+
+        # index -> Event: процесс загрузился (aiogram, БД) и берёт ходы
+        self._ready = {}
+
+    def _limits(self):
+        """
+        Доля каждого общего лимита на один процесс.
+        """
+
+        import groq_ai
+        import outbox as outbox_module
+        import ratelimit
+
+        limits = {}
+        for name in SHARED_LIMITS + TELEGRAM_LIMITS:
+            module = next(m for m in (ratelimit, groq_ai, outbox_module) if hasattr(m, name))
+            value = getattr(module, name)
+            share = value / (self.count + 1 if name in TELEGRAM_LIMITS else self.count)
+            limits[name] = max(int(share), 1) if isinstance(value, int) else share
+
+        return limits
+
+    def _env(self, limits):
+        env = dict(os.environ)
+        env.update((name, str(value)) for name, value in limits.items())
+        env["DB_NAME"] = db.DB_NAME
+        return env
+
+    def start(self):
+        limits = self._limits()
+
+        # Доля самого бота — его собственная очередь отправок
+        outbox.bucket = TokenBucket(
+            limits["TELEGRAM_SENDS_PER_SECOND"], limits["TELEGRAM_SENDS_BURST"]
+        )
+
+        env = self._env(limits)
+        for index in range(self.count):
+            self._ready[index] = asyncio.Event()
+            self._tasks.append(asyncio.create_task(self._keep(index, env)))
+
+    async def wait_ready(self):
+        """
+        Ждёт, пока все процессы загрузятся (несколько секунд
+        на импорт aiogram и открытие БД).
+        """
+
+        await asyncio.gather(*(ready.wait() for ready in self._ready.values()))
+
+    async def _keep(self, index, env):
+        script = os.path.abspath(__file__)
+
+        while not self._stopping:
+            self._ready[index].clear()
+            process = await asyncio.create_subprocess_exec(
+                sys.executable, script, "--index", str(index), "--count", str(self.count),
+                env=env, stdout=asyncio.subprocess.PIPE, limit=2 ** 22
+            )
+            self._processes[index] = process
+            await self._watch(index, process.stdout)
+            code = await process.wait()
+
+            if self._stopping:
+                return
+
+            self.restarts += 1
+            log.warning("Рабочий процесс %d завершился (код %s), перезапуск", index, code)
+            await asyncio.sleep(1)
+
+    async def _watch(self, index, stdout):
+        """
+        Читает stdout процесса до конца: строка _READY отмечает
+        готовность, метрики складываются в registry бота,
+        остальное выводится как есть.
+        """
+
+        async for line in stdout:
+            if line == _READY:
+                self._ready[index].set()
+            elif line.startswith(_METRICS):
+                metrics.merge(json.loads(line[len(_METRICS):]))
+            else:
+                sys.stdout.buffer.write(line)
+                sys.stdout.flush()
+
+    async def close(self):
+        self._stopping = True
+
+        for process in self._processes.values():
+            if process.returncode is None:
+                process.send_signal(signal.SIGTERM)
+
+        await asyncio.gather(*(p.wait() for p in self._processes.values()))
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def stats(self):
+        return {
+            "processes": sum(p.returncode is None for p in self._processes.values()),
+            "ready": sum(ready.is_set() for ready in self._ready.values()),
+            "restarts": self.restarts
+        }
+
+
+supervisor = Supervisor()
+
+
+# ================================
+# Точка входа рабочего процесса
+# ================================
+def _send_metrics(since):
+    now = time.monotonic()
+    data = json.dumps(metrics.snapshot(since), separators=(",", ":"))
+    sys.stdout.buffer.write(_METRICS + data.encode() + b"\n")
+    sys.stdout.flush()
+    return now
+
+
+async def _report_metrics():
+    """
+    Раз в WORKER_METRICS_INTERVAL отправляет боту накопленные
+    метрики; при остановке — последние.
+    """
+
+    since = time.monotonic()
+    try:
+        while True:
+            await asyncio.sleep(WORKER_METRICS_INTERVAL)
+            since = _send_metrics(since)
+    finally:
+        _send_metrics(since)
+
+
+async def main(index, count):
+    bot = create_bot()
+    await db.init_db()
+
+    worker = Worker(bot, index, count)
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, worker.stop)
+        except NotImplementedError:
+            pass
+
+    log.info("Рабочий процесс %d/%d запущен", index, count)
+    sys.stdout.buffer.write(_READY)
+    sys.stdout.flush()
+
+    reporter = asyncio.create_task(_report_metrics())
+
+    try:
+        await worker.run()
+    finally:
+        await summary_memory.close()
+        await outbox.close()
+        await close_session()
+        await bot.session.close()
+
+        reporter.cancel()
+        await asyncio.gather(reporter, return_exceptions=True)
+        await db.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Рабочий процесс Horror-Studio Bot")
+    parser.add_argument("--index", type=int, default=0)
+    parser.add_argument("--count", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        format=f"%(asctime)s %(levelname)s worker-{args.index} %(name)s: %(message)s"
+    )
+    asyncio.run(main(args.index, args.count))